@@ -5,13 +5,15 @@ from contracting import config
 
 #from contracting.logger import get_logger
 from contracting.compilation.linter import Linter
+from contracting.compilation.counters import instrument
 import copy
 
 class ContractingCompiler(ast.NodeTransformer):
-    def __init__(self, module_name='__main__', linter=Linter()):
+    def __init__(self, module_name='__main__', linter=Linter(), counters=False):
         #self.log = get_logger('Contracting.Compiler')
         self.module_name = module_name
         self.linter = linter
+        self.counters = counters  # Compile stamp counters into the transformed tree, see compilation.counters
         self.lint_alerts = None
         self.constructor_visited = False
         self.private_names = set()
@@ -42,6 +44,9 @@ class ContractingCompiler(ast.NodeTransformer):
 
         ast.fix_missing_locations(tree)
 
+        if self.counters:
+            tree = instrument(tree)
+
         # reset state
         self.private_names = set()
         self.orm_names = set()
@@ -65,6 +70,15 @@ class ContractingCompiler(ast.NodeTransformer):
         code = astor.to_source(tree)
         return code
 
+    def parse_to_artifacts(self, source, lint=True):
+        """
+        Canonical source and code object of a contract. The code object is compiled from the canonical source, like
+        the ones compiled from the stored code later, so the line numbers of all of them agree.
+        """
+        code = self.parse_to_code(source, lint=lint)
+        code_obj = compile(code, '', 'exec')
+        return code, code_obj
+
     def visit_FunctionDef(self, node):
 
         # Presumes all decorators are valid, as caught by linter.
@@ -0,0 +1,134 @@
+import ast
+
+from .. import config
+
+"""
+Stamp counters compiled into contract code, for metering without a trace function.
+
+Every block that can run more than once per call gets one call to the tracer's count() at its start, charged with
+what the block costs up front:
+
+    * module bodies and functions, on entry
+    * for and while loops, on every iteration
+    * comprehensions, on every iteration of each generator, from a condition that is always true
+
+The cost of a block is the number of AST nodes it runs times COUNTER_NODE_COST. Bodies of nested functions, loops and
+comprehensions are left to their own counters. Of the branches of an if, the most expensive one is charged, so a block
+costs the same whichever way it goes.
+"""
+
+COMPREHENSIONS = (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+
+
+class StampCounter(ast.NodeTransformer):
+    def __init__(self, node_cost=config.COUNTER_NODE_COST):
+        self.node_cost = node_cost
+
+    def expression_cost(self, node):
+        if isinstance(node, ast.expr_context):
+            return 0
+
+        if isinstance(node, COMPREHENSIONS):
+            # Only the outermost iterable is evaluated by the enclosing block
+            return 1 + self.expression_cost(node.generators[0].iter)
+
+        return 1 + sum(self.expression_cost(child) for child in ast.iter_child_nodes(node))
+
+    def statement_cost(self, node):
+        if isinstance(node, ast.FunctionDef):
+            return 1 + sum(self.expression_cost(d) for d in node.decorator_list) + \
+                   self.expression_cost(node.args)
+
+        if isinstance(node, ast.For):
+            return 1 + self.expression_cost(node.iter) + self.block_cost(node.orelse)
+
+        if isinstance(node, ast.While):
+            return 1 + self.expression_cost(node.test) + self.block_cost(node.orelse)
+
+        if isinstance(node, ast.If):
+            return 1 + self.expression_cost(node.test) + max(self.block_cost(node.body), self.block_cost(node.orelse))
+
+        return self.expression_cost(node)
+
+    def block_cost(self, body):
+        return sum(self.statement_cost(node) for node in body)
+
+    def counter(self, cost, node):
+        call = ast.Call(func=ast.Name(id=config.METER_FUNC_NAME, ctx=ast.Load()),
+                        args=[ast.Num(n=cost * self.node_cost)], keywords=[])
+        return ast.copy_location(call, node)
+
+    def meter(self, body, cost):
+        # Docstrings stay the first statement
+        idx = 0
+        if body and isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Str):
+            idx = 1
+
+        node = body[min(idx, len(body) - 1)]
+        body.insert(idx, ast.copy_location(ast.Expr(value=self.counter(cost, node)), node))
+
+    def visit_Module(self, node):
+        cost = self.block_cost(node.body)
+        self.generic_visit(node)
+        if node.body:
+            self.meter(node.body, cost)
+        return node
+
+    def visit_FunctionDef(self, node):
+        cost = self.block_cost(node.body)
+        self.generic_visit(node)
+        self.meter(node.body, cost)
+        return node
+
+    def visit_For(self, node):
+        cost = self.expression_cost(node.target) + self.block_cost(node.body)
+        self.generic_visit(node)
+        self.meter(node.body, cost)
+        return node
+
+    def visit_While(self, node):
+        cost = self.expression_cost(node.test) + self.block_cost(node.body)
+        self.generic_visit(node)
+        self.meter(node.body, cost)
+        return node
+
+    def visit_comprehension_node(self, node):
+        if isinstance(node, ast.DictComp):
+            elt_cost = self.expression_cost(node.key) + self.expression_cost(node.value)
+        else:
+            elt_cost = self.expression_cost(node.elt)
+
+        costs = []
+        for i, generator in enumerate(node.generators):
+            # Each iteration of a generator assigns its target, tests its conditions and either starts the next
+            # generator or produces an element
+            following = elt_cost
+            if i + 1 < len(node.generators):
+                following = self.expression_cost(node.generators[i + 1].iter)
+
+            costs.append(self.expression_cost(generator.target) +
+                         sum(self.expression_cost(c) for c in generator.ifs) + following)
+
+        self.generic_visit(node)
+
+        for generator, cost in zip(node.generators, costs):
+            generator.ifs.insert(0, self.counter(cost, generator.iter))
+
+        return node
+
+    visit_ListComp = visit_comprehension_node
+    visit_SetComp = visit_comprehension_node
+    visit_DictComp = visit_comprehension_node
+    visit_GeneratorExp = visit_comprehension_node
+
+
+def instrument(tree, node_cost=config.COUNTER_NODE_COST):
+    """Add stamp counters to a parsed contract. The tree is changed in place and returned"""
+    tree = StampCounter(node_cost=node_cost).visit(tree)
+    ast.fix_missing_locations(tree)
+    return tree
+
+
+def compile_source(source, node_cost=config.COUNTER_NODE_COST):
+    """Code object with stamp counters of the canonical source of a contract, as stored by the driver"""
+    return compile(instrument(ast.parse(source), node_cost=node_cost), '', 'exec')
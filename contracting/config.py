@@ -1,3 +1,4 @@
+# 'redis' or 'lmdb'. lmdb keeps state in an embedded store under LMDB_DIR instead of talking to a Redis server
 DB_TYPE = 'redis'
 
 DB_URL = 'localhost'
@@ -7,29 +8,86 @@ DB_OFFSET = 1
 
 DB_DELIMITER = ':'
 
+# Sorted set that indexes every key written through the RedisDriver so that prefix lookups avoid KEYS / SCAN
+KEY_INDEX = '__key_index__'
+
+# Bookkeeping of the node stored next to the state but outside of its keyspace, i.e. CACHE_POOL_KEY. A Redis hash
+# under this name, or the LMDB sub database of this name
+META_KEY = '__meta__'
+
+# How values are serialized in the database. 'json' or 'msgpack'. See contracting.db.encoder
+CODEC = 'json'
+
+# Number of decoded values ContractDriver keeps around so hot keys are not decoded again on every read
+DECODED_CACHE_SIZE = 4096
+
+# Number of compiled contracts the module loader keeps in memory. The least recently imported ones are evicted
+MODULE_CACHE_SIZE = 1024
+
+# 'blocks' charges every instruction of contract code from per code object cost tables and skips line events outside
+# of contracts. 'lines' charges the first opcode of every line executed in any frame. 'counters' runs without a trace
+# function: contracts are compiled with a stamp counter at the start of every function and loop iteration
+METERING = 'blocks'
+
+# Name contract code compiled with stamp counters calls them by, and what every AST node they cover costs
+METER_FUNC_NAME = '__meter__'
+COUNTER_NODE_COST = 3
+
+LMDB_DIR = './state'
+LMDB_MAP_SIZE = 2 ** 32  # 4gb of address space. Only pages actually written take up disk
+LMDB_MAX_DBS = 16
+
 # Number of available db's SenecaClients have available to get ahead on the next sub block while other sb's are
 # awaiting a merge confirmation
 NUM_CACHES = 4
 
+# Bounds of the cache pool. The FSMScheduler grows it while bags queue up and shrinks it back once it is idle
+MIN_NUM_CACHES = NUM_CACHES
+MAX_NUM_CACHES = 8
+CACHE_RATE_WINDOW = 10  # Seconds of recent bag arrivals the pool is sized on
+CACHE_POOL_KEY = '__num_caches__'  # Pool size the first sub-block builder settled on, followed by the others
+CACHE_POOL_CHANNEL = '__num_caches__'  # Pub/sub channel the first sub-block builder announces a new pool size on
+
 # Set timeouts for CR
 EXEC_TIMEOUT = 14  # Timeout for other subblocks finishing exec
 CR_TIMEOUT = 14  # Timeout for other subblocks finishing CR
 BLOCK_TIMEOUT = 30  # Timeout to wait for CRCache to be written to master
 CLEAN_TIMEOUT = 30  # Timeout to wait for DBs to synchronize their reset calls
 AVAIL_DB_TIMEOUT = 60
-POLL_INTERVAL = 0.1
+POLL_INTERVAL = 0.1  # How often the FSMScheduler retries transitions when nothing notifies it of the other processes
+NOTIFIED_POLL_INTERVAL = 1  # Fallback retry of the FSMScheduler while the driver's pub/sub notifies it
+
+# Pub/sub channel CRCaches announce macro changes on so schedulers in other processes wake up
+MACRO_CHANNEL = '__macros__'
+
+# Number of keys written per pipelined MULTI/EXEC when committing a cache to the database
+WRITE_BATCH_SIZE = 1000
 
-# Number of sb's to queue up if we run out of caches
+# Number of processes executing the transactions of a bag in parallel. 0 executes them serially in process
+EXECUTION_WORKERS = 0
+
+# Number of transactions of a bag the optimistic executor runs speculatively against the same state
+OPTIMISTIC_CONCURRENCY = 8
+
+# Number of sb's to queue up if we run out of caches. execute_sb returns False beyond that
 MAX_SB_QUEUE_SIZE = 8
 
 # Resource limits
-MEMORY_LIMIT = 32768  # 32kb
+# Bytes contract code may allocate in a transaction, counted as allocated and not net of frees. Requests small enough
+# for free lists are not counted, larger ones are rounded up to 512 bytes. 0 for no limit
+MEMORY_LIMIT = 33554432  # 32mb
+# Allocated bytes charged as one stamp. 0 to enforce MEMORY_LIMIT without charging for memory
+MEMORY_BYTES_PER_STAMP = 256
 RECURSION_LIMIT = 1024
 
 DELIMITER = ':'
 CODE_KEY = '__code__'
 TYPE_KEY = '__type__'
 AUTHOR_KEY = '__author__'
+HASH_KEY = '__hash__'  # Hash of the contract's code, which versions the compiled code cached by the module loader
+
+# Marshalled code objects are stored raw under ARTIFACT_PREFIX:<hash of the code>:<interpreter cache tag>
+ARTIFACT_PREFIX = '__artifacts__'
 INDEX_SEPARATOR = '.'
 
 DECIMAL_PRECISION = 64
@@ -45,5 +103,8 @@ ORM_CLASS_NAMES = {'Variable', 'Hash', 'ForeignVariable', 'ForeignHash'}
 MAX_HASH_DIMENSIONS = 16
 MAX_KEY_SIZE = 1024
 
+# Stamps charged by the contract driver for every read and write of a contract, plus the bytes of the key and value
+READ_COST_PER_KEY = 250
 READ_COST_PER_BYTE = 25
+WRITE_COST_PER_KEY = 2500
 WRITE_COST_PER_BYTE = 250
@@ -1,6 +1,8 @@
 from contracting.compilation.compiler import ContractingCompiler
 from ..db.driver import ContractDriver
 from ..execution.runtime import rt
+from ..execution.metering import blocks
+from ..compilation import counters
 from types import ModuleType
 from ..stdlib import env
 from .. import config
@@ -16,7 +18,7 @@ class Contract:
 
         c = ContractingCompiler(module_name=name)
 
-        code_obj = c.parse_to_code(code, lint=True)
+        code, code_obj = c.parse_to_artifacts(code, lint=True)
 
         ctx = ModuleType('context')
 
@@ -29,9 +31,18 @@ class Contract:
         scope.update({'__contract__': True})
         scope.update(rt.env)
 
-        exec(code_obj, scope)
+        # Metered like any loaded contract while its body and constructor run. The stored code has no counters
+        run_obj = code_obj
+        if rt.mode == 'counters':
+            run_obj = counters.compile_source(code)
 
-        if scope.get(config.INIT_FUNC_NAME) is not None:
-            scope[config.INIT_FUNC_NAME]()
+        blocks.register(run_obj)
+        try:
+            exec(run_obj, scope)
 
-        self._driver.set_contract(name=name, code=code_obj, author=author, overwrite=False)
+            if scope.get(config.INIT_FUNC_NAME) is not None:
+                scope[config.INIT_FUNC_NAME]()
+        finally:
+            blocks.unregister(run_obj)
+
+        self._driver.set_contract(name=name, code=code, author=author, overwrite=False, code_obj=code_obj)
@@ -11,9 +11,11 @@ from contracting.db.driver import ContractDriver, CacheDriver
 from contracting.db.cr.transaction_bag import TransactionBag
 from contracting import config
 from contracting.db.cr.callback_data import ExecutionData, SBData
+from contracting.db.encoder import Encoder
 from typing import List
 
 import json
+import time
 
 # TODO include _key exclusions for stamps, etc
 class Macros:
@@ -25,6 +27,9 @@ class Macros:
 
     ALL_MACROS = [EXECUTION, CONFLICT_RESOLUTION, RESET]
 
+    # Macros as the DB returns their keys
+    RAW_MACROS = {m.encode() for m in ALL_MACROS}
+
 @add_state_features(Timeout)
 class CustomStateMachine(Machine):
     def __init__(self, *args, **kwargs):
@@ -64,6 +69,10 @@ class CRCache:
 
         self.bag = None            # Bag will be set by the execute call
         self.rerun_idx = None      # The index to being reruns at
+        self.conflicts = set()     # Keys read during execution whose value changed before CR
+        self.rerun_count = 0       # Number of transactions executed again during CR
+        self.rerun_ratio = 0       # Share of the bag's transactions executed again during CR
+        self.merge_stats = {}      # Keys, chunks and seconds of the last merge to master
         self.results = {}          # The results of the execution
         self.macros = Macros()     # Instance of the macros class for mutex/sync
         self.input_hash = None     # The 'input hash' of the bag we are executing, a 64 char hex str
@@ -147,7 +156,11 @@ class CRCache:
                                           transitions=transitions, initial='CLEAN')
 
         self.scheduler.mark_clean(self)
-        self._reset_macro_keys()
+
+        # The macros live in the shared DB. Caches may be created while the other sub-block builders already use
+        # theirs on the same index, so only the first one resets them
+        if self.sbb_idx == 0:
+            self._reset_macro_keys()
 
     def _schedule_cr(self):
         # Add sync_execution to the scheduler to wait for the CR step
@@ -162,7 +175,7 @@ class CRCache:
 
     def _incr_macro_key(self, macro):
         self.log.debug("INCREMENTING MACRO {}".format(macro))
-        self.db.incrby(macro)
+        self.db.incrby(macro, channel=config.MACRO_CHANNEL)
 
     def _check_macro_key(self, macro):
         val = self.db.get_direct(macro)
@@ -171,8 +184,8 @@ class CRCache:
 
     def _reset_macro_keys(self):
         self.log.spam("{} is resetting macro keys".format(self))
-        for key in Macros.ALL_MACROS:
-            self.db.set_direct(key, 0)
+        self.db.write_batch({key: 0 for key in Macros.ALL_MACROS})
+        self.db.publish(config.MACRO_CHANNEL, Macros.RESET)
 
     def get_results(self):
         return self.results
@@ -189,12 +202,9 @@ class CRCache:
         # Do not commit, leveraging cache only
         self.results = self.executor.execute_bag(self.bag, environment=self.bag.environment, driver=self.master_db)
 
-        # Copy the cache from Master DB Driver to the contained Driver for common
-        self.db.reset_cache(modified_keys=self.master_db.modified_keys,
-                            contract_modifications=self.master_db.contract_modifications,
-                            original_values=self.master_db.original_values)
-        # Reset the master_db cache back to empty
-        self.master_db.reset_cache()
+        # Move the cache from Master DB Driver to the contained Driver for common. This also resets the master_db
+        # cache back to empty
+        self.db.take_cache(self.master_db)
 
         # Increment the execution macro
         self._incr_macro_key(Macros.EXECUTION)
@@ -210,34 +220,58 @@ class CRCache:
         # match the value in the DB, cascade from common to master, if the _key doesn't
         # exist in common, check master since another CRCache may have merged since you
         # executed.
-        cr_key_hits = []
+        cr_key_hits = set()
         for key, value in self.db.original_values.items():
-            if key not in cr_key_hits:
-                common_db_value = super(CacheDriver, self.db).get(key)
-                if common_db_value is not None:
-                    if common_db_value != value:
-                        cr_key_hits.append(key)
-                else:
-                    master_db_value = super(CacheDriver, self.master_db).get(key)
-                    if master_db_value != value:
-                        cr_key_hits.append(key)
-
-        # Check the modified keys list for the lowest contract index, set that as the
-        # rerun index so we can rerun all contracts following the first mismatch
+            common_db_value = super(CacheDriver, self.db).get(key)
+            if common_db_value is not None:
+                if common_db_value != value:
+                    cr_key_hits.add(key)
+            else:
+                master_db_value = super(CacheDriver, self.master_db).get(key)
+                if master_db_value != value:
+                    cr_key_hits.add(key)
+
+        self.conflicts = cr_key_hits
+
+        # The first contract that read a mismatched _key is where the reruns begin. Everything before it stays
         if len(cr_key_hits) > 0:
-            cr_key_modifications = {k: v for k, v in self.db.modified_keys.items() if k in cr_key_hits}
-            self.rerun_idx = 999999
-            for key, value in cr_key_modifications.items():
-                if value[0] < self.rerun_idx:
-                    self.rerun_idx = value[0]
+            self.rerun_idx = self.db.read_log.first_reader(cr_key_hits)
 
     def requires_reruns(self):
         return self.rerun_idx is not None
 
     def rerun_transactions(self):
+        # Only contracts that read a mismatched _key, or a _key written by a contract that was rerun, are executed
+        # again. The others would write exactly the same values, so their write sets are replayed instead.
+        writes = self.db.contract_modifications[self.rerun_idx:]
+        reads = [self.db.read_log.keys_read(idx) for idx in range(self.rerun_idx, len(self.db.read_log))]
+        scans = [self.db.read_log.prefixes_scanned(idx) for idx in range(self.rerun_idx, len(self.db.read_log))]
         self.db.revert(idx=self.rerun_idx)
-        self.bag.yield_from(idx=self.rerun_idx)
-        self.results.update(self.executor.execute_bag(self.bag, environment=self.bag.environment, driver=self.db))
+
+        dirty = set(self.conflicts)
+        for offset, idx in enumerate(range(self.rerun_idx, len(self.bag.transactions))):
+            old_writes = writes[offset] if offset < len(writes) else {}
+
+            # A dirty _key under a scanned prefix may be one a rerun created, which the scan did not return
+            if offset < len(reads) and reads[offset].isdisjoint(dirty) and \
+                    not any(key.startswith(prefix) for prefix in scans[offset] for key in dirty):
+                self.db.replay(old_writes, reads=reads[offset], scans=scans[offset])
+                continue
+
+            tx = self.bag.transactions[idx]
+            self.results[idx] = self.executor.execute(tx.payload.sender, tx.contract_name, tx.func_name, tx.kwargs,
+                                                      stamps=tx.payload.stampsSupplied, auto_commit=False,
+                                                      environment=self.bag.environment, driver=self.db)
+            self.rerun_count += 1
+
+            dirty.update(old_writes.keys())
+            if idx < len(self.db.contract_modifications):
+                dirty.update(self.db.contract_modifications[idx].keys())
+
+        self.rerun_ratio = self.rerun_count / len(self.bag.transactions)
+        self.log.info("{} reran {} of {} transactions ({:.1%})".format(self, self.rerun_count,
+                                                                       len(self.bag.transactions),
+                                                                       self.rerun_ratio))
 
     def resolve_conflicts(self):
         self.prepare_reruns()
@@ -256,17 +290,37 @@ class CRCache:
 
     def merge_to_master(self):
         if self.sbb_idx == 0:
-            merge_keys = [ x for x in self.db.keys() if x not in Macros.ALL_MACROS ]
-            for key in merge_keys:
-                self.master_db.set(key, self.db.get(key))
-            self.master_db.commit()
+            # Stream the common layer to master in chunks of raw values. Nothing is decoded or held beyond one chunk,
+            # and every chunk is a single pipelined write
+            start = time.time()
+            keys = 0
+            chunks = 0
+            for chunk in self.db.iter_chunks(batch_size=config.WRITE_BATCH_SIZE):
+                sets = {k: v for k, v in chunk if k not in Macros.RAW_MACROS and k not in Macros.ALL_MACROS}
+                self.master_db.write_batch(sets)
+
+                keys += len(sets)
+                chunks += 1
+                self.log.debugv("{} merged {} keys to master in {} chunks".format(self, keys, chunks))
+
+            self.merge_stats = {
+                'keys': keys,
+                'chunks': chunks,
+                'seconds': time.time() - start
+            }
+            self.log.info("{} merged {} keys to master in {:.3f}s".format(self, keys, self.merge_stats['seconds']))
 
     def reset_dbs(self):
         # If we are on SBB 0, we need to flush the common layer of this cache
         # since the DB is shared, we only need to call this from one of the SBBs
         self.db.reset_cache()
         self.master_db.reset_cache()
+        self.db.clear_decoded()
+        self.master_db.clear_decoded()
         self.rerun_idx = None
+        self.conflicts = set()
+        self.rerun_count = 0
+        self.rerun_ratio = 0
         self.bag = None
 
         # If we are on SBB 0, we need to flush the common layer of this cache
@@ -304,7 +358,7 @@ class CRCache:
             if status_code == 0:
                 mods = self.db.contract_modifications[i]
                 i += 1
-                state_str = json.dumps(mods)
+                state_str = json.dumps(mods, cls=Encoder)  # Binary codecs store bytes, which go out as hex
 
             tx_datas.append(ExecutionData(contract=self.bag.transactions[tx_idx], status=status_code,
                                           response=result, state=state_str, stamps=stamps))
@@ -1,4 +1,5 @@
 import asyncio
+import math
 import time
 from contracting.logger import get_logger
 from contracting.execution.executor import Executor
@@ -10,23 +11,51 @@ from contracting.db.driver import ContractDriver
 from collections import deque, defaultdict
 from typing import Callable, List, Any
 import traceback
+import weakref
+
+
+# Every scheduler of this process, so a transition made by one can wake up the others that may be waiting on it
+SCHEDULERS = weakref.WeakSet()
+
+
+def notify_all():
+    for scheduler in list(SCHEDULERS):
+        scheduler.notify()
 
 
 class FSMScheduler:
 
-    def __init__(self, loop, sbb_idx, num_sbb):
+    def __init__(self, loop, sbb_idx, num_sbb, driver=None, cache_factory=None):
         self.log = get_logger("FSM Scheduler")
         self.events = defaultdict(set)
         self.temp_events = defaultdict(set)
         self.loop = loop
 
+        # Set whenever a transition may have become possible. Polls are only retried on poll_interval without it
+        self.wakeup = asyncio.Event()
+        SCHEDULERS.add(self)
+
+        # Macro changes made by the sub-block builders of other processes arrive through the driver's pub/sub
+        self.driver = driver
+        self.subscription = None
+        if driver is not None:
+            self.subscription = driver.subscribe(config.MACRO_CHANNEL, lambda message: self.notify())
+
+        # Size of the cache pool every sub-block builder keeps. Only the first one sets it, the others are told of
+        # every change, so neither has to read it back from the DB
+        self.pool_size = None
+        self.pool_subscription = None
+        if driver is not None and sbb_idx != 0:
+            self.pool_subscription = driver.subscribe(config.CACHE_POOL_CHANNEL, self._pool_size_changed)
+
         self.num_sbb = num_sbb
         self.sbb_idx = sbb_idx
 
         self.log.debug("Starting scheduler")
 
         # Cilantro is in charge of starting the event loop. This coro will start as soon as cilantro
-        # (SubBlockBuilder) kicks off his event loop
+        # (SubBlockBuilder) kicks off his event loop. It runs until stop()
+        self.running = True
         self.fut = asyncio.ensure_future(self._poll_events())
 
         # DEBUG -- TODO DELETE
@@ -36,7 +65,21 @@ class FSMScheduler:
         self.available_caches = deque() # LIFO
         self.pending_caches = deque() # FIFO
 
+        # Every cache of the pool in order of DB index. With a cache_factory the pool is resized at runtime
+        self.caches = []
+        self.cache_factory = cache_factory
+
+        # Bags waiting for a cache, executed in order as soon as one is clean
+        self.bag_queue = deque()
+
+        # Load the pool is sized on: arrival times of recent bags, and how long a cache takes from execution to clean
+        self.arrivals = deque()
+        self.started = {}
+        self.latency = 0
+        self.rejected = 0
+
         self.merge_idx = 0
+        self.merges_requested = 0  # update_master_db calls for bags that are still queued
 
         self._log_caches()
 
@@ -67,29 +110,156 @@ class FSMScheduler:
         self.log.spam("----------------------------------")
 
     def execute_bag(self, bag: TransactionBag, environment={}):
-        if len(self.available_caches) == 0:
-            self.log.warning("No available caches in FSM scheduler. Returning False from execute_bag")
-            return False
+        # Set the environment of the bag, which is going to be standard (time, blocknum, blockhash).
+        bag.environment = environment
+        self.arrivals.append(time.time())
+
+        # Bags queued before this one go first so sub-blocks are still executed in order
+        if len(self.available_caches) == 0 or self.bag_queue:
+            if len(self.bag_queue) >= config.MAX_SB_QUEUE_SIZE:
+                self.rejected += 1
+                self.log.warning("No available caches and {} bags already queued in FSM scheduler. Returning False "
+                                 "from execute_bag".format(len(self.bag_queue)))
+                return False
+
+            self.log.info("No available caches in FSM scheduler. Queueing input hash {}".format(bag.input_hash))
+            self.bag_queue.append(bag)
+            self._resize_pool()
+            self._drain_queue()
+        else:
+            self._execute_on_cache(bag)
 
+        self._log_caches()
+        self.notify()
+        return True
+
+    def _execute_on_cache(self, bag: TransactionBag):
         current_cache = self.available_caches.popleft()
         assert current_cache.state == 'CLEAN', "Pulled cache from available db with state {}, but expected CLEAN state"\
                                                .format(current_cache.state)
 
-        # Set the environment of the bag, which is going to be standard (time, blocknum, blockhash).
-        bag.environment = environment
-
         current_cache.set_bag(bag)
         current_cache.execute()
         self.log.info("FSM executing input hash {} using cache {}".format(bag.input_hash, current_cache))  # TODO remove
         self.pending_caches.append(current_cache)
+        self.started[current_cache] = time.time()
+
+        self._schedule_merges()
+
+    def _drain_queue(self):
+        while self.bag_queue and self.available_caches:
+            self._execute_on_cache(self.bag_queue.popleft())
+
+    def target_pool_size(self):
+        now = time.time()
+        while self.arrivals and self.arrivals[0] < now - config.CACHE_RATE_WINDOW:
+            self.arrivals.popleft()
+        rate = len(self.arrivals) / config.CACHE_RATE_WINDOW
+
+        # Little's law: the caches busy at once are the arrival rate times how long each one stays busy. On top of
+        # the ones busy right now, keep one for every bag already waiting and a spare for the next burst
+        busy = max(math.ceil(rate * self.latency), len(self.pending_caches))
+        needed = busy + len(self.bag_queue) + 1
+        return max(config.MIN_NUM_CACHES, min(config.MAX_NUM_CACHES, needed))
+
+    def _pool_size(self):
+        # Caches of different sub-block builders on the same DB index work on the same bags, so every builder has to
+        # keep the same pool. The first one sizes it and is the only one to write it, the others follow
+        if self.driver is None:
+            return self.target_pool_size()
+
+        if self.sbb_idx == 0:
+            target = self.target_pool_size()
+            if target != self.pool_size:
+                self.pool_size = target
+                self.driver.set_meta(config.CACHE_POOL_KEY, target)
+                self.driver.publish(config.CACHE_POOL_CHANNEL, target)
+            return target
+
+        # Read once, for a builder that started after the first one settled on a size. Changes arrive by pub/sub
+        if self.pool_size is None:
+            self.pool_size = self._check_pool_key()
+
+        return self.pool_size if self.pool_size is not None else len(self.caches)
+
+    def _check_pool_key(self):
+        val = self.driver.get_meta(config.CACHE_POOL_KEY)
+        return int(val) if val is not None else None
+
+    def _pool_size_changed(self, message):
+        # Called from the pub/sub listener thread
+        self.pool_size = int(message)
+        self.notify()
+
+    def _resize_pool(self):
+        if self.cache_factory is None:
+            return
 
-        self._log_caches()
-        return True
+        target = self._pool_size()
+
+        while len(self.caches) < target:
+            self.log.info("Growing cache pool to {} caches for {} queued bags"
+                          .format(len(self.caches) + 1, len(self.bag_queue)))
+            self.cache_factory(config.DB_OFFSET + len(self.caches))
+
+        # Only shrink while nothing is in flight, one cache at a time, and only ever the last one so DB indices stay
+        # contiguous
+        if len(self.caches) > target and not self.pending_caches and not self.bag_queue:
+            cache = self.caches[-1]
+            if cache in self.available_caches and cache.state == 'CLEAN':
+                self.log.info("Shrinking cache pool to {} caches".format(len(self.caches) - 1))
+                self.caches.pop()
+                self.available_caches.remove(cache)
+                self.events.pop(cache, None)
+
+    def stats(self):
+        return {
+            'caches': len(self.caches),
+            'available': len(self.available_caches),
+            'pending': len(self.pending_caches),
+            'queued': len(self.bag_queue),
+            'rejected': self.rejected,
+            'latency': self.latency
+        }
 
     def add_poll(self, cache: CRCache, func: callable, succ_state: str, is_merge=False):
         self.temp_events[cache].add((func, succ_state, is_merge))
+        self.notify()
+
+    def notify(self):
+        # Safe to call from any thread, e.g. the pub/sub listener
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    @property
+    def poll_interval(self):
+        # Transitions of the sub-block builders in other processes are only seen by polling without a subscription
+        if self.subscription is None:
+            return config.POLL_INTERVAL
+        return config.NOTIFIED_POLL_INTERVAL
+
+    def stop(self):
+        # Ends the poll loop on its next pass. Cancelling it instead can be lost when a wakeup arrives at the same time
+        self.running = False
+        self.notify()
+
+        if self.subscription is not None:
+            self.subscription.stop()
+            self.subscription = None
+
+        if self.pool_subscription is not None:
+            self.pool_subscription.stop()
+            self.pool_subscription = None
 
     def mark_clean(self, cache: CRCache):
+        if cache not in self.caches:
+            self.caches.append(cache)
+
+        started = self.started.pop(cache, None)
+        if started is not None:
+            elapsed = time.time() - started
+            self.latency = elapsed if not self.latency else 0.8 * self.latency + 0.2 * elapsed
+
         if cache in self.pending_caches:
             self.log.debug("[mark_clean] Removing cache {} from pending_caches")
             self.pending_caches.remove(cache)
@@ -98,6 +268,7 @@ class FSMScheduler:
         self.available_caches.append(cache)
 
         self._log_caches()
+        self.notify()
 
     def check_top_of_stack(self, cache: CRCache):
         if not self.pending_caches:
@@ -114,7 +285,13 @@ class FSMScheduler:
 
     async def _poll_events(self):
         try:
-            while True:
+            while self.running:
+                self.wakeup.clear()
+
+                # Caches marked clean since the last pass take the bags waiting for one
+                self._resize_pool()
+                self._drain_queue()
+
                 rm_set = defaultdict(list)  # set of function pointer to remove if the poll call was successful
 
                 for cache, poll_set in self.events.items():
@@ -144,10 +321,17 @@ class FSMScheduler:
                     for tup in li:
                         self.events[cache].remove(tup)
 
+                # Anything that transitioned may unblock other caches, here or in another scheduler of this process
+                if rm_set:
+                    notify_all()
+
                 self.events.update(self.temp_events)
                 self.temp_events.clear()
 
-                await asyncio.sleep(config.POLL_INTERVAL)
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
 
         except Exception as e:
             self.log.fatal("damn son, big yikes in the _poll_events: {}...\nerror:".format(e))
@@ -155,22 +339,32 @@ class FSMScheduler:
             raise e
 
     def update_master_db(self):
-        assert len(self.pending_caches) > 0, "attempted to update master db but no pending caches"
-        assert self.merge_idx < len(self.pending_caches), "Merge idx {} out of range of pending caches of len {}"\
-                                                          .format(self.merge_idx, len(self.pending_caches))
+        assert self.merge_idx + self.merges_requested < len(self.pending_caches) + len(self.bag_queue), \
+            "Merge idx {} out of range of pending caches of len {} and queued bags of len {}"\
+            .format(self.merge_idx + self.merges_requested, len(self.pending_caches), len(self.bag_queue))
 
-        cache = self.pending_caches[self.merge_idx]
-        self.log.info("update_master_db called for cache {}".format(cache))
-        self.merge_idx += 1
-        self.add_poll(cache, cache.merge, 'RESET', True)
+        self.merges_requested += 1
+        self._schedule_merges()
 
         self._log_caches()
 
+    def _schedule_merges(self):
+        # A merge requested for a bag that is still queued is scheduled once the bag is on a cache
+        while self.merges_requested and self.merge_idx < len(self.pending_caches):
+            cache = self.pending_caches[self.merge_idx]
+            self.log.info("update_master_db called for cache {}".format(cache))
+            self.merge_idx += 1
+            self.merges_requested -= 1
+            self.add_poll(cache, cache.merge, 'RESET', True)
+
     def flush_all(self):
         self.log.info("Flushing all caches...")
         for cache in self.pending_caches:
             cache.discard()
 
+        self.bag_queue.clear()
+        self.merges_requested = 0
+
         self._log_caches()
 
 
@@ -188,16 +382,23 @@ class SubBlockClient:
         self.executor = Executor()
         self.master_db = ContractDriver()
 
-        caches = []
-        self.scheduler = FSMScheduler(self.loop, sbb_idx, num_sbb)
+        self.scheduler = FSMScheduler(self.loop, sbb_idx, num_sbb, driver=self.master_db,
+                                      cache_factory=self._create_cache)
         for i in range(config.NUM_CACHES):
-            caches.append(CRCache(config.DB_OFFSET + i, self.master_db,
-                                  self.sbb_idx, self.num_sbb,
-                                  self.executor, self.scheduler))
+            self._create_cache(config.DB_OFFSET + i)
+
+    def _create_cache(self, idx):
+        return CRCache(idx, self.master_db, self.sbb_idx, self.num_sbb, self.executor, self.scheduler)
 
     def flush_all(self):
         self.scheduler.flush_all()
 
+    def stop(self):
+        # The scheduler's poll loop and pub/sub listeners and the worker pool would otherwise outlive the client
+        self.scheduler.stop()
+        if self.executor.pool is not None:
+            self.executor.pool.terminate()
+
     def execute_sb(self, input_hash: str, contracts: list, completion_handler: Callable[[SBData], None], environment={}):
         self.log.info("Execute SB call for input hash {}".format(input_hash))
 
@@ -1,6 +1,15 @@
 import abc
-import copy
 import dbm
+import os
+import sys
+import threading
+import weakref
+
+# lmdb is optional. Only single node deployments using the 'lmdb' DB_TYPE need it installed
+try:
+    import lmdb
+except ImportError:
+    lmdb = None
 
 # we can't include pylevel in production since its not installed on the docker images and will
 # result in an interpret time error
@@ -8,14 +17,17 @@ from redis import Redis
 from redis.connection import Connection
 from .. import config
 from ..exceptions import DatabaseDriverNotFound
-from ..db.encoder import encode, decode
+from ..db.encoder import encode, get_codec
 
 from ..logger import get_logger
 from ..execution.runtime import rt
 
 from .. import config
 
-from collections import deque, defaultdict
+from collections import deque, defaultdict, OrderedDict
+from array import array
+import decimal
+import hashlib
 import marshal
 
 class AbstractDatabaseDriver:
@@ -66,6 +78,47 @@ class AbstractDatabaseDriver:
             return True
         return False
 
+    def get_many(self, keys):
+        """Get a list of values for the given keys, in order. Drivers that support it do this in bulk"""
+        return [self.get(key) for key in keys]
+
+    def write_batch(self, sets, deletes=(), batch_size=config.WRITE_BATCH_SIZE):
+        """Apply a dict of sets and an iterable of deletes. Drivers that support it do this in bulk"""
+        for key, value in sets.items():
+            self.set(key, value)
+        for key in deletes:
+            self.delete(key)
+
+    def iter_chunks(self, batch_size=config.WRITE_BATCH_SIZE):
+        """Yield every stored (_key, value) pair in lists of at most batch_size. Drivers that support it stream them"""
+        keys = list(self.keys())
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            yield list(zip(batch, self.get_many(batch)))
+
+    def get_meta(self, key):
+        """Get a value of the node's bookkeeping, see set_meta"""
+        return self.get(key)
+
+    def set_meta(self, key, value):
+        """
+        Set a value of the node's bookkeeping. Drivers that can keep it apart from the state do, so it is not returned
+        by iter, keys and iter_chunks. The others store it as any other _key
+        """
+        self.set(key, value)
+
+    def publish(self, channel, message):
+        """Notify the subscribers of a channel. Drivers without a message bus have no one to notify"""
+        return
+
+    def subscribe(self, channel, callback):
+        """
+        Call callback with the message of every publish on the channel, from a background thread.
+
+        :return: handle with a stop() method, or None if the driver has no message bus
+        """
+        return None
+
 '''
 import plyvel
 class LevelDBDriver(AbstractDatabaseDriver):
@@ -164,7 +217,7 @@ class DictDriver(AbstractDatabaseDriver):
         del self.conn
         self.conn = {}
 
-    def incrby(self, key, amount=1):
+    def incrby(self, key, amount=1, channel=None):
         """Increment a numeric _key by one"""
         k = self.get(key)
 
@@ -173,6 +226,9 @@ class DictDriver(AbstractDatabaseDriver):
         k = int(k) + amount
         self.set(key, k)
 
+        if channel is not None:
+            self.publish(channel, key)
+
         return k
 
 import atexit
@@ -230,7 +286,7 @@ class DBMDriver(AbstractDatabaseDriver):
         for k in self.keys():
             self.delete(k)
 
-    def incrby(self, key, amount=1):
+    def incrby(self, key, amount=1, channel=None):
         k = self.get(key)
 
         if k is None:
@@ -238,6 +294,187 @@ class DBMDriver(AbstractDatabaseDriver):
         k = int(k) + amount
         self.set(key, k)
 
+        if channel is not None:
+            self.publish(channel, key)
+
+        return k
+
+
+class LMDBSnapshot:
+    """A consistent, read only view of an LMDB database for as long as it is open"""
+    def __init__(self, txn):
+        self.txn = txn
+
+    def get(self, key):
+        return self.txn.get(LMDBDriver._to_bytes(key))
+
+    def iter(self, prefix):
+        return LMDBDriver._prefix_scan(self.txn, LMDBDriver._to_bytes(prefix))
+
+    def close(self):
+        self.txn.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# LMDB only allows one open environment per path per process, so they are shared between driver instances.
+# (pid, path) -> environment. An environment must not be used across fork(), so a forked process opens its own
+LMDB_ENVIRONMENTS = {}
+
+# Every LMDB driver of this process, so the ones a forked process inherits can reopen their environment in it
+LMDB_DRIVERS = weakref.WeakSet()
+
+
+def _reopen_lmdb_environments():
+    # lmdb refuses to open a path twice in a process, and the child inherits the parent's environments as open.
+    # Closing one in the child only releases what the child holds: reader slots are freed by pid, and the parent's
+    # file locks are not inherited
+    for env in LMDB_ENVIRONMENTS.values():
+        env.close()
+    LMDB_ENVIRONMENTS.clear()
+
+    for driver in list(LMDB_DRIVERS):
+        driver._setup_conn()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reopen_lmdb_environments)
+
+
+class LMDBDriver(AbstractDatabaseDriver):
+    """
+    Embedded, ordered key value store. Prefix iteration is a cursor range scan, so it is proportional to the
+    number of matching keys rather than to the size of the database. Each DB index is a named sub database in
+    the same environment.
+    """
+    def __init__(self, dir=config.LMDB_DIR, db=config.MASTER_DB, map_size=config.LMDB_MAP_SIZE, **kwargs):
+        if lmdb is None:
+            raise DatabaseDriverNotFound(driver='lmdb (the lmdb package is not installed)',
+                                         known_drivers=DATABASE_DRIVER_MAPS.keys())
+        self.dir = dir
+        self.db = db
+        self.map_size = map_size
+        self.env = None
+        self.handle = None
+        self.meta = None
+        self._setup_conn()
+
+    def _setup_conn(self):
+        path = os.path.abspath(self.dir)
+        self.env = LMDB_ENVIRONMENTS.get((os.getpid(), path))
+        if self.env is None:
+            os.makedirs(path, exist_ok=True)
+            self.env = lmdb.open(path, map_size=self.map_size, max_dbs=config.LMDB_MAX_DBS)
+            LMDB_ENVIRONMENTS[(os.getpid(), path)] = self.env
+        LMDB_DRIVERS.add(self)
+        self.handle = self.env.open_db('db{}'.format(self.db).encode())
+        self.meta = self.env.open_db(config.META_KEY.encode())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['env']
+        del state['handle']
+        del state['meta']
+        return state
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+        self._setup_conn()
+
+    @staticmethod
+    def _to_bytes(s):
+        if isinstance(s, bytes):
+            return s
+        return str(s).encode()
+
+    @staticmethod
+    def _prefix_scan(txn, prefix, values=False):
+        cursor = txn.cursor()
+        results = []
+        if not cursor.set_range(prefix):
+            return results
+        for k, v in cursor:
+            if not k.startswith(prefix):
+                break
+            results.append((k, v) if values else k)
+        return results
+
+    def get(self, key):
+        with self.env.begin(db=self.handle) as txn:
+            return txn.get(self._to_bytes(key))
+
+    def get_many(self, keys):
+        with self.env.begin(db=self.handle) as txn:
+            return [txn.get(self._to_bytes(key)) for key in keys]
+
+    def set(self, key, value):
+        with self.env.begin(db=self.handle, write=True) as txn:
+            txn.put(self._to_bytes(key), self._to_bytes(value))
+
+    def delete(self, key):
+        with self.env.begin(db=self.handle, write=True) as txn:
+            txn.delete(self._to_bytes(key))
+
+    def write_batch(self, sets, deletes=(), batch_size=config.WRITE_BATCH_SIZE):
+        """All sets and deletes are applied in one write transaction, so they land atomically"""
+        with self.env.begin(db=self.handle, write=True) as txn:
+            for key, value in sets.items():
+                txn.put(self._to_bytes(key), self._to_bytes(value))
+            for key in deletes:
+                txn.delete(self._to_bytes(key))
+
+    def iter(self, prefix):
+        with self.env.begin(db=self.handle) as txn:
+            return self._prefix_scan(txn, self._to_bytes(prefix))
+
+    def get_meta(self, key):
+        with self.env.begin(db=self.meta) as txn:
+            return txn.get(self._to_bytes(key))
+
+    def set_meta(self, key, value):
+        with self.env.begin(db=self.meta, write=True) as txn:
+            txn.put(self._to_bytes(key), self._to_bytes(value))
+
+    def keys(self):
+        return self.iter(prefix=b'')
+
+    def snapshot(self):
+        return LMDBSnapshot(self.env.begin(db=self.handle))
+
+    def iter_chunks(self, batch_size=config.WRITE_BATCH_SIZE):
+        # A single read transaction gives every chunk the same consistent view
+        with self.env.begin(db=self.handle) as txn:
+            chunk = []
+            for kv in txn.cursor():
+                chunk.append(kv)
+                if len(chunk) == batch_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+    def flush(self, db=None):
+        with self.env.begin(db=self.handle, write=True) as txn:
+            txn.drop(self.handle, delete=False)
+
+    def incrby(self, key, amount=1, channel=None):
+        """Increment a numeric _key. Runs in a single write transaction so it cannot lose updates"""
+        with self.env.begin(db=self.handle, write=True) as txn:
+            k = txn.get(self._to_bytes(key))
+
+            if k is None:
+                k = 0
+            k = int(k) + amount
+            txn.put(self._to_bytes(key), self._to_bytes(k))
+
+        if channel is not None:
+            self.publish(channel, key)
+
         return k
 
 
@@ -300,6 +537,31 @@ class RedisConnectionDriver(AbstractDatabaseDriver):
         return k
 
 
+# (host, port, db) of every Redis DB this process has made sure has a KEY_INDEX
+INDEXED_DBS = set()
+
+
+class Subscription(threading.Thread):
+    """
+    Listens to a Redis pub/sub connection until stop(). redis-py's own worker stops by unsubscribing from the caller's
+    thread, which can miss the reply the worker reads and keep it listening, so this one only ever touches the
+    connection from its own thread.
+    """
+    def __init__(self, pubsub, sleep_time):
+        super().__init__(daemon=True)
+        self.pubsub = pubsub
+        self.sleep_time = sleep_time
+        self.running = True
+
+    def run(self):
+        while self.running:
+            self.pubsub.get_message(ignore_subscribe_messages=True, timeout=self.sleep_time)
+        self.pubsub.close()
+
+    def stop(self):
+        self.running = False
+
+
 class RedisDriver(AbstractDatabaseDriver):
     def __init__(self, host=config.DB_URL, port=config.DB_PORT, db=config.MASTER_DB):
         self.host = host
@@ -308,6 +570,18 @@ class RedisDriver(AbstractDatabaseDriver):
         self.conn = None
         self.connection_pool = None
         self._setup_conn()
+        self._ensure_index()
+
+    def _ensure_index(self):
+        # State written before the index existed has keys but no index, and would be invisible to iter and keys. It is
+        # indexed on the first connection of the process to the DB. An empty DB has nothing to index
+        location = (self.host, self.port, self.db)
+        if location in INDEXED_DBS:
+            return
+
+        if self.conn.dbsize() and not self.conn.exists(config.KEY_INDEX):
+            self.rebuild_index()
+        INDEXED_DBS.add(location)
 
     def _setup_conn(self):
         self.conn = Redis(host=self.host, port=self.port, db=self.db)
@@ -325,46 +599,114 @@ class RedisDriver(AbstractDatabaseDriver):
         self._setup_conn()
 
     def get(self, key):
-        val = self.conn.get(key)
-
-        if val is not None and rt.tracer.is_started():
-            cost = len(key) + len(val)
-            cost *= config.READ_COST_PER_BYTE
-            rt.tracer.add_cost(cost)
-
-        return val
+        return self.conn.get(key)
 
     def set(self, key, value):
-
-        if rt.tracer.is_started():
-            cost = len(key) + len(value)
-            cost *= config.READ_COST_PER_BYTE
-            rt.tracer.add_cost(cost)
-
-        self.conn.set(key, value)
+        pipe = self.conn.pipeline(transaction=True)
+        pipe.set(key, value)
+        pipe.zadd(config.KEY_INDEX, {key: 0})
+        pipe.execute()
 
     def delete(self, key):
-        self.conn.delete(key)
+        pipe = self.conn.pipeline(transaction=True)
+        pipe.delete(key)
+        pipe.zrem(config.KEY_INDEX, key)
+        pipe.execute()
+
+    def get_many(self, keys):
+        """Fetch all keys in a single MGET round trip"""
+        if len(keys) == 0:
+            return []
+        return self.conn.mget(keys)
 
     def iter(self, prefix):
-        return list(self.conn.scan_iter(match=prefix+'*'))
+        """
+        Every key written through the driver is also a member of the KEY_INDEX sorted set. All members share the
+        same score, so they are ordered lexicographically and a prefix lookup is a ZRANGEBYLEX, which costs
+        O(log(N) + M) for M matching keys instead of a scan of the whole keyspace.
+        """
+        if isinstance(prefix, str):
+            prefix = prefix.encode()
+        return self.conn.zrangebylex(config.KEY_INDEX, b'[' + prefix, b'(' + prefix + b'\xff')
 
     def keys(self):
-        return self.conn.keys(pattern='*')
+        return self.conn.zrange(config.KEY_INDEX, 0, -1)
+
+    def iter_chunks(self, batch_size=config.WRITE_BATCH_SIZE):
+        # Pages through the _key index by rank, so only one chunk of keys and values is in memory at a time
+        start = 0
+        while True:
+            keys = self.conn.zrange(config.KEY_INDEX, start, start + batch_size - 1)
+            if not keys:
+                return
+
+            yield [(k, v) for k, v in zip(keys, self.conn.mget(keys)) if v is not None]
+            start += batch_size
+
+    def get_meta(self, key):
+        return self.conn.hget(config.META_KEY, key)
+
+    def set_meta(self, key, value):
+        # Not added to KEY_INDEX, like the index itself
+        self.conn.hset(config.META_KEY, key, value)
+
+    def publish(self, channel, message):
+        self.conn.publish(channel, message)
+
+    def subscribe(self, channel, callback):
+        pubsub = self.conn.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{channel: lambda message: callback(message['data'])})
+
+        subscription = Subscription(pubsub, sleep_time=config.NOTIFIED_POLL_INTERVAL)
+        subscription.start()
+        return subscription
+
+    def rebuild_index(self):
+        """
+        Index keys that were written without the driver (i.e. state from before the index existed). Done on the first
+        connection to a DB without an index, call it to re-index one whose keys were written around the driver since.
+        """
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.delete(config.KEY_INDEX)
+        for key in self.conn.scan_iter(match='*'):
+            if key not in (config.KEY_INDEX.encode(), config.META_KEY.encode()):
+                pipe.zadd(config.KEY_INDEX, {key: 0})
+        pipe.execute()
 
     def flush(self, db=None):
         self.conn.flushdb()
 
-    def incrby(self, key, amount=1):
-        """Increment a numeric _key by one"""
-        k = self.conn.get(key)
-
-        if k is None:
-            k = 0
-        k = int(k) + amount
-        self.conn.set(key, k)
-
-        return k
+    def write_batch(self, sets, deletes=(), batch_size=config.WRITE_BATCH_SIZE):
+        """Write all sets and deletes in MULTI/EXEC pipelines of at most batch_size keys each"""
+        deletes = list(deletes)
+
+        items = list(sets.items())
+        pipe = self.conn.pipeline(transaction=True)
+
+        for i in range(0, len(items), batch_size):
+            batch = dict(items[i:i + batch_size])
+            pipe.mset(batch)
+            pipe.zadd(config.KEY_INDEX, {key: 0 for key in batch})
+            pipe.execute()
+
+        for i in range(0, len(deletes), batch_size):
+            batch = deletes[i:i + batch_size]
+            pipe.delete(*batch)
+            pipe.zrem(config.KEY_INDEX, *batch)
+            pipe.execute()
+
+    def incrby(self, key, amount=1, channel=None):
+        """
+        Increment a numeric _key on the server, so concurrent increments cannot lose updates. Indexing the _key and
+        announcing the new value on a pub/sub channel go in the same round trip.
+        """
+        pipe = self.conn.pipeline(transaction=True)
+        pipe.incrby(key, amount)
+        pipe.zadd(config.KEY_INDEX, {key: 0})
+        if channel is not None:
+            pipe.publish(channel, key)
+
+        return pipe.execute()[0]
 
 # Defined at the bottom since needs to be instantiated
 # after the classes have been defined. Allows us to
@@ -372,7 +714,8 @@ class RedisDriver(AbstractDatabaseDriver):
 # from the top level instead of having to manually change
 # a bunch of code to get to it.
 DATABASE_DRIVER_MAPS = {
-    'redis': RedisConnectionDriver
+    'redis': RedisDriver,
+    'lmdb': LMDBDriver
 }
 
 
@@ -386,8 +729,81 @@ def get_database_driver():
 
 
 DatabaseDriver = get_database_driver()
-#DatabaseDriver = LevelDBDriver
-DatabaseDriver = RedisDriver
+
+
+# Version of a read that was served by the DB rather than by a write of an earlier transaction
+STORAGE = -1
+
+
+class ReadLog:
+    """
+    The keys every transaction of a bag read and the version each read saw, which is either the index of the
+    transaction whose write was returned or STORAGE. Keys are interned so a transaction's reads are a flat array of
+    (_key id, version) pairs, cheap enough to keep on for every bag. The prefixes each transaction scanned are kept
+    next to them, since a _key created under one changes what the scan returns.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.keys = []
+        self.txs = []
+        self.scans = []
+        self.seen = set()
+
+    def __len__(self):
+        return len(self.txs)
+
+    def new_tx(self):
+        self.txs.append(array('q'))
+        self.scans.append(set())
+        self.seen = set()
+
+    def record(self, key, version):
+        # Only the first read of a _key in a transaction matters, later ones can only see the same version
+        kid = self.ids.get(key)
+        if kid is None:
+            kid = len(self.keys)
+            self.ids[key] = kid
+            self.keys.append(key)
+        elif kid in self.seen:
+            return
+
+        self.seen.add(kid)
+        self.txs[-1].extend((kid, version))
+
+    def record_scan(self, prefix):
+        self.scans[-1].add(prefix)
+
+    def truncate(self, idx):
+        del self.txs[idx:]
+        del self.scans[idx:]
+
+    def reads(self, idx):
+        """List of (_key, version) read by transaction idx"""
+        entries = self.txs[idx]
+        return [(self.keys[entries[i]], entries[i + 1]) for i in range(0, len(entries), 2)]
+
+    def keys_read(self, idx):
+        entries = self.txs[idx]
+        return {self.keys[entries[i]] for i in range(0, len(entries), 2)}
+
+    def prefixes_scanned(self, idx):
+        return set(self.scans[idx])
+
+    def first_reader(self, keys):
+        """Index of the first transaction that read any of the keys, or None"""
+        ids = {self.ids[k] for k in keys if k in self.ids}
+        if ids:
+            for idx, entries in enumerate(self.txs):
+                if not ids.isdisjoint(entries[::2]):
+                    return idx
+        return None
+
+    def readers(self, key):
+        """Indexes of the transactions that read the _key"""
+        kid = self.ids.get(key)
+        if kid is None:
+            return []
+        return [idx for idx, entries in enumerate(self.txs) if kid in entries[::2]]
 
 
 class CacheDriver(DatabaseDriver):
@@ -397,48 +813,127 @@ class CacheDriver(DatabaseDriver):
         self.modified_keys = None
         self.contract_modifications = None
         self.original_values = None
+        self.read_log = None
+        self.prefetched = None
+        self.journal = None
+
+        # Stored value that marks a key as deleted on commit
+        self.null = encode(None)
+
         self.reset_cache()
 
-    def reset_cache(self, modified_keys=None, contract_modifications=None, original_values=None):
+    def reset_cache(self, modified_keys=None, contract_modifications=None, original_values=None, read_log=None):
+        # The structures passed in are adopted as they are, not copied, so handing a write set over is O(1).
+        # Callers give up ownership and must not keep modifying them (see take_cache).
+
         # Modified keys is a dictionary of deques representing the contracts that have modified
         # that _key
         if modified_keys:
-            self.modified_keys = copy.deepcopy(modified_keys)
+            self.modified_keys = modified_keys
         else:
             self.modified_keys = defaultdict(deque)
         # Contract modififications is a list of dicts containing the keys updated by a contract
         # and their final value
         if contract_modifications:
-            self.contract_modifications = copy.deepcopy(contract_modifications)
+            self.contract_modifications = contract_modifications
         else:
             self.contract_modifications = []
         # Original values is a dictionary of keys representing the original value fetched from
         # the DB
         if original_values:
-            self.original_values = copy.deepcopy(original_values)
+            self.original_values = original_values
         else:
             self.original_values = {}
+        # Read log holds, parallel to contract modifications, the keys each contract read that it had not written
+        # itself and the version it saw
+        if read_log:
+            self.read_log = read_log
+        else:
+            self.read_log = ReadLog()
+            for _ in self.contract_modifications:
+                self.read_log.new_tx()
+
+        # Journal of (_key, existed, previous value) for every set in the current transaction
+        self.journal = []
 
         # If we do not have any contract modifications, add a new one
         if len(self.contract_modifications) == 0:
             self.new_tx()
 
+        # Keys warmed by prefetch that are served from original_values instead of the DB
+        self.prefetched = set()
+
+    def take_cache(self, other):
+        """Move the write set and read values of another cache driver into this one and leave the other empty"""
+        self.reset_cache(modified_keys=other.modified_keys,
+                         contract_modifications=other.contract_modifications,
+                         original_values=other.original_values,
+                         read_log=other.read_log)
+        other.reset_cache()
+
     def get(self, key):
+        self.mark_read(key)
+        return self.peek(key)
+
+    def mark_read(self, key):
+        """Attribute a read of the _key, as it stands now, to the current transaction"""
+        key_location = self.modified_keys.get(key)
+        if not key_location:
+            self.read_log.record(key, STORAGE)
+        elif key_location[-1] != len(self.contract_modifications) - 1:
+            self.read_log.record(key, key_location[-1])
+
+    def peek(self, key):
+        """Read a _key through the cache without attributing the read to the current transaction"""
         key_location = self.modified_keys.get(key)
-        if key_location is None:
+        if key_location:
+            value = self.contract_modifications[key_location[-1]][key]
+        elif key in self.prefetched:
+            # Warmed by prefetch
+            value = self.original_values[key]
+        else:
             value = super().get(key)
             self.original_values[key] = value
-        else:
-            value = self.contract_modifications[key_location[-1]][key]
         return value
 
+    def prefetch(self, keys):
+        """
+        Warm original_values with a single bulk read so that later gets on these keys stay in memory.
+        Keys that are already modified or fetched are skipped.
+
+        :param keys: iterable of keys that are likely to be read
+        :return: number of keys fetched from the DB
+        """
+        to_fetch = [k for k in set(keys) if not self.modified_keys.get(k) and k not in self.original_values]
+        values = super().get_many(to_fetch)
+        self.original_values.update(zip(to_fetch, values))
+        self.prefetched.update(to_fetch)
+        return len(to_fetch)
+
     def get_direct(self, key):
         return super().get(key)
 
     def set(self, key, value):
-        self.contract_modifications[-1].update({key: value})
-        # TODO: May have multiple instances of contract_idx if multiple sets on same _key
-        self.modified_keys[key].append(len(self.contract_modifications) - 1)
+        mods = self.contract_modifications[-1]
+
+        # Journal the previous state of the _key in this transaction so savepoints can be rolled back
+        if key in mods:
+            self.journal.append((key, True, mods[key]))
+        else:
+            self.journal.append((key, False, None))
+            self.modified_keys[key].append(len(self.contract_modifications) - 1)
+
+        mods[key] = value
+
+    def replay(self, writes, reads=(), scans=()):
+        """Record a transaction from the raw values it wrote and the keys it read, without executing it"""
+        for key in reads:
+            self.mark_read(key)
+        for prefix in scans:
+            self.read_log.record_scan(prefix)
+        for key, value in writes.items():
+            CacheDriver.set(self, key, value)
+        self.new_tx()
 
     def delete(self, key):
         self.set(key, None) # Indirection is going on here where None gets encoded into JSONs none
@@ -447,50 +942,101 @@ class CacheDriver(DatabaseDriver):
         super().set(key, value)
 
     def revert(self, idx=0):
+        """
+        Discard the writes of transaction idx and every transaction after it. Only the discarded writes are
+        walked, so reverting the tail of a large bag is cheap. Transaction idx is left as an empty, current
+        transaction so it can be executed again.
+        """
         if idx == 0:
             self.reset_cache()
-        else:
-            for key, i in self.modified_keys.items():
-                while len(i) >= 1:
-                    if i[-1] >= idx:
-                        i.pop()
-                    else:
-                        break
-                if len(i) == 0:
-                    i = None
-                self.modified_keys[key] = i
-
-            self.contract_modifications = self.contract_modifications[:idx + 1]
-            # self.contract_modifications[idx].clear()
-            # for mod_dict in self.contract_modifications[:idx + 1]:
+        elif idx < len(self.contract_modifications):
+            for mods in reversed(self.contract_modifications[idx:]):
+                for key in mods:
+                    locations = self.modified_keys[key]
+                    while locations and locations[-1] >= idx:
+                        locations.pop()
+                    if not locations:
+                        del self.modified_keys[key]
+
+            del self.contract_modifications[idx:]
+            self.read_log.truncate(idx)
+            self.new_tx()
+
+    def savepoint(self):
+        """Mark the current point in the current transaction so the writes after it can be undone"""
+        return len(self.contract_modifications), len(self.journal)
+
+    def rollback(self, savepoint):
+        """Undo every write of the current transaction made after the savepoint was taken"""
+        tx, mark = savepoint
+        assert tx == len(self.contract_modifications), 'Savepoint belongs to another transaction.'
+
+        mods = self.contract_modifications[-1]
+        while len(self.journal) > mark:
+            key, existed, previous = self.journal.pop()
+            if existed:
+                mods[key] = previous
+            else:
+                del mods[key]
+                locations = self.modified_keys[key]
+                locations.pop()
+                if not locations:
+                    del self.modified_keys[key]
 
     def commit(self):
+        sets = {}
+        deletes = []
         for key, idx in self.modified_keys.items():
+            # Keys whose every write was reverted have nothing left to commit
+            if not idx:
+                continue
+
             value = self.contract_modifications[idx[-1]][key]
-            if value == 'null': # This shit is null because that is the JSON representation and the data is being encoded in the contract driver
-                super().delete(key)
+            if value == self.null: # Deletes are sets of None, which the contract driver has already encoded
+                deletes.append(key)
             else:
-                super().set(key, value)
+                sets[key] = value
+
+        super().write_batch(sets, deletes)
 
         self.reset_cache()
     #
 
     def iter(self, prefix):
+        self.read_log.record_scan(prefix)
+
         keys = set(super().iter(prefix=prefix))
         for k in self.modified_keys.keys():
-            if k not in keys and k.startswith(prefix):
+            if k.startswith(prefix):
+                # Stores return bytes, and a _key with a pending write must come back once, under the name it is read by
+                keys.discard(k.encode())
                 keys.add(k)
         return list(keys)
 
     def new_tx(self):
         self.contract_modifications.append(dict())
+        self.read_log.new_tx()
+        self.journal = []
+
+
+# Decoded values of these types can be handed out more than once without copying
+IMMUTABLE_TYPES = (int, str, bytes, decimal.Decimal, float, type(None))
 
 
 class ContractDriver(CacheDriver):
     def __init__(self, host=config.DB_URL, port=config.DB_PORT, delimiter=config.INDEX_SEPARATOR, db=0,
-                 code_key=config.CODE_KEY, type_key=config.TYPE_KEY, author_key=config.AUTHOR_KEY):
+                 code_key=config.CODE_KEY, type_key=config.TYPE_KEY, author_key=config.AUTHOR_KEY, codec=None):
         super().__init__(host=host, port=port, db=db)
 
+        self.codec = get_codec(codec)
+        self.null = self.codec.encode(None)
+
+        # LRU of _key -> (raw value, decoded value). An entry is only used while the raw value it was decoded from
+        # is still what the cache layer returns, so writes, reverts and commits can never serve a stale value.
+        self.decoded = OrderedDict()
+        self.decoded_hits = 0
+        self.decoded_misses = 0
+
         self.delimiter = delimiter
 
         self.code_key = code_key
@@ -500,16 +1046,91 @@ class ContractDriver(CacheDriver):
         # Tests if access to the DB is available
         #self.conn.ping()
 
-    def get(self, key):
-        value = super().get(key)
-        return decode(value)
+    @staticmethod
+    def read_cost(key, raw):
+        # Lengths of the key and of the value as stored, which is already encoded, so metering encodes nothing
+        return config.READ_COST_PER_KEY + (len(key) + (len(raw) if raw is not None else 0)) * config.READ_COST_PER_BYTE
+
+    @staticmethod
+    def write_cost(key, raw):
+        return config.WRITE_COST_PER_KEY + (len(key) + len(raw)) * config.WRITE_COST_PER_BYTE
+
+    def get(self, key, metered=True):
+        raw = super().get(key)
+
+        # Every read costs the same whether the cache, a prefetch or the DB served it, so stamps do not depend on
+        # the backend or on what ran before in the bag
+        if metered and rt.tracer.is_started():
+            rt.tracer.add_cost(self.read_cost(key, raw))
+
+        entry = self.decoded.get(key)
+        if entry is not None and entry[0] == raw:
+            self.decoded_hits += 1
+            self.decoded.move_to_end(key)
+            return entry[1]
+
+        self.decoded_misses += 1
+        value = self.codec.decode(raw)
+
+        # Mutable values are not cached. A contract could change them in place without setting them back
+        if isinstance(value, IMMUTABLE_TYPES):
+            self.decoded[key] = (raw, value)
+            if len(self.decoded) > config.DECODED_CACHE_SIZE:
+                self.decoded.popitem(last=False)
+
+        return value
 
     def set(self, key, value):
-        v = encode(value)
+        v = self.codec.encode(value)
+
+        if rt.tracer.is_started():
+            rt.tracer.add_cost(self.write_cost(key, v))
+
+        self.decoded.pop(key, None)
         super().set(key, v)
 
+    def clear_decoded(self):
+        self.decoded.clear()
+
+    def decoded_stats(self):
+        return {
+            'hits': self.decoded_hits,
+            'misses': self.decoded_misses,
+            'size': len(self.decoded)
+        }
+
+    def migrate_codec(self, source='json'):
+        """
+        Re-encode every stored value that is not in this driver's codec yet. Values are decoded with the source
+        codec, so migrating back from msgpack to JSON needs source='msgpack'.
+
+        :return: number of keys rewritten
+        """
+        source = get_codec(source)
+
+        artifacts = config.ARTIFACT_PREFIX.encode()
+
+        sets = {}
+        for key in super(CacheDriver, self).keys():
+            # Marshalled code is stored raw and never went through a codec
+            if key.startswith(artifacts):
+                continue
+
+            raw = super(CacheDriver, self).get(key)
+            if raw is None or self.codec.is_encoded(raw):
+                continue
+
+            value = source.decode(raw)
+            if value is None:
+                continue
+
+            sets[key] = self.codec.encode(value)
+
+        super(CacheDriver, self).write_batch(sets)
+        return len(sets)
+
     def values(self, prefix):
-        keys = super().iter(prefix=prefix)
+        keys = self.iter(prefix=prefix)
         values = []
         for key in keys:
             value = self.get(key)
@@ -539,25 +1160,82 @@ class ContractDriver(CacheDriver):
         )
 
     def get_contract(self, name):
-        return self.hget(name, self.code_key)
+        # Not metered. The module loader reads the code on a cold load only, and what a contract costs to import
+        # must not depend on whether this process had it cached
+        return self.get(self.make_key(name, self.code_key), metered=False)
 
-    def set_contract(self, name, code, author='sys', _type='user', overwrite=False):
+    def set_contract(self, name, code, author='sys', _type='user', overwrite=False, code_obj=None):
         if not overwrite or self.is_contract(name):
             self.hset(name, self.code_key, code)
             self.hset(name, self.author_key, author)
             self.hset(name, self.type_key, _type)
 
-            code_obj = compile(code, '', 'exec')
-            code_blob = marshal.dumps(code_obj)
-            self.hset(name, '__compiled__', code_blob)
+            code_hash = hashlib.sha256(code.encode()).hexdigest()
+            self.hset(name, config.HASH_KEY, code_hash)
+
+            # The marshalled code goes in as raw bytes, past the codec, so loading it is one read and no decoding.
+            # Callers that compiled the code already pass the code object along
+            if code_obj is None:
+                code_obj = compile(code, '', 'exec')
+            CacheDriver.set(self, self.artifact_key(code_hash), marshal.dumps(code_obj))
+
+            self._invalidate_module(name)
+
+    @staticmethod
+    def artifact_key(code_hash):
+        # Marshalled code is only readable by the interpreter version that wrote it
+        return '{}{}{}{}{}'.format(config.ARTIFACT_PREFIX, config.DELIMITER, code_hash, config.DELIMITER,
+                                   sys.implementation.cache_tag)
+
+    def get_compiled(self, name, code_hash=None):
+        """
+        The code object of a contract. Read as raw bytes stored under the hash of its code for this interpreter, or
+        compiled from its code if there are none yet, e.g. after an upgrade of the interpreter.
+        """
+        if code_hash is not None:
+            blob = self.get_raw(self.artifact_key(code_hash))
+            if blob is not None:
+                return marshal.loads(blob)
+
+        code = self.get_contract(name)
+        if code is None:
+            return None
+        return compile(code, '', 'exec')
+
+    def get_contract_hash(self, name):
+        # Not metered. The module loader checks it on every import to tell if the code it has is still current, and
+        # that must not cost the transaction anything
+        return self.codec.decode(self.get_raw(self.make_key(name, config.HASH_KEY)))
+
+    def is_submitted(self, name):
+        """Whether the contract was submitted through this driver and is not committed yet"""
+        return bool(self.modified_keys.get(self.make_key(name, config.HASH_KEY)))
+
+    def get_raw(self, key):
+        """
+        The value of a _key as stored, neither decoded, metered nor attributed to the current transaction. A write
+        pending in the cache, e.g. of a contract submitted earlier in the bag, is seen before it is committed
+        """
+        key_location = self.modified_keys.get(key)
+        if key_location:
+            return self.contract_modifications[key_location[-1]][key]
 
-    def get_compiled(self, name):
-        return self.hget(name, '__compiled__')
+        raw, = super(CacheDriver, self).get_many([key])
+        return raw
 
     def delete_contract(self, name):
         for k in self.iter(prefix=name):
             self.delete(k)
 
+        self._invalidate_module(name)
+
+    @staticmethod
+    def _invalidate_module(name):
+        # Imported here since the module loader imports this one. Loaded modules of this process are warm and would
+        # keep running the old code otherwise
+        from ..execution.module import invalidate_module
+        invalidate_module(name)
+
     def is_contract(self, name):
         return self.exists(
             self.make_key(name, self.code_key)
@@ -567,5 +1245,6 @@ class ContractDriver(CacheDriver):
         return [k.decode() for k in super().keys()]
 
     def get_contract_keys(self, name):
-        keys = [k.decode() for k in self.iter(prefix='{}{}'.format(name, self.delimiter))]
+        keys = self.iter(prefix='{}{}'.format(name, self.delimiter))
+        keys = [k.decode() if isinstance(k, bytes) else k for k in keys]
         return keys
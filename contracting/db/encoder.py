@@ -1,6 +1,15 @@
 import json
+import math
 import decimal
 from ..stdlib.bridge.time import Datetime, Timedelta
+from .. import config
+from ..exceptions import CodecNotFound
+
+# msgpack is optional. Only nodes using the 'msgpack' CODEC need it installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 ##
 # ENCODER CLASS
@@ -54,3 +63,125 @@ def decode(data):
         return json.loads(data, parse_float=decimal.Decimal, object_hook=as_object)
     except json.decoder.JSONDecodeError as e:
         return None
+
+
+##
+# CODECS
+# A codec turns Python values into the raw values stored in the database and back. Drivers pick one by name so that
+# the storage format can change without touching the ORM.
+##
+
+
+# Leading byte of binary encoded values. 0xff never appears in UTF-8, so it can not be the start of a JSON value
+BINARY_MAGIC = b'\xff'
+
+
+class JSONCodec:
+    name = 'json'
+
+    def encode(self, data):
+        return encode(data)
+
+    def decode(self, data):
+        return decode(data)
+
+    def is_encoded(self, data):
+        return not (isinstance(data, bytes) and data[:1] == BINARY_MAGIC)
+
+
+DECIMAL_EXT = 1
+DATETIME_EXT = 2
+TIMEDELTA_EXT = 3
+BIGINT_EXT = 4
+
+# Range of the ints msgpack can store natively. Others are stored as their digits, as JSON would
+MSGPACK_INT_MIN = -2 ** 63
+MSGPACK_INT_MAX = 2 ** 64 - 1
+
+
+class MsgpackCodec:
+    """
+    Compact binary encoding. Values are prefixed with a byte that can never start UTF-8 JSON so both formats can
+    live side by side while state is migrated. Anything without the prefix is decoded as legacy JSON.
+
+    Every value decodes to what the JSON codec would return, so nodes on different codecs keep the same state: Decimals
+    go through float and come back as Decimals like floats do, bytes are stored as hex and non string dict keys as
+    strings. Ints past 64 bits are stored as their digits.
+    """
+    name = 'msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise CodecNotFound(codec='msgpack (the msgpack package is not installed)', known_codecs=CODECS.keys())
+
+    @staticmethod
+    def _default(o):
+        if isinstance(o, decimal.Decimal):
+            return msgpack.ExtType(DECIMAL_EXT, str(o).encode())
+        if isinstance(o, Datetime):
+            return msgpack.ExtType(DATETIME_EXT, msgpack.packb(
+                [o.year, o.month, o.day, o.hour, o.minute, o.second, o.microsecond]))
+        if isinstance(o, Timedelta):
+            return msgpack.ExtType(TIMEDELTA_EXT, msgpack.packb([o._timedelta.days, o._timedelta.seconds]))
+        raise TypeError('Object of type {} is not serializable'.format(type(o).__name__))
+
+    @staticmethod
+    def _ext_hook(code, data):
+        if code == DECIMAL_EXT:
+            return decimal.Decimal(data.decode())
+        if code == DATETIME_EXT:
+            return Datetime(*msgpack.unpackb(data))
+        if code == TIMEDELTA_EXT:
+            days, seconds = msgpack.unpackb(data)
+            return Timedelta(days=days, seconds=seconds)
+        if code == BIGINT_EXT:
+            return int(data.decode())
+        return msgpack.ExtType(code, data)
+
+    @staticmethod
+    def _number(f):
+        # JSON writes a float by its repr and reads it back as a Decimal, but for NaN and infinities, which stay floats
+        return decimal.Decimal(repr(f)) if math.isfinite(f) else f
+
+    def _prepare(self, o):
+        t = type(o)
+        if t is float or t is decimal.Decimal:
+            return self._number(float(o))
+        if t is bytes:
+            return o.hex()
+        if t is int and not MSGPACK_INT_MIN <= o <= MSGPACK_INT_MAX:
+            return msgpack.ExtType(BIGINT_EXT, str(o).encode())
+        if isinstance(o, (list, tuple)):
+            return [self._prepare(i) for i in o]
+        if isinstance(o, dict):
+            return {(k if type(k) is str else json.dumps(k)): self._prepare(v) for k, v in o.items()}
+        return o
+
+    def encode(self, data):
+        return BINARY_MAGIC + msgpack.packb(self._prepare(data), default=self._default, use_bin_type=True)
+
+    def decode(self, data):
+        if data is None:
+            return None
+
+        if isinstance(data, str) or data[:1] != BINARY_MAGIC:
+            return decode(data)
+
+        return msgpack.unpackb(data[1:], ext_hook=self._ext_hook, raw=False)
+
+    def is_encoded(self, data):
+        return isinstance(data, bytes) and data[:1] == BINARY_MAGIC
+
+
+CODECS = {
+    'json': JSONCodec,
+    'msgpack': MsgpackCodec
+}
+
+
+def get_codec(name=None):
+    name = name or config.CODEC
+    cls = CODECS.get(name)
+    if cls is None:
+        raise CodecNotFound(codec=name, known_codecs=CODECS.keys())
+    return cls()
@@ -27,6 +27,16 @@ class DatabaseDriverNotFound(SenecaError):
     fmt = "Unknown database _driver '{_driver}', known drivers '{known_drivers}'"
 
 
+class CodecNotFound(SenecaError):
+    """
+    Could not find the specified value codec
+
+    :ivar codec: The name of the codec the user attempted to load
+    :ivar known_codecs: The list of known codecs
+    """
+    fmt = "Unknown codec '{codec}', known codecs '{known_codecs}'"
+
+
 class ContractExists(SenecaError):
     """
     When attempting to set a contract, found that it
@@ -46,3 +56,25 @@ class SenecaException(Exception):
     """
     Base exeception to be returned by default from inside contracting contracts
     """
+
+
+class CostTableNotFound(SenecaError):
+    """
+    There is no opcode cost table for the running interpreter
+
+    :ivar path: Where the table was expected
+    :ivar cache_tag: Tag of the interpreter, e.g. cpython-36
+    """
+    fmt = "No opcode cost table for interpreter '{cache_tag}' at '{path}'. " \
+          "Generate one with python -m contracting.execution.metering.estimator"
+
+
+class CostTableMismatch(SenecaError):
+    """
+    An opcode cost table does not have an entry for every opcode the tracer meters
+
+    :ivar path: The table
+    :ivar size: Number of entries in the table
+    :ivar expected: Number of opcodes the tracer meters
+    """
+    fmt = "Opcode cost table '{path}' has {size} entries, the tracer meters {expected} opcodes"
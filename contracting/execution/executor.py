@@ -1,4 +1,5 @@
 import importlib
+import itertools
 import multiprocessing
 
 from typing import Dict
@@ -8,16 +9,23 @@ from . import runtime
 from ..db.cr.transaction_bag import TransactionBag
 from ..db.driver import ContractDriver, CacheDriver
 from ..execution.module import install_database_loader, uninstall_builtins
+from ..execution.prefetch import Prefetcher
+from ..execution.pool import TransactionPool
+from ..execution.optimistic import OptimisticExecutor
 from .. import config
 
 STAMP_TO_TAU = 5000 # Manually set until voting added
 
 class Executor:
     def __init__(self, production=False, driver=None, metering=True,
-                 currency_contract='currency', balances_hash='balances'):
+                 currency_contract='currency', balances_hash='balances', prefetch=False,
+                 workers=config.EXECUTION_WORKERS, optimistic=False, metering_mode=None):
 
         self.metering = metering
 
+        # How stamps are counted when metering, see config.METERING
+        self.metering_mode = metering_mode or config.METERING
+
         self.driver = driver
         if not self.driver:
             self.driver = ContractDriver()
@@ -34,6 +42,21 @@ class Executor:
         self.currency_contract = currency_contract
         self.balances_hash = balances_hash
 
+        # Optionally warm the driver cache with the keys each transaction is likely to read before running it
+        self.prefetcher = None
+        if prefetch:
+            self.prefetcher = Prefetcher(currency_contract=currency_contract, balances_hash=balances_hash)
+
+        # Optionally execute the transactions of a bag on a pool of worker processes
+        self.pool = None
+        if workers or optimistic:
+            self.pool = TransactionPool(self, workers or multiprocessing.cpu_count())
+
+        # Optionally execute bags speculatively on the pool and re-execute only the transactions that read stale state
+        self.optimistic = None
+        if optimistic:
+            self.optimistic = OptimisticExecutor(self, self.pool)
+
         runtime.rt.env.update({'__Driver': self.driver})
 
     def execute_bag(self, bag: TransactionBag, environment={}, auto_commit=False, driver=None) -> Dict[int, tuple]:
@@ -50,8 +73,18 @@ class Executor:
                     2: (1, ImportError)
                  }
         """
+        target = driver or self.driver
+        if self.optimistic is not None and not auto_commit and isinstance(target, ContractDriver):
+            return self.optimistic.execute_bag(bag, environment=environment, driver=target)
+
+        if self.pool is not None and not auto_commit and isinstance(target, ContractDriver):
+            return self.pool.execute_bag(bag, environment=environment, driver=target)
+
         response_obj = {}
 
+        if self.prefetcher is not None and isinstance(target, CacheDriver):
+            target.prefetch(self.prefetcher.keys_for_bag(bag, metering=self.metering))
+
         for idx, tx in bag:
             response_obj[idx] = self.execute(tx.payload.sender, tx.contract_name, tx.func_name,
                                              tx.kwargs, stamps=tx.payload.stampsSupplied, auto_commit=auto_commit,
@@ -85,6 +118,15 @@ class Executor:
         # Therefor we need to have a try catch to communicate success/fail back to the
         # client. Necessary in the case of batch run through bags where we still want to
         # continue execution in the case of failure of one of the transactions.
+        learning = False
+        if self.prefetcher is not None and isinstance(driver, CacheDriver):
+            driver.prefetch(self.prefetcher.keys_for_tx(sender, contract_name, function_name, kwargs,
+                                                        metering=metering))
+
+            learning = self.prefetcher.wants(contract_name, function_name)
+            reads_before = len(driver.original_values)
+            mods_before = len(driver.contract_modifications)
+
         balances_key = None
         if metering:
 
@@ -100,11 +142,18 @@ class Executor:
                                        Balance at key {} is {}'.format(balances_key, balance)
 
         # Execute the function
-        runtime.rt.set_up(stmps=stamps, meter=metering)
+        runtime.rt.set_up(stmps=stamps, meter=metering, mode=self.metering_mode)
         status_code, result = self.sandbox.execute(sender, contract_name, function_name, kwargs,
                                                    auto_commit, environment, driver)
         runtime.rt.tracer.stop()
 
+        # Remember what this transaction touched so the next calls to the same function can be prefetched
+        if learning:
+            touched = set(itertools.islice(driver.original_values, reads_before, None))
+            for mods in driver.contract_modifications[mods_before - 1:]:
+                touched.update(mods.keys())
+            self.prefetcher.observe(sender, contract_name, function_name, kwargs, touched)
+
         # Deduct the stamps if that is enabled
         if metering:
             assert balances_key is not None, 'Balance key was not set properly. Cannot deduct stamps.'
@@ -183,6 +232,12 @@ class Sandbox(object):
         runtime.rt.ctx.append(sender)
         runtime.rt.env.update(environment)
         status_code = 0
+
+        # Lets a failed transaction inside a bag drop its own writes without touching the ones before it
+        savepoint = None
+        if isinstance(driver, CacheDriver):
+            savepoint = driver.savepoint()
+
         try:
             module = importlib.import_module(contract_name)
             #module = __import__(contract_name)
@@ -199,6 +254,8 @@ class Sandbox(object):
             status_code = 1
             if auto_commit:
                 driver.revert()
+            elif savepoint is not None:
+                driver.rollback(savepoint)
         finally:
             if isinstance(driver, CacheDriver):
                 driver.new_tx()
@@ -227,9 +284,7 @@ class MultiProcessingSandbox(Sandbox):
 
     def _update_driver_cache(self, driver, updated_driver):
         if updated_driver and isinstance(updated_driver, CacheDriver):
-            driver.reset_cache(modified_keys=updated_driver.modified_keys,
-                               contract_modifications=updated_driver.contract_modifications,
-                               original_values=updated_driver.original_values)
+            driver.take_cache(updated_driver)
 
     def execute_bag(self, txbag, environment={}, auto_commit=False, driver=None):
         self._lazy_instantiate()
@@ -312,5 +367,9 @@ class MultiProcessingSandbox(Sandbox):
                                                              tx['kwargs'], auto_commit=tx['auto_commit'],
                                                              environment=tx['environment'], driver=driver)
 
+                # The parent cleans up its own runtime, not this one. Without this the next import returns the module
+                # of an earlier message, whose ORM objects still write to the driver that message brought along
+                runtime.rt.clean_up()
+
             parent_pipe.send(response_obj)
 
@@ -0,0 +1,81 @@
+"""
+Cost tables for block metering.
+
+The tracer used to charge the first opcode of every line it saw, in every frame, including the interpreter and
+driver code a contract calls into. With block metering every contract code object gets a table of what each run of
+its instructions costs when it is loaded, and the tracer:
+
+    * turns off line events for frames whose code has no table, so only contract code pays for a trace callback
+    * charges, on a line event, the cost of every instruction from where the frame is up to the next line
+
+Tables are packed unsigned ints, one per code unit, registered by id(code) so the tracer can look them up without
+hashing the code object.
+"""
+
+from array import array
+import dis
+
+from ... import config
+from .costs import load_costs
+
+# Bytes per code unit (opcode + argument)
+CODE_UNIT = 2
+
+# id(code) -> packed cost table. Handed to the tracer, which reads it on every call into a new frame
+TABLES = {}
+
+# id(code) -> code. Keeps registered code alive so its id can't be reused by another code object
+_CODES = {}
+
+# Cost table of the running interpreter
+COSTS = load_costs()
+
+
+def line_costs(code, costs=COSTS):
+    """
+    Cost of every code unit of a code object up to the next line. A line event at any instruction then charges the
+    straight-line run it starts, so every instruction executed is paid for instead of only the first of each line.
+    """
+    raw = code.co_code
+    units = len(raw) // CODE_UNIT
+
+    starts = {offset // CODE_UNIT for offset, _ in dis.findlinestarts(code)}
+
+    table = array('I', [0]) * units
+    running = 0
+    for i in range(units - 1, -1, -1):
+        running += costs.get(raw[i * CODE_UNIT], 0)
+        table[i] = running
+        if i in starts:
+            running = 0
+
+    return table
+
+
+def code_objects(code):
+    """The code object and every code object nested in it, e.g. the functions defined by a contract"""
+    yield code
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            yield from code_objects(const)
+
+
+def register(code, costs=COSTS):
+    for c in code_objects(code):
+        if id(c) not in TABLES:
+            TABLES[id(c)] = line_costs(c, costs).tobytes()
+            _CODES[id(c)] = c
+
+
+def unregister(code):
+    for c in code_objects(code):
+        if _CODES.get(id(c)) is c:
+            del TABLES[id(c)]
+            del _CODES[id(c)]
+
+
+def tables(mode=None):
+    """Tables the tracer meters with, or None to charge the first opcode of every line as the line tracer does"""
+    if (mode or config.METERING) == 'blocks':
+        return TABLES
+    return None
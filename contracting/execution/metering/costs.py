@@ -0,0 +1,57 @@
+import os
+import sys
+
+import contracting
+from ...exceptions import CostTableNotFound, CostTableMismatch
+
+"""
+Opcode cost tables, one per interpreter since opcodes are renumbered, added and removed between Python versions:
+
+    contracting/execution/metering/cu_costs.<sys.implementation.cache_tag>.const
+
+A table has one "opcode,cost" line for every value an opcode byte can take, TABLE_SIZE in total. Lines starting with
+'#' are comments. The C tracer reads the same file into a table of the same size, so a table that does not fit it is
+rejected here instead of metering with part of it.
+
+Tables are generated by contracting.execution.metering.estimator.
+"""
+
+TABLE_SIZE = 256
+
+COSTS_DIR = os.path.join(contracting.__path__[0], 'execution', 'metering')
+
+
+def costs_path(cache_tag=None):
+    return os.path.join(COSTS_DIR, 'cu_costs.{}.const'.format(cache_tag or sys.implementation.cache_tag))
+
+
+def load_costs(path=None):
+    path = path or costs_path()
+
+    if not os.path.exists(path):
+        raise CostTableNotFound(path=path, cache_tag=sys.implementation.cache_tag)
+
+    costs = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            opcode, cost = line.split(',')
+            costs[int(opcode)] = int(cost)
+
+    if sorted(costs) != list(range(TABLE_SIZE)):
+        raise CostTableMismatch(path=path, size=len(costs), expected=TABLE_SIZE)
+
+    return costs
+
+
+def write_costs(costs, path, comments=()):
+    if sorted(costs) != list(range(TABLE_SIZE)):
+        raise CostTableMismatch(path=path, size=len(costs), expected=TABLE_SIZE)
+
+    with open(path, 'w') as f:
+        for comment in comments:
+            f.write('# {}\n'.format(comment))
+        for opcode in range(TABLE_SIZE):
+            f.write('{},{}\n'.format(opcode, costs[opcode]))
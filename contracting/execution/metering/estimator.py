@@ -1,433 +1,407 @@
 """
-    OperationsEstimator is for computing the estimated cost of each opcode
-    instructions for your system. This is not meant to be used for determining
-    the cost of a smart contract. For that, see contracting.libs.metering.cost.Cost
+    OperationsEstimator computes the cost of every opcode of the running interpreter, for the cost table the tracer
+    meters with. This is not meant to be used for determining the cost of a smart contract.
+
+    Run it headless with the interpreter the table is for:
+
+        python -m contracting.execution.metering.estimator
+
+    which writes contracting/execution/metering/cu_costs.<cache tag>.const, see contracting.execution.metering.costs.
+
+    * Every snippet of SNIPPETS is executed once under a tracer that counts the opcodes it runs, then timed on its
+      own and repeated several times over. The fastest of a few timings is used, so a stray slow run does not move
+      the result.
+    * The time of a snippet is fitted as the sum of the costs of the opcodes it ran, plus a fixed overhead for
+      executing a snippet at all. Costs are never negative, and snippets that fit badly are weighted down (Huber)
+      so a noisy one can't drag every opcode it shares with others along.
+    * The whole measurement is done a few times and the median cost of every opcode is kept.
+    * Costs are expressed relative to the cost of a few reference opcodes, which gives the same table on a faster or
+      a slower machine, and rounded to a coarse scale so noise in the timings does not show in the table. Opcodes no
+      snippet runs are charged as much as the more expensive measured ones.
 """
 
-import dis, time, os, sys, numpy as np
-from collections import defaultdict
-from scipy.optimize import nnls
-import matplotlib
-matplotlib.use('TkAgg')
-import matplotlib.pyplot as plt
+import argparse
+import dis
+import gc
+import math
+import platform
+import statistics
+import sys
+import time
+from collections import Counter
 
-import contracting
+from .costs import TABLE_SIZE, costs_path, write_costs
 
-constants_path = contracting.__path__[0] + '/constants/'
+# Costs are multiples of the average cost of these opcodes, which is charged REFERENCE_COST. A single opcode is too
+# cheap to be told apart reliably from the ones it always runs with
+REFERENCE_OPNAMES = ('LOAD_CONST', 'LOAD_NAME', 'STORE_NAME', 'LOAD_FAST', 'STORE_FAST', 'POP_TOP')
+REFERENCE_COST = 2
 
-def timeit(fn):
-    def _fn(self, op, code_str, *args, **kwargs):
+# Opcodes no snippet runs are charged this quantile of the measured costs
+UNMEASURED_QUANTILE = 0.9
+
+SNIPPETS = [
+    # Names, constants and simple statements
+    'a = 1',
+    'a = 1\nb = a',
+    'a = 1\ndel a',
+    'a = None\nb = True\nc = False',
+    'a = 1\nb = 2\na, b = b, a',
+    'a = 1\na, a, a = a, a, a',
+    'a, b = "ab"',
+    'a, *b = [1, 2, 3]',
+    'pass',
+    'def f():\n    global g\n    g = 1\nf()',
+    'def f():\n    global g\n    g = 1\n    return g\nf()',
+    'def f():\n    global g\n    g = 1\n    del g\nf()',
+
+    # Unary, binary and in place operators
+    'a = 1\na = +a',
+    'a = 1\na = -a',
+    'a = 1\na = not a',
+    'a = 1\na = ~a',
+    'a = 2\na = a ** 2',
+    'a = 2\na = a * 2',
+    'a = 2\na = a @ 2 if False else a',
+    'a = 2\na = a % 2',
+    'a = 2\na = a + 2',
+    'a = 2\na = a - 2',
+    'a = 2\na = a // 2',
+    'a = 2\na = a / 2',
+    'a = 1\na = a << 1',
+    'a = 1\na = a >> 1',
+    'a = 1\na = a & 1',
+    'a = 1\na = a ^ 1',
+    'a = 1\na = a | 1',
+    'a = 1\na += 1',
+    'a = 1\na -= 1',
+    'a = 1\na *= 1',
+    'a = 1\na /= 1',
+    'a = 1\na //= 1',
+    'a = 1\na %= 1',
+    'a = 1\na **= 1',
+    'a = 1\na <<= 1',
+    'a = 1\na >>= 1',
+    'a = 1\na &= 1',
+    'a = 1\na ^= 1',
+    'a = 1\na |= 1',
+    'a = "x" + "y"',
+    'a = "x" * 3',
+    'a = 1.5 * 2.5',
+
+    # Comparisons and boolean logic
+    'a = 1 == 2',
+    'a = 1 < 2',
+    'a = 1 < 2 < 3',
+    'a = 1\nb = a is None',
+    'a = 1\nb = a is not None',
+    'a = 1 in (1, 2)',
+    'a = 1 not in (1, 2)',
+    'a = 1 and 2',
+    'a = 0 or 2',
+    'a = 1 if 1 else 2',
+    'if 1 == 2:\n    a = 1\nelse:\n    a = 2',
+    'if not 1 == 2:\n    a = 1\nelse:\n    a = 2',
+    'a = None\nif a is None:\n    a = 1',
+
+    # Containers
+    'a = [1, 2, 3]',
+    'a = (1, 2, 3)',
+    'a = 1\nb = (a, a)',
+    'a = {1, 2, 3}',
+    'a = {"a": 1, "b": 2}',
+    'a = 1\nb = {"a": a, "b": a}',
+    'a = 1\nb = {a: a}',
+    'a = [1]\nb = [*a, *a]',
+    'a = (1,)\nb = (*a, *a)',
+    'a = {1}\nb = {*a, *a}',
+    'a = {"a": 1}\nb = {**a, **a}',
+    'a = [1]\na[0]',
+    'a = [0]\na[0] = 1',
+    'a = [1]\ndel a[0]',
+    'a = [1, 2, 3]\nb = a[:]',
+    'a = [1, 2, 3, 4]\nb = a[::-1]',
+    'a = [1, 2, 3]\na[1:2] = [4]',
+    'a = {"a": 1}\nb = a["a"]',
+    'a = [1]\na[0] += 1',
+    'a = "abc"\nb = a[1]',
+
+    # Strings
+    'a = 1\nb = f"{a}"',
+    'a = 1\nb = f"{a}-{a}"',
+    'a = 1.5\nb = f"{a:.2f}"',
+    'a = "x"\nb = f"{a!r}"',
+
+    # Attributes and methods
+    '[].sort()',
+    'a = []\na.append(1)',
+    'a = "abc".upper()',
+    'a = (1).real',
+    'class A: pass\na = A()\na.x = 1',
+    'class A: pass\na = A()\na.x = 1\nb = a.x',
+    'class A: pass\na = A()\na.x = 1\ndel a.x',
+    'class A:\n    def f(self):\n        return 1\nA().f()',
+
+    # Functions
+    'def f(): pass',
+    'def f(): pass\nf()',
+    'def f(a): return a\nf(1)',
+    'def f(a, b): return a\nf(1, 2)',
+    'def f(a, b=1): return a\nf(1)',
+    'def f(a, *, b): return a\nf(1, b=2)',
+    'def f(a, b): return a\nf(a=1, b=2)',
+    'def f(a, b): pass\na = (1, 2)\nf(*a)',
+    'def f(a, b): pass\na = {"a": 1, "b": 2}\nf(**a)',
+    'def f(*a, **k): return a\nf(1, 2, c=3)',
+    'f = lambda: 1\nf()',
+    'def f(a):\n    def g():\n        return a\n    return g()\nf(1)',
+    'def f():\n    a = 1\n    def g():\n        nonlocal a\n        a = 2\n    g()\n    return a\nf()',
+    'def d(f): return f\n@d\ndef f(): pass',
+    'def f():\n    a = 1\n    b = a\n    return b\nf()',
+    'def f():\n    a = 1\n    del a\nf()',
+    'def f():\n    return len([1])\nf()',
+    'a = len([1, 2])',
+    'a = abs(-1)',
+    'a = isinstance(1, int)',
+
+    # Loops and comprehensions
+    'for a in (1, 2): pass',
+    'for a in range(10): pass',
+    'for a in range(10):\n    b = a',
+    'for a in (1, 2): break',
+    'for a in range(5):\n    if a > 2:\n        continue',
+    'a = 0\nwhile a < 5:\n    a += 1',
+    'a = 0\nwhile True:\n    a += 1\n    if a > 3:\n        break',
+    'for a, b in ((1, 2), (3, 4)): pass',
+    'a = [x for x in range(5)]',
+    'a = [x for x in range(5) if x]',
+    'a = {x for x in range(5)}',
+    'a = {x: x for x in range(5)}',
+    'a = list(x for x in range(5))',
+    'a = [x * y for x in range(3) for y in range(3)]',
+    'def g():\n    yield 1\n    yield 2\nfor a in g(): pass',
+    'def g():\n    yield from (1, 2)\nfor a in g(): pass',
+
+    # Exceptions and context managers
+    'try:\n    a = 1\nexcept ValueError:\n    a = 2',
+    'try:\n    raise ValueError\nexcept ValueError:\n    a = 2',
+    'try:\n    raise ValueError("x")\nexcept ValueError as e:\n    a = e',
+    'try:\n    a = 1\nfinally:\n    a = 3',
+    'try:\n    try:\n        raise ValueError\n    finally:\n        a = 1\nexcept ValueError:\n    pass',
+    'try:\n    assert 1 == 2\nexcept AssertionError:\n    pass',
+    'assert 1 == 1',
+    'for a in (1, 2):\n    try:\n        continue\n    except Exception:\n        pass',
+    'class C:\n    def __enter__(self): return self\n    def __exit__(self, *a): pass\nwith C() as c: pass',
+    'class C:\n    def __enter__(self): return self\n    def __exit__(self, *a): return True\nwith C():\n'
+    '    raise ValueError',
+
+    # Classes, imports and pattern matching
+    'class A: pass',
+    'class A:\n    x = 1\n    def f(self): pass',
+    'class A:\n    def __init__(self):\n        super().__init__()\nA()',
+    'import math',
+    'import os.path',
+    'from math import pi',
+    'from math import *',
+    'a = [1, 2]\nmatch a:\n    case [x, y]:\n        b = x\n    case _:\n        b = 0',
+    'a = {"k": 1}\nmatch a:\n    case {"k": v}:\n        b = v',
+    'a = 1\nmatch a:\n    case int():\n        b = a',
+    'a = 3\nmatch a:\n    case 1 | 2:\n        b = 1\n    case _:\n        b = 2',
+]
+
+
+def quantize(cost):
+    """
+    Nearest of 1, 2, 3, 4, 6, 8, 12, 16 ... Costs are only as precise as the timings they come from, so small
+    differences between runs leave the table as it is
+    """
+    if cost < 1.5:
+        return 1
+
+    exponent = math.floor(math.log2(cost))
+    candidates = [2 ** exponent, 2 ** (exponent + 1)]
+    if exponent > 0:
+        candidates.append(3 * 2 ** (exponent - 1))
+
+    return min(candidates, key=lambda c: abs(math.log(cost / c)))
+
+
+def _opcode_counter(counts):
+    def trace(frame, event, arg):
+        frame.f_trace_opcodes = True
+        if event == 'opcode':
+            counts[frame.f_code.co_code[frame.f_lasti]] += 1
+        return trace
+    return trace
 
-        ### Finding the median time it takes for each code snippets
-        med = []
-        opcode = dis.opmap[op]
-        instructions = defaultdict(int)
-        for ins in dis.get_instructions(code_str):
-            instructions[ins.opcode] += 1
-        code_obj = compile(code_str, '__main__', 'exec')
-        for i in range(self.iterations):
-            try:
-                start = time.clock()
-                fn(self, code_obj, *args, **kwargs)
-                end = time.clock()
-            except ValueError:
-                end = time.clock()
-            elapsed = end-start
-            med.append(elapsed)
-            if hasattr(self, 'histogram_file'):
-                self.histogram_file.write('{},{}\n'.format(opcode, elapsed))
-
-        t = np.median(med)
-        # if not instructions.get(opcode):
-        #     raise Exception('Not a valid example: {}\n{}'.format(op,
-        #         [ins.opname for ins in dis.get_instructions(code_str)]))
-        self.costs[opcode] = {
-            't': t,
-            'ops': instructions
-        }
-
-        return t
-    return _fn
-
-def suppress_stdout(fn):
-    def _fn(*args, **kwargs):
-        ### Disable stdout
-        stdout = sys.stdout
-        f = open(os.devnull, 'w')
-        sys.stdout = f
-        fn(*args, **kwargs)
-        ### Re-enable stdout
-        sys.stdout = stdout
-    return _fn
 
 class OperationsEstimator:
-    def __init__(self, show_plot=False):
-        self.iterations = 10000
-        self.total_opcodes = 144
-        self.non_zero_min_cost = np.float('2.7937841015807387e-09')
-        self.costs = {}
-        self.histogram_fname = os.path.join(constants_path, 'histogram.csv')
-        self.costs_fname = os.path.join(constants_path, 'costs.csv')
-        self.cu_costs_fname = os.path.join(constants_path, 'cu_costs.const')
-        self.show_plot = show_plot
-        if not os.path.exists(self.costs_fname):
-            self.compute_opcode_costs()
-        else:
-            self.load_opcode_costs()
-        if not os.path.exists(self.cu_costs_fname):
-            self.comput_cu_costs()
-        else:
-            self.load_cu_costs()
-
-    @timeit
-    def calc_cost(self, code_obj):
-        exec(code_obj)
-
-    @suppress_stdout
-    def precalc_costs(self):
-        self.calc_cost('POP_TOP','''
-(lambda:1)()
-        ''')
-        self.calc_cost('ROT_TWO','''
-a = 1; b = 2
-(a, b) = (b, a)
-        ''')
-        self.calc_cost('ROT_THREE','''
-a = 1
-(a, a, a) = (a, a, a)
-        ''')
-        self.calc_cost('UNARY_POSITIVE','''
-a = 1
-a = +a
-        ''')
-        self.calc_cost('UNARY_NEGATIVE','''
-a = 1
-a = -a
-        ''')
-        self.calc_cost('UNARY_NOT','''
-a = 1
-a = not a
-        ''')
-        self.calc_cost('UNARY_INVERT','''
-a = 1
-a = ~a
-        ''')
-        self.calc_cost('BINARY_POWER','''
-a = 2
-a = a ** 2
-        ''')
-        self.calc_cost('BINARY_MULTIPLY','''
-a = 2
-a = a * 2
-        ''')
-        self.calc_cost('BINARY_MODULO','''
-a = 2
-a = a % 2
-        ''')
-        self.calc_cost('BINARY_ADD','''
-a = 2
-a = a + 2
-        ''')
-        self.calc_cost('BINARY_SUBTRACT','''
-a = 2
-a = a - 2
-        ''')
-        self.calc_cost('BINARY_SUBSCR','''
-a = [1]
-a[0]
-        ''')
-        self.calc_cost('BINARY_FLOOR_DIVIDE','''
-a = 2
-a = a // 2
-        ''')
-        self.calc_cost('BINARY_TRUE_DIVIDE','''
-a = 2
-a = a / 2
-        ''')
-        self.calc_cost('INPLACE_FLOOR_DIVIDE','''
-a = 1
-a //= 1
-        ''')
-        self.calc_cost('BUILD_SLICE','''
-a = [1,2,3]
-a = a[:]
-        ''')
-        self.calc_cost('INPLACE_ADD','''
-a = 1
-a += 1
-        ''')
-        self.calc_cost('INPLACE_SUBTRACT','''
-a = 1
-a -= 1
-        ''')
-        self.calc_cost('INPLACE_MULTIPLY','''
-a = 1
-a *= 1
-        ''')
-        self.calc_cost('INPLACE_TRUE_DIVIDE','''
-a = 1
-a /= 1
-        ''')
-        self.calc_cost('INPLACE_MODULO','''
-a = 1
-a %= 1
-        ''')
-        self.calc_cost('STORE_SUBSCR','''
-a = [0]
-a[0] = 1
-        ''')
-        self.calc_cost('DELETE_SUBSCR','''
-a = [1]
-del a[0]
-        ''')
-        self.calc_cost('BINARY_LSHIFT','''
-a = 1
-a = a << 1
-        ''')
-        self.calc_cost('BINARY_RSHIFT','''
-a = 1
-a = a >> 1
-        ''')
-        self.calc_cost('BINARY_AND','''
-a = 1
-a = a & 1
-        ''')
-        self.calc_cost('BINARY_XOR','''
-a = 1
-a = a ^ 1
-        ''')
-        self.calc_cost('BINARY_OR','''
-a = 1
-a = a | 1
-        ''')
-        self.calc_cost('INPLACE_POWER','''
-a = 1
-a **= 1
-        ''')
-        self.calc_cost('GET_ITER','''
-for a in (1,2): pass
-        ''')
-        self.calc_cost('INPLACE_LSHIFT','''
-a = 1
-a <<= 1
-        ''')
-        self.calc_cost('INPLACE_RSHIFT','''
-a = 1
-a >>= 1
-        ''')
-        self.calc_cost('INPLACE_AND','''
-a = 1
-a &= 1
-        ''')
-        self.calc_cost('INPLACE_XOR','''
-a = 1
-a ^= 1
-        ''')
-        self.calc_cost('INPLACE_OR','''
-a = 1
-a |= 1
-        ''')
-        self.calc_cost('BREAK_LOOP','''
-for a in (1,2): break
-        ''')
-        f = open('1.txt', 'w+')
-        self.calc_cost('WITH_CLEANUP_START','''
-with open("1.txt") as f:
-    print(f.read())
-        ''')
-        self.calc_cost('WITH_CLEANUP_FINISH','''
-with open("1.txt") as f:
-    print(f.read())
-        ''')
-        os.remove('1.txt')
-        self.calc_cost('RETURN_VALUE','''
-# empty file
-        ''')
-        self.calc_cost('IMPORT_STAR','''
-from sys import *
-        ''')
-        self.calc_cost('POP_BLOCK','''
-for a in (1,2): break
-        ''')
-        self.calc_cost('END_FINALLY','''
-try:
-    a = 1
-finally:
-    a = 3
-        ''')
-        self.calc_cost('LOAD_BUILD_CLASS','''
-class a: pass
-        ''')
-        self.calc_cost('STORE_NAME','''
-a = 1
-        ''')
-        self.calc_cost('DELETE_NAME','''
-a = 1
-del a
-        ''')
-        self.calc_cost('UNPACK_SEQUENCE','''
-(a, b) = "ab"
-        ''')
-        self.calc_cost('FOR_ITER','''
-for i in (1,2): pass
-        ''')
-        self.calc_cost('STORE_ATTR','''
-import sys
-sys.stderr = sys.stdout
-        ''')
-        self.calc_cost('DELETE_ATTR','''
-import random
-random.hello = 'world'
-del random.hello
-        ''')
-        self.calc_cost('STORE_GLOBAL','''
-global a
-a = 1
-        ''')
-        self.calc_cost('DELETE_GLOBAL','''
-global a
-a = 2
-del a
-        ''')
-        self.calc_cost('DUP_TOP_TWO','''
-a = 0
-b = [0]
-b[a] += 1
-        ''')
-        self.calc_cost('LOAD_CONST','''
-a = 1
-        ''')
-        self.calc_cost('LOAD_NAME','''
-a = 1
-a = a
-        ''')
-        self.calc_cost('BUILD_TUPLE','''
-a = 1;
-a = (a, a)
-        ''')
-        self.calc_cost('BUILD_LIST','''
-[1,2,3]
-        ''')
-        self.calc_cost('BUILD_CONST_KEY_MAP','''
-{"a":1,"b":2}
-        ''')
-        self.calc_cost('LOAD_ATTR','''
-[].sort()
-        ''')
-        self.calc_cost('COMPARE_OP','''
-a = 1 == 2
-        ''')
-        self.calc_cost('IMPORT_NAME','''
-import random
-        ''')
-        self.calc_cost('IMPORT_FROM','''
-from dis import opmap
-        ''')
-        self.calc_cost('JUMP_FORWARD','''
-if 1 == 2: pass
-else: pass
-        ''')
-        self.calc_cost('POP_JUMP_IF_FALSE','''
-if 1 == 2: pass
-else: pass
-        ''')
-        self.calc_cost('POP_JUMP_IF_TRUE','''
-if not(1 == 2): pass
-else: pass
-        ''')
-        self.calc_cost('JUMP_ABSOLUTE','''
-for i in (1,2): pass
-        ''')
-        self.calc_cost('LOAD_GLOBAL','''
-global a
-a = 1
-a = a
-        ''')
-        self.calc_cost('CONTINUE_LOOP','''
-for x in (1,2):
-    try: continue
-    except: pass
-        ''')
-        self.calc_cost('SETUP_LOOP','''
-while 0 > 1: pass
-        ''')
-        self.calc_cost('SETUP_EXCEPT','''
-try:
-    a = 1
-except ValueError:
-    a = 2
-        ''')
-        self.calc_cost('SETUP_FINALLY','''
-try:
-    a = 1
-finally:
-    a = 3
-        ''')
-        self.calc_cost('RAISE_VARARGS','''
-raise ValueError
-        ''')
-        self.calc_cost('CALL_FUNCTION','''
-def f(): pass
-f()
-        ''')
-        self.calc_cost('MAKE_FUNCTION','''
-def f(): pass
-        ''')
-        self.calc_cost('BUILD_SLICE','''
-a = [1,2,3,4]
-b = a[::-1]
-        ''')
-        self.calc_cost('CALL_FUNCTION_EX','''
-def f(a,b): pass
-a = (1,2)
-f(*a)
-        ''')
-
-    def computer_medians(self):
-        X = []
-        y = []
-        for opcode, item in self.costs.items():
-            X.append([item['ops'][i] if item['ops'].get(i) else 0 for i in range(self.total_opcodes)])
-            y.append(item['t'])
-        X = np.array(X)
-        y = np.array(y)
-        medians = np.array(nnls(X, y)[0])
-        self.opcodes = [i for i in range(self.total_opcodes)]
-        self.medians = [m for idx, m in enumerate(medians)]
-        self.costs = {}
-        for i, m in enumerate(self.medians):
-            self.costs_file.write('{},{}\n'.format(self.opcodes[i], repr(m)))
-
-    def plot(self):
-        plt.plot(self.opcodes, self.medians, 'o', markersize=5)
-        plt.legend()
-        plt.show()
-
-    def compute_opcode_costs(self):
-        self.histogram_file = open(self.histogram_fname, 'w+')
-        self.costs_file = open(self.costs_fname, 'w+')
-        self.precalc_costs()
-        self.computer_medians()
-        if self.show_plot: self.plot()
-
-    def load_opcode_costs(self):
-        self.medians = []
-        with open(self.costs_fname) as f:
-            for line in f:
-                opcode, median = line.split(',')
-                self.medians.append(np.float(median))
-
-    def comput_cu_costs(self):
-        self.cu_costs_file = open(self.cu_costs_fname, 'w+')
-        self.cu_costs = {}
-        costs = np.array(self.medians)/self.non_zero_min_cost + 1.0 # 1.0 is padding for 0 costs
-        for opcode, m in enumerate(costs):
-            self.cu_costs[opcode] = int(np.round(m))
-            self.cu_costs_file.write('{},{}\n'.format(opcode, self.cu_costs[opcode]))
-
-    def load_cu_costs(self):
-        self.cu_costs = {}
-        with open(self.cu_costs_fname) as f:
-            for line in f:
-                opcode, cost = line.split(',')
-                self.cu_costs[int(opcode)] = int(cost)
+    def __init__(self, snippets=SNIPPETS, trials=3, number=2000, repeats=7, repetitions=10,
+                 reference=REFERENCE_OPNAMES, reference_cost=REFERENCE_COST, ridge=1e-2, solver_rounds=10,
+                 solver_sweeps=200):
+        self.snippets = snippets
+        self.trials = trials                # Independent measurements, the median cost of each opcode is used
+        self.number = number                # Executions per timing
+        self.repeats = repeats              # Timings per snippet, the median is used
+        self.repetitions = repetitions      # Copies of a snippet in its repeated version
+        self.reference = [dis.opmap[name] for name in reference if name in dis.opmap]
+        self.reference_cost = reference_cost
+        self.ridge = ridge                  # Pull towards zero, relative to how often opcodes run. Splits the cost of
+                                            # opcodes that always run together evenly instead of arbitrarily
+        self.solver_rounds = solver_rounds  # Rounds of reweighting
+        self.solver_sweeps = solver_sweeps  # Coordinate descent sweeps per round
+
+        # Snippets that could not be compiled or raised, e.g. syntax a version of Python does not have
+        self.skipped = []
+
+    def compile(self, snippet):
+        try:
+            return compile(snippet, '<estimator>', 'exec')
+        except SyntaxError:
+            return None
+
+    def count_opcodes(self, code):
+        """Opcodes an execution of the code runs, including the ones of the functions it calls into"""
+        counts = Counter()
+        trace = _opcode_counter(counts)
+
+        sys.settrace(trace)
+        try:
+            exec(code, {})
+        finally:
+            sys.settrace(None)
+
+        return counts
+
+    def time_code(self, code):
+        """Seconds per execution"""
+        timings = []
+
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for _ in range(self.repeats):
+                start = time.perf_counter()
+                for _ in range(self.number):
+                    exec(code, {})
+                timings.append((time.perf_counter() - start) / self.number)
+        finally:
+            if enabled:
+                gc.enable()
+
+        # The fastest run is the one the rest of the machine disturbed least
+        return min(timings)
+
+    def measure(self):
+        """
+        (opcode counts, seconds) of every snippet that runs, once on its own and once repeated, which tells the cost of
+        its opcodes apart from the overhead of executing a snippet
+        """
+        self.skipped = []
+
+        rows = []
+        for snippet in self.snippets:
+            codes = [self.compile(snippet), self.compile('\n'.join([snippet] * self.repetitions))]
+            if None in codes:
+                self.skipped.append(snippet)
+                continue
+
+            try:
+                measured = [(self.count_opcodes(code), self.time_code(code)) for code in codes]
+            except Exception:
+                self.skipped.append(snippet)
+                continue
+
+            rows.extend(measured)
+
+        return rows
+
+    def solve(self, rows):
+        """
+        Non negative seconds per opcode that fit the rows best, plus the overhead of a snippet under the key None.
+        Least squares by coordinate descent, reweighted so rows with large residuals count less (Huber)
+        """
+        opcodes = sorted({op for counts, _ in rows for op in counts})
+        columns = [None] + opcodes
+
+        matrix = [[1 if column is None else counts.get(column, 0) for column in columns] for counts, _ in rows]
+        y = [seconds for _, seconds in rows]
+
+        weights = [1.0] * len(rows)
+        x = [0.0] * len(columns)
+
+        for _ in range(self.solver_rounds):
+            # Normal equations of the weighted problem
+            gram = [[sum(w * row[i] * row[j] for w, row in zip(weights, matrix)) for j in range(len(columns))]
+                    for i in range(len(columns))]
+            rhs = [sum(w * row[i] * t for w, row, t in zip(weights, matrix, y)) for i in range(len(columns))]
+
+            penalty = self.ridge * statistics.median(gram[i][i] for i in range(1, len(columns)))
+            for i in range(1, len(columns)):
+                gram[i][i] += penalty
+
+            for _ in range(self.solver_sweeps):
+                for i in range(len(columns)):
+                    if gram[i][i] == 0:
+                        continue
+                    residual = rhs[i] - sum(g * v for g, v in zip(gram[i], x)) + gram[i][i] * x[i]
+                    x[i] = max(0.0, residual / gram[i][i])
+
+            residuals = [t - sum(a * v for a, v in zip(row, x)) for row, t in zip(matrix, y)]
+            scale = statistics.median(abs(r) for r in residuals) * 1.4826
+            if scale == 0:
+                break
+
+            threshold = 1.345 * scale
+            weights = [1.0 if abs(r) <= threshold else threshold / abs(r) for r in residuals]
+
+        return dict(zip(columns, x))
+
+    def cu_costs(self, seconds):
+        """Cost of every opcode byte in multiples of the reference opcode"""
+        unit = statistics.mean(seconds.get(op, 0) for op in self.reference)
+        if not unit:
+            raise ValueError('No snippet measured the reference opcodes {}'.format(
+                ', '.join(dis.opname[op] for op in self.reference)))
+
+        measured = {op: quantize(self.reference_cost * t / unit) for op, t in seconds.items() if op is not None}
+
+        ordered = sorted(measured.values())
+        unmeasured = ordered[min(len(ordered) - 1, int(len(ordered) * UNMEASURED_QUANTILE))]
+
+        return {op: measured.get(op, unmeasured) for op in range(TABLE_SIZE)}
+
+    def run(self):
+        """Cost table from the median of the seconds per opcode of several independent trials"""
+        trials = [self.solve(self.measure()) for _ in range(self.trials)]
+
+        opcodes = set().union(*trials)
+        seconds = {op: statistics.median(trial.get(op, 0) for trial in trials) for op in opcodes}
+
+        return self.cu_costs(seconds)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compute the opcode cost table of this interpreter')
+    parser.add_argument('--output', default=costs_path(), help='where to write the table')
+    parser.add_argument('--trials', type=int, default=3, help='independent measurements')
+    parser.add_argument('--number', type=int, default=2000, help='executions of a snippet per timing')
+    parser.add_argument('--repeats', type=int, default=7, help='timings per snippet')
+    args = parser.parse_args(argv)
+
+    estimator = OperationsEstimator(trials=args.trials, number=args.number, repeats=args.repeats)
+    costs = estimator.run()
+
+    write_costs(costs, args.output, comments=[
+        '{} {} ({})'.format(platform.python_implementation(), platform.python_version(),
+                            sys.implementation.cache_tag),
+        'Generated by contracting.execution.metering.estimator relative to the average of {} = {}'.format(
+            ', '.join(dis.opname[op] for op in estimator.reference), estimator.reference_cost),
+        '{} of {} snippets skipped'.format(len(estimator.skipped), len(estimator.snippets))
+    ])
+
+    print('Wrote {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
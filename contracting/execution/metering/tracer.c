@@ -10,6 +10,21 @@
 #include <stdlib.h>
 #include <string.h>
 
+/* The tracer reads frames directly, which the frame API of 3.11 no longer allows */
+#if PY_VERSION_HEX < 0x03060000 || PY_VERSION_HEX >= 0x030B0000
+#error "The tracer supports Python 3.6 to 3.10"
+#endif
+
+/* Code unit a frame is at, and its offset into co_code. f_lasti is a byte offset up to 3.9 and a code unit index
+   from 3.10 */
+#if PY_VERSION_HEX >= 0x030A0000
+#define FRAME_UNIT(frame)       ((Py_ssize_t) (frame)->f_lasti)
+#define FRAME_OFFSET(frame)     ((Py_ssize_t) (frame)->f_lasti * (Py_ssize_t) sizeof(_Py_CODEUNIT))
+#else
+#define FRAME_UNIT(frame)       ((Py_ssize_t) (frame)->f_lasti / (Py_ssize_t) sizeof(_Py_CODEUNIT))
+#define FRAME_OFFSET(frame)     ((Py_ssize_t) (frame)->f_lasti)
+#endif
+
 /* Py 2.x and 3.x compatibility */
 
 #ifndef Py_TYPE
@@ -30,41 +45,281 @@
 #define RET_OK      0
 #define RET_ERROR   -1
 
+/* Entries of a cost table, one for every value of an opcode byte. Must match contracting.execution.metering.costs */
+#define CU_COSTS_SIZE   256
+
 /* The Tracer type. */
 
-typedef struct {
+typedef struct Tracer {
     PyObject_HEAD
 
     /* Variables to keep track of metering */
-    int cu_costs[144];
+    int cu_costs[CU_COSTS_SIZE];
     unsigned int cost;
     unsigned int stamp_supplied;
     int started;
     char *cu_cost_fname;
 
+    /* Block metering. id(code) -> packed cost per code unit, or NULL to charge the first opcode of every line */
+    PyObject *tables;
+
+    /* Table of the code line events are coming from, until its frame calls into or returns to another one. Always the
+       code of a running frame, which keeps it alive, so its address can't be reused by other code meanwhile */
+    PyCodeObject *last_code;
+    PyObject *last_table;
+
+    /* Memory metering. Bytes allocated by contract code while started, not net of what it frees */
+    PyObject *contracts;            /* id(code) -> anything, for the code objects of contracts */
+    size_t memory_used;
+    size_t memory_limit;            /* Allocations past it fail, 0 for no limit */
+    unsigned int bytes_per_stamp;   /* 0 to not charge for memory */
+    int memory_exceeded;
+
 } Tracer;
 
-void read_cu_costs(char *fname, int cu_costs[]) {
+/*
+ * Memory metering
+ *
+ * While a tracer is started, the allocators of the MEM and OBJ domains are wrapped so allocations requested while a
+ * contract frame is running are counted before they happen. Every node has to charge the same for the same
+ * transaction, so only requests past pymalloc's small request threshold are metered: smaller ones may be served from
+ * free lists and pools earlier code left behind without reaching the allocator at all, and are paid for by the
+ * instructions that create them instead. Each metered request is charged its size rounded up to a whole size class.
+ *
+ * The allocation that would go past the limit fails with a MemoryError, and so does every later one the contract
+ * makes, in case the code it called swallowed the error. Frees are passed through, which is why memory is charged as
+ * allocated rather than as held.
+ */
+
+#define MEMORY_SMALL_REQUEST    512
+#define MEMORY_SIZE_CLASS       512
+
+static Tracer *memory_tracer = NULL;
+static PyMemAllocatorEx mem_allocator;
+static PyMemAllocatorEx obj_allocator;
+
+static int
+Tracer_in_contract(Tracer *self)
+{
+    PyThreadState *tstate = _PyThreadState_UncheckedGet();
+    PyObject *type, *value, *traceback;
+    PyObject *key;
+    int found = 0;
+
+    if (self->contracts == NULL || tstate == NULL || tstate->frame == NULL) {
+        return 0;
+    }
+
+    /* The key is a small request, which the hooks pass straight through. An exception the caller has set is kept */
+    PyErr_Fetch(&type, &value, &traceback);
+
+    key = PyLong_FromVoidPtr(tstate->frame->f_code);
+    if (key != NULL) {
+        found = PyDict_GetItem(self->contracts, key) != NULL;
+        Py_DECREF(key);
+    }
+
+    PyErr_Restore(type, value, traceback);
+    return found;
+}
+
+static int
+Tracer_charge_memory(size_t size)
+{
+    Tracer *self = memory_tracer;
+    size_t classes;
+
+    if (self == NULL || !self->started || size <= MEMORY_SMALL_REQUEST || !Tracer_in_contract(self)) {
+        return RET_OK;
+    }
+
+    if (self->memory_exceeded) {
+        return RET_ERROR;
+    }
+
+    classes = size / MEMORY_SIZE_CLASS + (size % MEMORY_SIZE_CLASS != 0);
+
+    if (self->memory_limit && classes > (self->memory_limit - self->memory_used) / MEMORY_SIZE_CLASS) {
+        self->memory_exceeded = 1;
+        return RET_ERROR;
+    }
+
+    if (classes > (((size_t) -1) - self->memory_used) / MEMORY_SIZE_CLASS) {
+        self->memory_used = (size_t) -1;
+    }
+    else {
+        self->memory_used += classes * MEMORY_SIZE_CLASS;
+    }
+    return RET_OK;
+}
+
+static void *
+hook_malloc(void *ctx, size_t size)
+{
+    PyMemAllocatorEx *alloc = (PyMemAllocatorEx *) ctx;
+
+    if (Tracer_charge_memory(size) != RET_OK) {
+        return NULL;
+    }
+    return alloc->malloc(alloc->ctx, size);
+}
+
+static void *
+hook_calloc(void *ctx, size_t nelem, size_t elsize)
+{
+    PyMemAllocatorEx *alloc = (PyMemAllocatorEx *) ctx;
+
+    /* An overflowing request is left to the allocator to refuse */
+    if (elsize == 0 || nelem <= ((size_t) -1) / elsize) {
+        if (Tracer_charge_memory(nelem * elsize) != RET_OK) {
+            return NULL;
+        }
+    }
+    return alloc->calloc(alloc->ctx, nelem, elsize);
+}
+
+static void *
+hook_realloc(void *ctx, void *ptr, size_t new_size)
+{
+    PyMemAllocatorEx *alloc = (PyMemAllocatorEx *) ctx;
+
+    /* The old size is not known, so a resize is charged as a new allocation */
+    if (Tracer_charge_memory(new_size) != RET_OK) {
+        return NULL;
+    }
+    return alloc->realloc(alloc->ctx, ptr, new_size);
+}
+
+static void
+hook_free(void *ctx, void *ptr)
+{
+    PyMemAllocatorEx *alloc = (PyMemAllocatorEx *) ctx;
+    alloc->free(alloc->ctx, ptr);
+}
+
+static void
+Tracer_hook_memory(Tracer *self)
+{
+    PyMemAllocatorEx hook;
+
+    self->memory_used = 0;
+    self->memory_exceeded = 0;
+
+    if (memory_tracer != NULL || (self->memory_limit == 0 && self->bytes_per_stamp == 0)) {
+        return;
+    }
+
+    hook.malloc = hook_malloc;
+    hook.calloc = hook_calloc;
+    hook.realloc = hook_realloc;
+    hook.free = hook_free;
+
+    PyMem_GetAllocator(PYMEM_DOMAIN_MEM, &mem_allocator);
+    PyMem_GetAllocator(PYMEM_DOMAIN_OBJ, &obj_allocator);
+
+    hook.ctx = &mem_allocator;
+    PyMem_SetAllocator(PYMEM_DOMAIN_MEM, &hook);
+
+    hook.ctx = &obj_allocator;
+    PyMem_SetAllocator(PYMEM_DOMAIN_OBJ, &hook);
+
+    memory_tracer = self;
+}
+
+static void
+Tracer_unhook_memory(Tracer *self)
+{
+    if (memory_tracer != self) {
+        return;
+    }
+
+    PyMem_SetAllocator(PYMEM_DOMAIN_MEM, &mem_allocator);
+    PyMem_SetAllocator(PYMEM_DOMAIN_OBJ, &obj_allocator);
+
+    memory_tracer = NULL;
+}
+
+static unsigned int
+Tracer_total_cost(Tracer *self)
+{
+    if (self->bytes_per_stamp == 0) {
+        return self->cost;
+    }
+    return self->cost + (unsigned int) (self->memory_used / self->bytes_per_stamp);
+}
+
+static int
+Tracer_check(Tracer *self)
+{
+    if (Tracer_total_cost(self) > self->stamp_supplied) {
+        PyErr_SetString(PyExc_AssertionError, "The cost has exceeded the stamp supplied!\n");
+        return RET_ERROR;
+    }
+
+    return RET_OK;
+}
+
+static int
+read_cu_costs(char *fname, int cu_costs[]) {
     FILE * fp;
     char * line = NULL;
     size_t len = 0;
     ssize_t read_bytes;
+    int entries = 0;
+    int result = RET_OK;
+
+    if (fname == NULL) {
+        PyErr_SetString(PyExc_AssertionError, "CU_COST_FNAME is not set, there is no cost table to meter with.\n");
+        return RET_ERROR;
+    }
 
     fp = fopen(fname, "r");
     if (fp == NULL) {
-        PyErr_SetString(PyExc_AssertionError, "Computational Costs file is not found due to unsuccessful install.\n");
-        exit(EXIT_FAILURE);
+        PyErr_Format(PyExc_AssertionError, "Computational Costs file %s is not found due to unsuccessful install.\n",
+                     fname);
+        return RET_ERROR;
     }
 
     while ((read_bytes = getline(&line, &len, fp)) != -1) {
-        int opcode = strtol(strtok(line, ","), NULL, 10);
-        int cost = strtol(strtok(NULL, ","), NULL, 10);
-        cu_costs[opcode] = cost;
+        char *opcode_str;
+        char *cost_str;
+        long opcode;
+
+        if (line[0] == '#' || line[0] == '\n') {
+            continue;
+        }
+
+        opcode_str = strtok(line, ",");
+        cost_str = strtok(NULL, ",");
+        if (opcode_str == NULL || cost_str == NULL) {
+            PyErr_Format(PyExc_AssertionError, "Malformed line in computational costs file %s.\n", fname);
+            result = RET_ERROR;
+            break;
+        }
+
+        opcode = strtol(opcode_str, NULL, 10);
+        if (opcode < 0 || opcode >= CU_COSTS_SIZE) {
+            PyErr_Format(PyExc_AssertionError, "Opcode %ld in computational costs file %s is out of range.\n",
+                         opcode, fname);
+            result = RET_ERROR;
+            break;
+        }
+
+        cu_costs[opcode] = strtol(cost_str, NULL, 10);
+        entries++;
+    }
+
+    if (result == RET_OK && entries != CU_COSTS_SIZE) {
+        PyErr_Format(PyExc_AssertionError, "Computational costs file %s has %d entries, the tracer meters %d.\n",
+                     fname, entries, CU_COSTS_SIZE);
+        result = RET_ERROR;
     }
 
     fclose(fp);
     if (line)
         free(line);
+
+    return result;
 }
 
 static int
@@ -73,11 +328,24 @@ Tracer_init(Tracer *self, PyObject *args, PyObject *kwds)
 
     char *fname = getenv("CU_COST_FNAME");
 
-    read_cu_costs(fname, self->cu_costs); // Read cu cu_costs from ones interpreted in Python
+    // Read cu cu_costs from ones interpreted in Python
+    if (read_cu_costs(fname, self->cu_costs) != RET_OK) {
+        return RET_ERROR;
+    }
 
     self->started = 0;
     self->cost = 0;
 
+    self->tables = NULL;
+    self->last_code = NULL;
+    self->last_table = NULL;
+
+    self->memory_used = 0;
+    self->memory_limit = 0;
+    self->bytes_per_stamp = 0;
+    self->memory_exceeded = 0;
+    self->contracts = NULL;
+
     return RET_OK;
 }
 
@@ -88,6 +356,11 @@ Tracer_dealloc(Tracer *self)
         PyEval_SetTrace(NULL, NULL);
     }
 
+    Tracer_unhook_memory(self);
+
+    Py_XDECREF(self->tables);
+    Py_XDECREF(self->contracts);
+
     Py_TYPE(self)->tp_free((PyObject*)self);
 }
 
@@ -103,6 +376,70 @@ Tracer_dealloc(Tracer *self)
 //}
 
 
+/*
+ * Block metering tables
+ */
+
+static PyObject *
+Tracer_lookup(Tracer *self, PyFrameObject *frame)
+{
+    PyObject *key;
+    PyObject *table;
+
+    key = PyLong_FromVoidPtr(frame->f_code);
+    if (key == NULL) {
+        PyErr_Clear();
+        return NULL;
+    }
+
+    /* Borrowed. The table stays registered at least as long as the code of a running frame */
+    table = PyDict_GetItem(self->tables, key);
+    Py_DECREF(key);
+
+    self->last_code = frame->f_code;
+    self->last_table = table;
+
+    return table;
+}
+
+static PyObject *
+Tracer_table(Tracer *self, PyFrameObject *frame)
+{
+    if (frame->f_code == self->last_code) {
+        return self->last_table;
+    }
+    return Tracer_lookup(self, frame);
+}
+
+static unsigned int
+Tracer_line_cost(Tracer *self, PyFrameObject *frame)
+{
+    const char * str;
+    int opcode;
+    PyObject *table;
+    Py_ssize_t unit;
+
+    if (self->tables == NULL) {
+        /* Line metering: the first opcode of the line */
+        str = PyBytes_AS_STRING(frame->f_code->co_code);
+        opcode = (unsigned char) str[FRAME_OFFSET(frame)];
+        return self->cu_costs[opcode];
+    }
+
+    table = Tracer_table(self, frame);
+    if (table == NULL) {
+        return 0;
+    }
+
+    unit = FRAME_UNIT(frame);
+    if (unit < 0 || unit >= PyBytes_GET_SIZE(table) / (Py_ssize_t) sizeof(unsigned int)) {
+        return 0;
+    }
+
+    /* Everything from this instruction up to the next line */
+    return ((const unsigned int *) PyBytes_AS_STRING(table))[unit];
+}
+
 /*
  * The Trace Function
  */
@@ -110,30 +447,36 @@ Tracer_dealloc(Tracer *self)
  static int
  Tracer_trace(Tracer *self, PyFrameObject *frame, int what, PyObject *arg)
  {
-     const char * str;
-     int opcode;
+     unsigned int cost;
 
      switch (what) {
-         // case PyTrace_CALL:      /* 0 */
-         //     printf("CALL\n");
-         //     break;
-         //
-         // case PyTrace_RETURN:    /* 3 */
-         //     printf("RETURN\n");
-         //     break;
+         case PyTrace_CALL:      /* 0 */
+             if (self->tables == NULL) {
+                 break;
+             }
+
+             /* Code without a table is not contract code. Its frame does not need to report lines at all */
+             if (Tracer_lookup(self, frame) == NULL) {
+#if PY_VERSION_HEX >= 0x030700A0
+                 frame->f_trace_lines = 0;
+#endif
+             }
+             break;
+
+         case PyTrace_RETURN:    /* 3 */
+             self->last_code = NULL;
+             self->last_table = NULL;
+             break;
 
          case PyTrace_LINE:      /* 2 */
-             // printf("LINE\n");
-             str = PyBytes_AS_STRING(frame->f_code->co_code);
-             opcode = str[frame->f_lasti];
-             if (opcode < 0) opcode = -opcode;
-             if (self->cost + self->cu_costs[opcode] > self->stamp_supplied) {
-                 PyErr_SetString(PyExc_AssertionError, "The cost has exceeded the stamp supplied!\n");
+             cost = Tracer_line_cost(self, frame);
+             self->cost += cost;
+             if (Tracer_check(self) != RET_OK) {
+                 self->cost -= cost;
                  PyEval_SetTrace(NULL, NULL);
                  self->started = 0;
                  return RET_ERROR;
              }
-             self->cost += self->cu_costs[opcode];
              break;
 
          // case PyTrace_EXCEPTION:
@@ -154,6 +497,21 @@ Tracer_start(Tracer *self, PyObject *args)
     PyEval_SetTrace((Py_tracefunc)Tracer_trace, (PyObject*)self);
     self->cost = 0;
     self->started = 1;
+
+    Tracer_hook_memory(self);
+
+    return Py_BuildValue("");
+}
+
+static PyObject *
+Tracer_start_counters(Tracer *self, PyObject *args)
+{
+    // Meter without a trace function. Contract code compiled with stamp counters calls count() instead
+    self->cost = 0;
+    self->started = 1;
+
+    Tracer_hook_memory(self);
+
     return Py_BuildValue("");
 }
 
@@ -165,6 +523,8 @@ Tracer_stop(Tracer *self, PyObject *args)
         self->started = 0;
     }
 
+    Tracer_unhook_memory(self);
+
     return Py_BuildValue("");
 }
 
@@ -181,6 +541,11 @@ Tracer_reset(Tracer *self)
     self->cost = 0;
     self->stamp_supplied = 0;
     self->started = 0;
+
+    Tracer_unhook_memory(self);
+    self->memory_used = 0;
+    self->memory_exceeded = 0;
+
     return Py_BuildValue("");
 }
 
@@ -193,8 +558,7 @@ Tracer_add_cost(Tracer *self, PyObject *args, PyObject *kwds)
     PyArg_ParseTuple(args, "i", &new_cost);
     self->cost += new_cost;
 
-    if (self->cost > self->stamp_supplied) {
-         PyErr_SetString(PyExc_AssertionError, "The cost has exceeded the stamp supplied!\n");
+    if (Tracer_check(self) != RET_OK) {
          PyEval_SetTrace(NULL, NULL);
          self->started = 0;
          return NULL;
@@ -203,10 +567,104 @@ Tracer_add_cost(Tracer *self, PyObject *args, PyObject *kwds)
     return Py_BuildValue("");
 }
 
+static PyObject *
+Tracer_count(Tracer *self, PyObject *cost)
+{
+    // Called by the stamp counters compiled into contract code, once per block. Returns True so comprehensions can
+    // call it from their conditions
+    long new_cost;
+
+    if (!self->started) {
+        Py_RETURN_TRUE;
+    }
+
+    new_cost = PyLong_AsLong(cost);
+    if (new_cost == -1 && PyErr_Occurred()) {
+        return NULL;
+    }
+
+    self->cost += new_cost;
+
+    if (Tracer_check(self) != RET_OK) {
+        self->started = 0;
+        return NULL;
+    }
+
+    Py_RETURN_TRUE;
+}
+
+static PyObject *
+Tracer_set_tables(Tracer *self, PyObject *args)
+{
+    // Tables for block metering, see contracting.execution.metering.blocks. None meters lines instead
+    PyObject *tables;
+
+    if (!PyArg_ParseTuple(args, "O", &tables)) {
+        return NULL;
+    }
+
+    if (tables != Py_None && !PyDict_Check(tables)) {
+        PyErr_SetString(PyExc_TypeError, "tables must be a dict or None");
+        return NULL;
+    }
+
+    Py_XDECREF(self->tables);
+    self->tables = NULL;
+    if (tables != Py_None) {
+        Py_INCREF(tables);
+        self->tables = tables;
+    }
+
+    self->last_code = NULL;
+    self->last_table = NULL;
+
+    return Py_BuildValue("");
+}
+
+static PyObject *
+Tracer_set_memory_limit(Tracer *self, PyObject *args)
+{
+    // Takes effect from the next start. A limit of 0 allows any amount, bytes_per_stamp of 0 charges nothing.
+    // Allocations are metered while code whose id is a key of contracts is running, see blocks.TABLES
+    Py_ssize_t limit;
+    unsigned int bytes_per_stamp;
+    PyObject *contracts;
+
+    if (!PyArg_ParseTuple(args, "nIO!", &limit, &bytes_per_stamp, &PyDict_Type, &contracts)) {
+        return NULL;
+    }
+
+    if (limit < 0) {
+        PyErr_SetString(PyExc_ValueError, "memory limit can't be negative");
+        return NULL;
+    }
+
+    self->memory_limit = (size_t) limit;
+    self->bytes_per_stamp = bytes_per_stamp;
+
+    Py_INCREF(contracts);
+    Py_XDECREF(self->contracts);
+    self->contracts = contracts;
+
+    return Py_BuildValue("");
+}
+
+static PyObject *
+Tracer_get_memory_used(Tracer *self)
+{
+    return PyLong_FromSize_t(self->memory_used);
+}
+
 static PyObject *
 Tracer_get_stamp_used(Tracer *self, PyObject *args, PyObject *kwds)
 {
-    return Py_BuildValue("i", self->cost);
+    return Py_BuildValue("I", Tracer_total_cost(self));
+}
+
+static PyObject *
+Tracer_get_table_size(Tracer *self)
+{
+    return PyLong_FromLong(CU_COSTS_SIZE);
 }
 
 static PyObject *
@@ -226,6 +684,12 @@ Tracer_methods[] = {
     { "start",      (PyCFunction) Tracer_start,         METH_VARARGS,
             PyDoc_STR("Start the tracer") },
 
+    { "start_counters",      (PyCFunction) Tracer_start_counters,         METH_VARARGS,
+            PyDoc_STR("Start metering with the stamp counters compiled into contracts instead of tracing") },
+
+    { "count",       (PyCFunction) Tracer_count,          METH_O,
+            PyDoc_STR("Add the cost of a block. Throws AssertionError if cost exceeds stamps supplied.") },
+
     { "stop",       (PyCFunction) Tracer_stop,          METH_VARARGS,
             PyDoc_STR("Stop the tracer") },
 
@@ -238,9 +702,21 @@ Tracer_methods[] = {
     { "set_stamp",  (PyCFunction) Tracer_set_stamp,     METH_VARARGS,
             PyDoc_STR("Set the stamp before starting the tracer") },
 
+    { "set_tables",  (PyCFunction) Tracer_set_tables,     METH_VARARGS,
+            PyDoc_STR("Meter with per code object cost tables instead of the first opcode of each line") },
+
     { "get_stamp_used",  (PyCFunction) Tracer_get_stamp_used,     METH_VARARGS,
             PyDoc_STR("Get the stamp usage after it's been completed") },
 
+    { "set_memory_limit",  (PyCFunction) Tracer_set_memory_limit,     METH_VARARGS,
+            PyDoc_STR("Set the bytes contract code may allocate, how many of them cost a stamp and the contract code") },
+
+    { "get_memory_used",  (PyCFunction) Tracer_get_memory_used,     METH_NOARGS,
+            PyDoc_STR("Bytes allocated by contract code since the tracer was started") },
+
+    { "get_table_size",  (PyCFunction) Tracer_get_table_size,     METH_NOARGS,
+            PyDoc_STR("Number of opcodes the cost table of the tracer has an entry for.") },
+
     { "is_started",  (PyCFunction) Tracer_is_started,     METH_VARARGS,
             PyDoc_STR("Returns 1 if tracer is started, 0 if not.") },
 
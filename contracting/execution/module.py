@@ -6,11 +6,18 @@ from importlib import invalidate_caches, __import__
 
 from ..db.driver import ContractDriver
 from ..stdlib import env
+from ..db.contract import Contract
 from ..execution.runtime import rt
-from ..db.orm import Variable, Hash
+from ..execution.metering import blocks
+from ..compilation import counters
+from ..db.orm import Datum, Variable, Hash
+from .. import config
 
-from types import ModuleType
-import marshal
+from collections import OrderedDict
+from functools import lru_cache
+from types import ModuleType, FunctionType
+import decimal
+import dis
 
 
 # This function overrides the __import__ function, which is the builtin function that is called whenever Python runs
@@ -70,36 +77,254 @@ class DatabaseFinder(MetaPathFinder):
         return DatabaseLoader()
 
 
-MODULE_CACHE = {}
+class ModuleCache:
+    """
+    LRU of contract name -> (hash of the contract's code, code object). An entry is only used while the hash matches
+    the one stored with the contract, so a contract submitted again by another process is loaded again as well.
+    """
+    def __init__(self, size=config.MODULE_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, name, version):
+        entry = self.entries.get(name)
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(name)
+        return entry[1]
+
+    def set(self, name, version, code):
+        self.pop(name)
+
+        # Metered by block while it is cached
+        blocks.register(code)
+
+        self.entries[name] = (version, code)
+        self.entries.move_to_end(name)
+
+        while len(self.entries) > self.size:
+            evicted, (_, evicted_code) = self.entries.popitem(last=False)
+            blocks.unregister(evicted_code)
+            MODULE_INSTANCES.pop(evicted, None)
+            self.evictions += 1
+
+    def pop(self, name):
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            blocks.unregister(entry[1])
+
+    def clear(self):
+        for _, code in self.entries.values():
+            blocks.unregister(code)
+        self.entries.clear()
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.entries)
+        }
+
+
+MODULE_CACHE = ModuleCache()
 CACHE = {}
 
+# Warm contract modules. Executing the body of a contract again on every transaction only re-creates the same
+# functions and ORM objects, so the scope of the first execution is kept and only the per call context (ctx, env and
+# the driver of the ORM objects) is bound again when a later transaction imports the contract
+MODULE_INSTANCES = {}
+
+# Stamps used by the contract imports that are running right now, so every body is only charged for its own code
+_IMPORT_COSTS = []
+
+IMMUTABLE_TYPES = (type(None), bool, int, float, complex, str, bytes, decimal.Decimal)
+
+# Opcodes that let a contract body read or change anything but its own names. Bodies using them are executed every time
+STATEFUL_OPS = {'LOAD_ATTR', 'LOAD_METHOD', 'STORE_ATTR', 'DELETE_ATTR', 'BINARY_SUBSCR', 'STORE_SUBSCR',
+                'DELETE_SUBSCR', 'IMPORT_FROM', 'IMPORT_STAR', 'LOAD_GLOBAL', 'STORE_GLOBAL', 'LOAD_BUILD_CLASS'}
+
+# Opcodes that let the functions of a contract change the objects its body created. Those objects are kept by a warm
+# module, so a change would be seen by the next transaction, which a cold module does not see. Items of ORM objects are
+# stored by the driver, and the body keeps nothing else that supports item assignment
+MUTATING_OPS = {'STORE_ATTR', 'DELETE_ATTR'}
+
+
+# Driver every DatabaseLoader reads contracts with, so imports reuse one connection instead of opening a new one
+LOADER_DRIVER = None
+
+
+def loader_driver():
+    global LOADER_DRIVER
+    if LOADER_DRIVER is None:
+        LOADER_DRIVER = ContractDriver()
+    return LOADER_DRIVER
+
+
+def invalidate_module(name):
+    """Forget the code and the warm instance of a contract, e.g. because it was submitted again"""
+    MODULE_CACHE.pop(name)
+    MODULE_INSTANCES.pop(name, None)
+
+
+def is_immutable(value):
+    if isinstance(value, (tuple, frozenset)):
+        return all(is_immutable(v) for v in value)
+    return isinstance(value, IMMUTABLE_TYPES)
+
+
+# Bounded like the module cache. The results hold on to the code objects, which would outlive their eviction otherwise
+@lru_cache(maxsize=config.MODULE_CACHE_SIZE)
+def reusable_body(code):
+    """
+    Whether the module level code of a contract only defines functions, ORM objects, imports and constants. Calling
+    anything else, or touching attributes and items, could read state, which would go stale in a warm module. Neither
+    may its functions set attributes, which would outlive the transaction on the objects a warm module keeps
+    """
+    for const in code.co_consts:
+        # Comprehensions and lambdas at module level run code this check does not look into
+        if hasattr(const, 'co_code') and const.co_name.startswith('<'):
+            return False
+
+    for nested in blocks.code_objects(code):
+        if nested is not code and any(i.opname in MUTATING_OPS for i in dis.get_instructions(nested)):
+            return False
+
+    for instruction in dis.get_instructions(code):
+        if instruction.opname in STATEFUL_OPS:
+            return False
+        if instruction.opname == 'LOAD_NAME' and instruction.argval not in config.ORM_CLASS_NAMES and \
+                instruction.argval != config.METER_FUNC_NAME:
+            return False
+
+    return True
+
+
+class ModuleInstance:
+    def __init__(self, code, scope, body, imports, cost):
+        self.code = code        # Code object the body was executed from
+        self.scope = scope      # Globals of the contract's functions
+        self.body = body        # Names bound by the body, without the imported contracts
+        self.imports = imports  # Name a contract was imported under -> name of the contract
+        self.cost = cost        # Stamps the body itself used, charged on every reuse. None if it was not metered
+
+    @classmethod
+    def capture(cls, code, scope, before, cost):
+        """The instance of a freshly executed body, or None if the body can't be reused safely"""
+        if not reusable_body(code):
+            return None
+
+        body = {}
+        imports = {}
+        for name, value in scope.items():
+            if name == '__builtins__' or (name in before and before[name] is value):
+                continue
+
+            if isinstance(value, ModuleType):
+                if not isinstance(getattr(value, '__loader__', None), DatabaseLoader):
+                    return None
+                imports[name] = value.__name__
+                continue
+
+            if isinstance(value, FunctionType):
+                if value.__globals__ is not scope or value.__closure__ is not None or \
+                        not is_immutable(value.__defaults__) or \
+                        not is_immutable(tuple((value.__kwdefaults__ or {}).values())):
+                    return None
+            elif isinstance(value, Hash):
+                if not is_immutable(value._default_value):
+                    return None
+            elif not isinstance(value, (Datum, Contract)) and not is_immutable(value):
+                return None
+
+            body[name] = value
+
+        if 'ctx' in body:
+            return None
+
+        return cls(code, scope, body, imports, cost)
+
+    def rebind(self, ctx, driver):
+        """Give the kept scope the context of the current call, as executing the body again would"""
+        builtins = self.scope['__builtins__']
+
+        self.scope.clear()
+        self.scope.update(env.gather())
+        self.scope.update(rt.env)
+        self.scope.update({'ctx': ctx})
+        self.scope.update({'__contract__': True})
+        self.scope.update(self.body)
+        self.scope['__builtins__'] = builtins
+
+        for value in self.body.values():
+            if isinstance(value, (Datum, Contract)):
+                value._driver = driver
+
+        # Imported while this contract is on top of rt.ctx, so the imported contracts see it as their caller
+        for name, module_name in self.imports.items():
+            self.scope[name] = importlib.import_module(module_name)
+
+        return self.scope
+
 
 class DatabaseLoader(Loader):
     def __init__(self):
-        self.d = ContractDriver()
+        self.d = loader_driver()
 
     def create_module(self, spec):
         return None
 
-    def exec_module(self, module):
-
+    @staticmethod
+    def _fetch_code(d, name):
         # fetch the individual contract
-        code = MODULE_CACHE.get(module.__name__)
+        version = d.get_contract_hash(name)
 
-        if MODULE_CACHE.get(module.__name__) is None:
-            code = self.d.get_compiled(module.__name__)
-            if code is None:
-                raise ImportError("Module {} not found".format(module.__name__))
+        # Code with stamp counters is cached apart from the stored artifact
+        instrumented = rt.mode == 'counters'
+        cached_version = (version, 'counters') if instrumented else version
 
-            code = bytes.fromhex(code)
-            code = marshal.loads(code)
-            MODULE_CACHE[module.__name__] = code
+        code = MODULE_CACHE.get(name, cached_version)
 
         if code is None:
-            raise ImportError("Module {} not found".format(module.__name__))
+            if instrumented:
+                source = d.get_contract(name)
+                code = counters.compile_source(source) if source is not None else None
+            else:
+                code = d.get_compiled(name, version)
+
+            if code is None:
+                raise ImportError("Module {} not found".format(name))
+
+            MODULE_CACHE.set(name, cached_version, code)
+
+        return code
 
-        scope = env.gather()
-        scope.update(rt.env)
+    def exec_module(self, module):
+        # A contract submitted earlier in the bag is only known to the driver of the transaction being executed until
+        # it is committed. Every other contract is read from the DB contracts are committed to
+        d = rt.env.get('__Driver')
+        if not isinstance(d, ContractDriver) or not d.is_submitted(module.__name__):
+            d = self.d
+
+        try:
+            code = self._fetch_code(d, module.__name__)
+        finally:
+            # Nothing the shared driver read is needed after the load. Kept, it would grow for the life of the process
+            if d is self.d:
+                d.reset_cache()
 
         ctx = ModuleType('context')
 
@@ -107,13 +332,46 @@ class DatabaseLoader(Loader):
         ctx.this = module.__name__
         ctx.signer = rt.ctx[0]
 
-        scope.update({'ctx': ctx})
-        scope.update({'__contract__': True})
+        metered = rt.tracer.is_started()
+        driver = rt.env.get('__Driver')
+
+        instance = MODULE_INSTANCES.get(module.__name__)
+        if instance is not None and (instance.code is not code or driver is None or
+                                     (metered and instance.cost is None)):
+            instance = None
 
         rt.ctx.append(module.__name__)
 
-        # execute the module with the std env and update the module to pass forward
-        exec(code, scope)
+        start = rt.tracer.get_stamp_used() if metered else 0
+        _IMPORT_COSTS.append(0)
+        try:
+            if instance is not None:
+                # Charged as if the body had been executed again
+                if metered:
+                    rt.tracer.add_cost(instance.cost)
+
+                scope = instance.rebind(ctx, driver)
+            else:
+                scope = env.gather()
+                scope.update(rt.env)
+
+                scope.update({'ctx': ctx})
+                scope.update({'__contract__': True})
+
+                before = dict(scope)
+
+                # execute the module with the std env and update the module to pass forward
+                exec(code, scope)
+
+                cost = None
+                if metered:
+                    cost = rt.tracer.get_stamp_used() - start - _IMPORT_COSTS[-1]
+                MODULE_INSTANCES[module.__name__] = ModuleInstance.capture(code, scope, before, cost)
+        finally:
+            _IMPORT_COSTS.pop()
+
+        if metered and _IMPORT_COSTS:
+            _IMPORT_COSTS[-1] += rt.tracer.get_stamp_used() - start
 
         # Update the module's attributes with the new scope
         vars(module).update(scope)
@@ -0,0 +1,309 @@
+from bisect import bisect_left, insort
+from collections import defaultdict
+import pickle
+
+from ..db.driver import CacheDriver
+from .pool import WriteSetDriver, WORKER, apply_write_set, driver_location, _raw, _worker_driver
+from .. import config
+
+"""
+The OptimisticExecutor runs the transactions of a bag speculatively on the workers of a TransactionPool and only
+executes again the ones whose reads turned out to be stale, in the style of Block-STM.
+
+    * Every transaction writes into a MultiVersionMemory instead of the driver. A read of transaction i returns the
+      write of the highest transaction below i, or the stored value if no transaction below i wrote the _key, and
+      remembers the version it saw: (writer, incarnation) or STORAGE.
+    * Transactions are executed in waves of `concurrency`, split in one chunk per worker. The workers get the
+      MultiVersionMemory as it is when the wave starts, pickled once for the wave and loaded once per chunk, so all
+      transactions of a wave see the writes of the waves before it.
+    * After every round, transactions are validated in bag order. One whose reads no longer resolve to the versions
+      it saw, or whose stored values differ from what the driver holds, gets a new incarnation in the next round.
+      The lowest invalid transaction always sees final state when it is executed again, so the number of rounds is
+      bounded by the size of the bag.
+    * Once everything is valid, the write sets are applied to the driver in bag order, which makes the outcome
+      identical to executing the bag serially.
+
+Unlike the TransactionPool alone, a transaction that depends on another one of the bag is executed again on the
+workers against the other's writes, instead of serially on the parent.
+"""
+
+# Version of a value that was read from the driver instead of from a transaction of the bag
+STORAGE = None
+
+
+class MultiVersionMemory:
+    def __init__(self):
+        # _key -> {writer: (incarnation, raw value)}
+        self.data = defaultdict(dict)
+
+        # _key -> sorted list of the transactions that wrote it
+        self.writers = defaultdict(list)
+
+        # transaction -> keys it wrote in its last incarnation
+        self.written = {}
+
+    def read(self, key, idx):
+        writers = self.writers.get(key)
+        if writers:
+            pos = bisect_left(writers, idx)
+            if pos > 0:
+                writer = writers[pos - 1]
+                incarnation, value = self.data[key][writer]
+                return (writer, incarnation), value
+        return STORAGE, None
+
+    def keys(self, prefix, idx):
+        """Keys starting with prefix that were written by a transaction below idx"""
+        return frozenset(k for k, writers in self.writers.items()
+                         if writers and writers[0] < idx and k.startswith(prefix))
+
+    def record(self, idx, incarnation, writes):
+        for key in self.written.get(idx, ()):
+            if key not in writes:
+                del self.data[key][idx]
+                self.writers[key].remove(idx)
+
+        for key, value in writes.items():
+            entries = self.data[key]
+            previous = entries.get(idx)
+            if previous is None:
+                insort(self.writers[key], idx)
+            elif previous[1] == value:
+                # Same value as the last incarnation. Keeping its version spares the readers a re-execution
+                continue
+            entries[idx] = (incarnation, value)
+
+        self.written[idx] = set(writes)
+
+
+class VersionedDriver(WriteSetDriver):
+    """Executes one transaction at a time against a MultiVersionMemory layered on top of a cache driver"""
+    def __init__(self, base, memory):
+        super().__init__(host=getattr(base, 'host', config.DB_URL), port=getattr(base, 'port', config.DB_PORT),
+                         db=base.db, codec=base.codec.name)
+        self.base = base
+        self.memory = memory
+        self.idx = 0
+        self.versions = {}
+
+        # Values and prefix scans read from the base driver rather than from the memory. A worker's base only sees
+        # committed state, so the parent checks them against its own driver
+        self.stored = {}
+        self.stored_scans = {}
+
+    def begin(self, idx=0):
+        super().begin()
+        self.idx = idx
+        self.versions = {}
+        self.stored = {}
+        self.stored_scans = {}
+
+    def resolve(self, key):
+        """Serve the first read of a _key from the memory, or the base driver if no transaction below wrote it"""
+        if not self.modified_keys.get(key) and key not in self.original_values:
+            version, value = self.memory.read(key, self.idx)
+            if version is STORAGE:
+                value = CacheDriver.peek(self.base, key)
+                self.stored[key] = value
+
+            self.versions.setdefault(key, version)
+
+            # Served by the cache layer like a prefetched value
+            self.original_values[key] = value
+            self.prefetched.add(key)
+
+    def get(self, key, metered=True):
+        self.resolve(key)
+        return super().get(key, metered=metered)
+
+    def is_submitted(self, name):
+        # Or by a transaction below, whose writes are in the memory
+        key = self.make_key(name, config.HASH_KEY)
+        self.resolve(key)
+        return super().is_submitted(name) or self.versions.get(key, STORAGE) is not STORAGE
+
+    def get_raw(self, key):
+        # Resolved like any read, so a contract a transaction below submitted is seen and validated
+        self.resolve(key)
+        return CacheDriver.peek(self, key)
+
+    def prefetch(self, keys):
+        # Every read already resolves in memory
+        return 0
+
+    def iter(self, prefix):
+        visible = self.memory.keys(prefix, self.idx)
+        self.scans.setdefault(prefix, visible)
+
+        keys = set(CacheDriver.iter(self.base, prefix))
+        self.stored_scans.setdefault(prefix, frozenset(_raw(k) for k in keys))
+
+        keys.update(visible)
+        keys.update(k for k in self.modified_keys if k.startswith(prefix))
+        return list(keys)
+
+
+def _worker_view(location, memory):
+    views = WORKER.setdefault('views', {})
+
+    view = views.get(location)
+    if view is None:
+        view = VersionedDriver(_worker_driver(location), memory)
+        views[location] = view
+
+    view.memory = memory
+    return view
+
+
+def _run_chunk(task):
+    chunk, location, memory, txs = task
+
+    view = _worker_view(location, pickle.loads(memory))
+    return chunk, [(tx[0], _run_versioned(view, *tx)) for tx in txs]
+
+
+def _run_versioned(view, pos, sender, contract_name, function_name, kwargs, stamps, environment):
+    view.base.begin()
+    view.begin(pos)
+
+    try:
+        outcome = WORKER['executor'].execute(sender, contract_name, function_name, kwargs, stamps=stamps,
+                                             auto_commit=False, environment=environment, driver=view)
+    except Exception as e:
+        outcome = e
+
+    _, writes, scans = view.finish()
+    result = (outcome, view.versions, writes, scans, view.stored, view.stored_scans)
+
+    # Results have to travel back through a pipe. If this one can't, the parent runs the tx itself
+    try:
+        pickle.dumps(result)
+    except Exception:
+        return None
+
+    return result
+
+
+class OptimisticExecutor:
+    def __init__(self, executor, pool, concurrency=config.OPTIMISTIC_CONCURRENCY):
+        self.executor = executor
+        self.pool = pool
+        self.concurrency = concurrency
+
+        # Totals over every bag executed, to tell how much speculation was wasted
+        self.executions = 0
+        self.transactions = 0
+        self.rounds = 0
+
+        # Executions a worker could not do or did against stored state the parent no longer has
+        self.fallbacks = 0
+
+    def run(self, view, idx, tx, environment):
+        """Execute a transaction on the parent, for the ones a worker could not hand back"""
+        view.begin(idx)
+        try:
+            outcome = self.executor.execute(tx.payload.sender, tx.contract_name, tx.func_name, tx.kwargs,
+                                            stamps=tx.payload.stampsSupplied, auto_commit=False,
+                                            environment=environment, driver=view)
+        except Exception as e:
+            # Raised again when the transaction is reached in bag order, if it still fails on valid reads
+            outcome = e
+
+        _, writes, scans = view.finish()
+        return outcome, view.versions, writes, scans, view.stored, view.stored_scans
+
+    def run_wave(self, wave, txs, memory, location, environment):
+        # The memory is the bulk of a task. It is pickled once for the wave and goes out once per chunk of it
+        payload = pickle.dumps(memory)
+
+        size = -(-len(wave) // self.pool.workers)
+        tasks = []
+        for chunk, start in enumerate(range(0, len(wave), size)):
+            chunk_txs = [(pos, txs[pos].payload.sender, txs[pos].contract_name, txs[pos].func_name, txs[pos].kwargs,
+                          txs[pos].payload.stampsSupplied, environment) for pos in wave[start:start + size]]
+            tasks.append((chunk, location, payload, chunk_txs))
+
+        executed = {}
+        for results in self.pool.map(_run_chunk, tasks).values():
+            executed.update(results)
+        return executed
+
+    def is_valid(self, memory, idx, versions, scans):
+        for key, version in versions.items():
+            if memory.read(key, idx)[0] != version:
+                return False
+
+        for prefix, keys in scans.items():
+            if memory.keys(prefix, idx) != keys:
+                return False
+
+        return True
+
+    def is_stored(self, driver, stored, stored_scans):
+        """Whether what a transaction read past the memory is what the driver holds"""
+        for key, value in stored.items():
+            if _raw(CacheDriver.peek(driver, key)) != _raw(value):
+                return False
+
+        for prefix, keys in stored_scans.items():
+            if frozenset(_raw(k) for k in CacheDriver.iter(driver, prefix)) != keys:
+                return False
+
+        return True
+
+    def execute_bag(self, bag, environment={}, driver=None):
+        txs = [tx for _, tx in bag]
+        order = [idx for idx, _ in bag]
+
+        memory = MultiVersionMemory()
+        view = VersionedDriver(driver, memory)
+        location = driver_location(driver)
+
+        incarnations = [0] * len(txs)
+        results = [None] * len(txs)
+
+        pending = list(range(len(txs)))
+        while pending:
+            self.rounds += 1
+
+            for start in range(0, len(pending), self.concurrency):
+                wave = pending[start:start + self.concurrency]
+
+                executed = self.run_wave(wave, txs, memory, location, environment)
+                for pos in wave:
+                    result = executed.get(pos)
+                    if result is None or not self.is_stored(driver, result[4], result[5]):
+                        result = self.run(view, pos, txs[pos], environment)
+                        self.fallbacks += 1
+
+                    memory.record(pos, incarnations[pos], result[2])
+                    incarnations[pos] += 1
+                    results[pos] = result
+
+                self.executions += len(wave)
+
+            # Transactions below the lowest one executed this round read nothing that changed
+            pending = [pos for pos in range(pending[0], len(txs))
+                       if not self.is_valid(memory, pos, results[pos][1], results[pos][3])]
+
+        self.transactions += len(txs)
+
+        response_obj = {}
+        for pos, idx in enumerate(order):
+            outcome, versions, writes, _, _, _ = results[pos]
+            if isinstance(outcome, Exception):
+                raise outcome
+
+            apply_write_set(driver, writes, reads=versions, commit=self.executor.metering)
+            response_obj[idx] = outcome
+
+        return response_obj
+
+    def stats(self):
+        return {
+            'concurrency': self.concurrency,
+            'rounds': self.rounds,
+            'executions': self.executions,
+            'fallbacks': self.fallbacks,
+            'transactions': self.transactions
+        }
@@ -0,0 +1,224 @@
+import multiprocessing.pool
+import pickle
+
+# Imported up front rather than lazily by the pool because sandboxes may uninstall the import machinery of this process
+import multiprocessing.popen_fork
+import multiprocessing.queues
+import multiprocessing.synchronize
+
+from ..db.driver import ContractDriver, CacheDriver
+from .. import config
+
+"""
+The TransactionPool executes the transactions of a bag on several processes at once.
+
+    ----------                       ------------
+    | Parent |  --- bag of txs --->  | Worker 1 |  executes tx 0, 3, 6 ... speculatively
+    ----------                       | Worker 2 |  executes tx 1, 4, 7 ...
+        ^                            | Worker N |  ...
+        |                            ------------
+        |                                 |
+        ---- (result, read set, write set) per tx
+
+    * Every worker keeps its own database connection and its own warm module cache for its whole life.
+    * A worker runs each transaction on an empty cache, so it only sees committed state, and hands back the raw
+      values it read and the raw values it wrote instead of touching the database.
+    * The parent walks the results in bag order. A transaction whose read set still matches what the parent sees
+      at that point would have produced exactly the same writes if it had run serially, so its write set is applied
+      as is. Otherwise the transaction is executed again serially on the parent. The outcome is always identical to
+      executing the bag serially.
+"""
+
+
+class WriteSetDriver(ContractDriver):
+    """Never writes to the database. Commits are captured in the read and write sets handed back to the parent"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reads = {}
+        self.writes = {}
+        self.scans = {}
+
+    def begin(self):
+        self.reset_cache()
+        self.clear_decoded()
+        self.reads = {}
+        self.writes = {}
+        self.scans = {}
+
+    def iter(self, prefix):
+        # Remember which stored keys a prefix scan saw. The parent sees the keys earlier transactions of the bag
+        # created as well, so the scan is only valid if both agree
+        if prefix not in self.scans:
+            self.scans[prefix] = frozenset(_raw(k) for k in super(CacheDriver, self).iter(prefix=prefix))
+        return super().iter(prefix)
+
+    def is_submitted(self, name):
+        # Loading a contract stored before the bag is a read of its hash like any other. The parent sees a contract
+        # submitted earlier in the bag instead, so the transaction is executed again there
+        submitted = super().is_submitted(name)
+        if not submitted:
+            self.get_raw(self.make_key(name, config.HASH_KEY))
+        return submitted
+
+    def get_raw(self, key):
+        value = super().get_raw(key)
+        if not self.modified_keys.get(key):
+            self.reads.setdefault(key, value)
+        return value
+
+    def _capture(self):
+        for key, value in self.original_values.items():
+            self.reads.setdefault(key, value)
+
+        for key, locations in self.modified_keys.items():
+            if locations:
+                self.writes[key] = self.contract_modifications[locations[-1]][key]
+
+    def commit(self):
+        self._capture()
+        self.reset_cache()
+
+    def finish(self):
+        self._capture()
+        return self.reads, self.writes, self.scans
+
+
+# Per process state of a worker. Set up once by _init_worker and reused for every transaction it runs
+WORKER = {}
+
+
+def _init_worker(metering, currency_contract, balances_hash, metering_mode=None):
+    # Imported here since the executor module imports this one
+    from .executor import Executor
+
+    WORKER['drivers'] = {}
+    WORKER['executor'] = Executor(metering=metering, currency_contract=currency_contract,
+                                  balances_hash=balances_hash, workers=0, metering_mode=metering_mode)
+
+
+def driver_location(driver):
+    """What a worker needs to open its own connection to the database of a driver"""
+    return (getattr(driver, 'host', config.DB_URL), getattr(driver, 'port', config.DB_PORT), driver.db,
+            driver.codec.name)
+
+
+def _worker_driver(location):
+    driver = WORKER['drivers'].get(location)
+    if driver is None:
+        host, port, db, codec = location
+        driver = WriteSetDriver(host=host, port=port, db=db, codec=codec)
+        WORKER['drivers'][location] = driver
+    return driver
+
+
+def _run_tx(task):
+    idx, location, sender, contract_name, function_name, kwargs, stamps, environment = task
+
+    driver = _worker_driver(location)
+    driver.begin()
+
+    try:
+        status_code, result, stamps_used = WORKER['executor'].execute(sender, contract_name, function_name, kwargs,
+                                                                      stamps=stamps, auto_commit=False,
+                                                                      environment=environment, driver=driver)
+        reads, writes, scans = driver.finish()
+
+        # Results have to travel back through a pipe. If this one can't, the parent runs the tx itself
+        pickle.dumps(result)
+    except Exception:
+        return idx, None
+
+    return idx, (status_code, result, stamps_used, reads, writes, scans)
+
+
+def apply_write_set(driver, writes, reads=(), commit=False):
+    """Write the raw values of one transaction to a cache driver as if it had been executed on it"""
+    driver.replay(writes, reads=reads)
+
+    # Mirror the stamp deduction of a serial execution, which commits after every transaction
+    if commit:
+        driver.commit()
+
+
+def _raw(value):
+    if isinstance(value, str):
+        return value.encode()
+    return value
+
+
+class TransactionPool:
+    def __init__(self, executor, workers):
+        self.executor = executor
+        self.workers = workers
+        self.pool = None
+
+        # Number of transactions whose speculative result was used / had to be executed again on the parent
+        self.applied = 0
+        self.reexecuted = 0
+
+    def _lazy_instantiate(self):
+        if self.pool is None:
+            self.pool = multiprocessing.pool.Pool(processes=self.workers, initializer=_init_worker,
+                                                  initargs=(self.executor.metering, self.executor.currency_contract,
+                                                            self.executor.balances_hash,
+                                                            self.executor.metering_mode))
+
+    def terminate(self):
+        if self.pool is not None:
+            self.pool.terminate()
+        self.pool = None
+
+    def is_valid(self, driver, reads, scans={}):
+        driver.prefetch(reads.keys())
+        for key, value in reads.items():
+            if _raw(CacheDriver.get(driver, key)) != _raw(value):
+                return False
+
+        for prefix, keys in scans.items():
+            if frozenset(_raw(k) for k in CacheDriver.iter(driver, prefix)) != keys:
+                return False
+
+        return True
+
+    def apply(self, driver, writes, reads=()):
+        apply_write_set(driver, writes, reads=reads, commit=self.executor.metering)
+
+    def map(self, func, tasks):
+        """Run func on the workers for every task, whose first item is its index. Returns index -> result"""
+        self._lazy_instantiate()
+
+        chunksize = max(1, len(tasks) // (self.workers * 4))
+        return dict(self.pool.imap_unordered(func, tasks, chunksize=chunksize))
+
+    def execute_bag(self, bag, environment={}, driver=None):
+        location = driver_location(driver)
+
+        tasks = [(idx, location, tx.payload.sender, tx.contract_name, tx.func_name, tx.kwargs,
+                  tx.payload.stampsSupplied, environment) for idx, tx in bag]
+
+        speculative = self.map(_run_tx, tasks)
+
+        response_obj = {}
+        for idx, tx in bag:
+            outcome = speculative[idx]
+
+            if outcome is not None and self.is_valid(driver, outcome[3], outcome[5]):
+                status_code, result, stamps_used, reads, writes, _ = outcome
+                self.apply(driver, writes, reads=reads)
+                response_obj[idx] = (status_code, result, stamps_used)
+                self.applied += 1
+            else:
+                response_obj[idx] = self.executor.execute(tx.payload.sender, tx.contract_name, tx.func_name,
+                                                          tx.kwargs, stamps=tx.payload.stampsSupplied,
+                                                          auto_commit=False, environment=environment,
+                                                          driver=driver)
+                self.reexecuted += 1
+
+        return response_obj
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'applied': self.applied,
+            'reexecuted': self.reexecuted
+        }
@@ -0,0 +1,103 @@
+from collections import defaultdict
+from .. import config
+
+SENDER = 0
+KWARG = 1
+LITERAL = 2
+
+# Upper bound of remembered key patterns per contract function so odd transactions cannot grow this forever
+MAX_PATTERNS_PER_FUNCTION = 64
+
+# Number of executions of a contract function to learn from. After that its patterns are considered stable
+OBSERVATIONS_PER_FUNCTION = 16
+
+
+class Prefetcher:
+    """
+    Guesses the keys a transaction bag is going to read so they can be fetched from the DB in one bulk call
+    before execution starts.
+
+    Keys are derived from the stamp balance check of each sender and from the access patterns previously seen
+    for the same contract function. A pattern is a key where each hash dimension is remembered either as the
+    sender, as one of the kwargs, or as a literal, i.e. erc20.balances:stu with sender 'stu' becomes
+    erc20.balances:<sender>.
+    """
+    def __init__(self, currency_contract='currency', balances_hash='balances'):
+        self.currency_contract = currency_contract
+        self.balances_hash = balances_hash
+
+        self.patterns = defaultdict(set)
+        self.observations = defaultdict(int)
+
+    def balance_key(self, sender):
+        return '{}{}{}{}{}'.format(self.currency_contract,
+                                   config.INDEX_SEPARATOR,
+                                   self.balances_hash,
+                                   config.DELIMITER,
+                                   sender)
+
+    @staticmethod
+    def to_pattern(key, sender, kwargs):
+        parts = key.split(config.DELIMITER)
+        kwarg_values = {str(v): k for k, v in kwargs.items()}
+
+        pattern = [parts[0]]
+        for part in parts[1:]:
+            if part == sender:
+                pattern.append((SENDER, None))
+            elif part in kwarg_values:
+                pattern.append((KWARG, kwarg_values[part]))
+            else:
+                pattern.append((LITERAL, part))
+
+        return tuple(pattern)
+
+    @staticmethod
+    def from_pattern(pattern, sender, kwargs):
+        parts = [pattern[0]]
+        for kind, value in pattern[1:]:
+            if kind == SENDER:
+                parts.append(sender)
+            elif kind == KWARG:
+                if value not in kwargs:
+                    return None
+                parts.append(str(kwargs[value]))
+            else:
+                parts.append(value)
+
+        return config.DELIMITER.join(parts)
+
+    def keys_for_tx(self, sender, contract_name, function_name, kwargs, metering=True):
+        keys = set()
+        if metering:
+            keys.add(self.balance_key(sender))
+
+        for pattern in self.patterns.get((contract_name, function_name), ()):
+            key = self.from_pattern(pattern, sender, kwargs)
+            if key is not None:
+                keys.add(key)
+
+        return keys
+
+    def keys_for_bag(self, bag, metering=True):
+        keys = set()
+        for _, tx in bag:
+            keys.update(self.keys_for_tx(tx.payload.sender, tx.contract_name, tx.func_name, tx.kwargs,
+                                         metering=metering))
+        return keys
+
+    def wants(self, contract_name, function_name):
+        return self.observations[(contract_name, function_name)] < OBSERVATIONS_PER_FUNCTION
+
+    def observe(self, sender, contract_name, function_name, kwargs, keys):
+        """
+        Learn from the keys a transaction actually touched so that later calls to the same function get them
+        prefetched too.
+        """
+        self.observations[(contract_name, function_name)] += 1
+
+        patterns = self.patterns[(contract_name, function_name)]
+        for key in keys:
+            if len(patterns) >= MAX_PATTERNS_PER_FUNCTION:
+                break
+            patterns.add(self.to_pattern(key, sender, kwargs))
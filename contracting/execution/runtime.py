@@ -1,14 +1,16 @@
 from collections import deque
 import sys
 from .. import config
-import contracting
+from ..exceptions import CostTableMismatch
 import os
 from .metering.tracer import Tracer
+from .metering import blocks, costs
 
 
 class Runtime:
-    cu_path = contracting.__path__[0]
-    cu_path = os.path.join(cu_path, 'execution', 'metering', 'cu_costs.const')
+    # Fails loudly if the running interpreter has no cost table of its own
+    cu_path = costs.costs_path()
+    costs.load_costs(cu_path)
 
     os.environ['CU_COST_FNAME'] = cu_path
 
@@ -20,14 +22,26 @@ class Runtime:
     env = {}
     stamps = 0
 
+    # How the last transaction was metered, see config.METERING. Contracts are loaded for this mode
+    mode = config.METERING
+
     tracer = Tracer()
+    if tracer.get_table_size() != costs.TABLE_SIZE:
+        raise CostTableMismatch(path=cu_path, size=costs.TABLE_SIZE, expected=tracer.get_table_size())
 
     @classmethod
-    def set_up(cls, stmps, meter):
+    def set_up(cls, stmps, meter, mode=None):
+        cls.mode = mode or config.METERING
+
         if meter:
             cls.stamps = stmps
             cls.tracer.set_stamp(stmps)
-            cls.tracer.start()
+            cls.tracer.set_memory_limit(config.MEMORY_LIMIT, config.MEMORY_BYTES_PER_STAMP, blocks.TABLES)
+            if cls.mode == 'counters':
+                cls.tracer.start_counters()
+            else:
+                cls.tracer.set_tables(blocks.tables(cls.mode))
+                cls.tracer.start()
 
     @classmethod
     def clean_up(cls):
@@ -0,0 +1,7 @@
+from ...execution.runtime import rt
+from ... import config
+
+# Called by contract code compiled with stamp counters. Contracts can't name it themselves since it starts with '_'
+exports = {
+    config.METER_FUNC_NAME: rt.tracer.count
+}
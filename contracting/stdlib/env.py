@@ -2,6 +2,7 @@ from .bridge.orm import exports as orm_exports
 from .bridge.hashing import exports as hash_exports
 from .bridge.time import exports as time_exports
 from .bridge.random import exports as random_exports
+from .bridge.metering import exports as metering_exports
 
 # TODO create a module instead and return it inside of a dictionary like:
 # {
@@ -17,5 +18,6 @@ def gather():
     env.update(hash_exports)
     env.update(time_exports)
     env.update(random_exports)
+    env.update(metering_exports)
 
     return env
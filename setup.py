@@ -19,6 +19,13 @@ requirements = [
     'astor==0.7.1'
 ]
 
+# Optional backends, e.g. pip install contracting[lmdb]. Their imports are guarded and only the DB_TYPE or CODEC that
+# uses one needs it installed
+extras = {
+    'lmdb': ['lmdb'],
+    'msgpack': ['msgpack'],
+}
+
 ext_errors = (CCompilerError, DistutilsExecError, DistutilsPlatformError)
 
 
@@ -57,6 +64,7 @@ setup(
     description='Python-based smart contract language and interpreter.',
     packages=find_packages(),
     install_requires=requirements,
+    extras_require=extras,
     url='https://github.com/Lamden/contracting',
     author='Lamden',
     author_email='team@lamden.io',
@@ -67,6 +67,22 @@ def d():
 
         self.assertEqual(self.d.get_contract('stubucks'), new_code)
 
+    def test_submission_stores_code_compiled_from_the_tree(self):
+        e = Executor(metering=False)
+
+        code = '''@export
+def d():
+    return 1
+'''
+
+        e.execute(**TEST_SUBMISSION_KWARGS, kwargs={'name': 'stubucks', 'code': code})
+
+        _, code_obj = self.compiler.parse_to_artifacts(code)
+        compiled = self.d.get_compiled('stubucks', self.d.get_contract_hash('stubucks'))
+
+        self.assertEqual(compiled.co_code, code_obj.co_code)
+        self.assertEqual(compiled.co_firstlineno, code_obj.co_firstlineno)
+
     def test_submission_then_function_call(self):
         e = Executor(metering=False)
 
@@ -23,6 +23,25 @@ v = Variable()
 
         self.assertEqual(v._key, '__main__.v')
 
+    def test_parse_to_artifacts_matches_parse_to_code(self):
+        code = '''
+v = Variable()
+
+@export
+def get():
+    return v.get()
+'''
+        c = ContractingCompiler()
+        source, code_obj = c.parse_to_artifacts(code, lint=False)
+
+        self.assertEqual(source, c.parse_to_code(code, lint=False))
+
+        scope = env.gather()
+        exec(code_obj, scope)
+
+        self.assertEqual(scope['__v']._key, '__main__.v')
+        self.assertIn('get', scope)
+
     def test_visit_assign_foreign_variable(self):
         code = '''
 fv = ForeignVariable(foreign_contract='scoob', foreign_name='kumbucha')
@@ -0,0 +1,92 @@
+import secrets
+import datetime
+from contracting.db.driver import ContractDriver
+from contracting.execution.executor import Executor
+from contracting import config
+
+# Transfers per second of erc20_clone with line metering, block metering, stamp counters and no metering at all, and
+# with block metering again without memory metering. Run from this directory, like prof_transfer.py
+
+TRANSFERS = 2000
+
+
+def submission_kwargs_for_file(f):
+    # Get the file name only by splitting off directories
+    split = f.split('/')
+    split = split[-1]
+
+    # Now split off the .s
+    split = split.split('.')
+    contract_name = split[0]
+
+    with open(f) as file:
+        contract_code = file.read()
+
+    return {
+        'name': contract_name,
+        'code': contract_code,
+    }
+
+
+TEST_SUBMISSION_KWARGS = {
+    'sender': 'stu',
+    'contract_name': 'submission',
+    'function_name': 'submit_contract'
+}
+
+
+def set_up():
+    d = ContractDriver()
+    d.flush()
+
+    with open('../../contracting/contracts/submission.s.py') as f:
+        contract = f.read()
+
+    d.set_contract(name='submission',
+                   code=contract,
+                   author='sys')
+
+    # Stamps are paid from the currency contract's balances
+    d.set('currency.balances{}stu'.format(config.DELIMITER), 1000000)
+    d.commit()
+
+    e = Executor(metering=False)
+    e.execute(**TEST_SUBMISSION_KWARGS,
+              kwargs=submission_kwargs_for_file('../integration/test_contracts/erc20_clone.s.py'))
+
+    return d
+
+
+def run(metering, mode, label=None):
+    e = Executor(metering=metering, metering_mode=mode)
+    recipients = [secrets.token_hex(16) for _ in range(TRANSFERS)]
+
+    stamps = 0
+    now = datetime.datetime.now()
+    for r in recipients:
+        _, _, used = e.execute(sender='stu',
+                               contract_name='erc20_clone',
+                               function_name='transfer',
+                               kwargs={
+                                   'amount': 1,
+                                   'to': r
+                               })
+        stamps += used
+    elapsed = (datetime.datetime.now() - now).total_seconds()
+
+    print('{:>10} {:>10.0f} tx/s {:>10.1f} stamps/tx'.format(label or (mode if metering else 'off'),
+                                                            TRANSFERS / elapsed, stamps / TRANSFERS))
+
+
+d = set_up()
+
+run(False, config.METERING)
+run(True, 'lines')
+run(True, 'blocks')
+run(True, 'counters')
+
+config.MEMORY_LIMIT = 0
+config.MEMORY_BYTES_PER_STAMP = 0
+run(True, 'blocks', label='no memory')
+
+d.flush()
@@ -1,5 +1,5 @@
 from unittest import TestCase
-from contracting.db.driver import CacheDriver
+from contracting.db.driver import CacheDriver, STORAGE
 from collections import deque, defaultdict
 
 
@@ -188,4 +188,182 @@ class TestCacheDriver(TestCase):
         self.assertEqual(self.c.get('stu'), 'farm')
         self.assertEqual(self.c.get('col'), 'orb')
         self.assertEqual(self.c.get('raghu'), 'tes')
-        self.assertEqual(self.c.get('new'), None)
\ No newline at end of file
+        self.assertEqual(self.c.get('new'), None)
+
+    def test_commit_deletes_null_keys(self):
+        self.c.conn.set('stu', 'farm')
+
+        self.c.set('stu', 'null')
+        self.c.set('col', 'bro')
+
+        self.c.commit()
+
+        self.assertIsNone(self.c.conn.get('stu'))
+        self.assertEqual(self.c.conn.get('col'), b'bro')
+
+    def test_commit_after_full_revert_of_key_skips_it(self):
+        self.c.set('stu', 'farm')
+
+        self.c.new_tx()
+
+        self.c.set('col', 'bro')
+
+        self.c.revert(1)
+        self.c.commit()
+
+        self.assertEqual(self.c.conn.get('stu'), b'farm')
+        self.assertIsNone(self.c.conn.get('col'))
+
+    def test_prefetch_warms_original_values(self):
+        self.c.conn.set('stu', 'farm')
+
+        fetched = self.c.prefetch(['stu', 'col'])
+
+        self.assertEqual(fetched, 2)
+        self.assertDictEqual(self.c.original_values, {'stu': b'farm', 'col': None})
+
+        # Served from memory from now on
+        self.c.conn.set('stu', 'changed')
+        self.assertEqual(self.c.get('stu'), b'farm')
+
+    def test_prefetch_skips_modified_and_known_keys(self):
+        self.c.set('stu', 'farm')
+        self.c.get('col')
+
+        self.assertEqual(self.c.prefetch(['stu', 'col', 'raghu']), 1)
+        self.assertEqual(self.c.get('stu'), 'farm')
+
+    def test_take_cache_moves_without_copying(self):
+        other = CacheDriver()
+        other.set('stu', 'farm')
+        other.get('col')
+
+        mods = other.contract_modifications
+
+        self.c.take_cache(other)
+
+        self.assertIs(self.c.contract_modifications, mods)
+        self.assertEqual(self.c.get('stu'), 'farm')
+        self.assertIn('col', self.c.original_values)
+
+        self.assertDictEqual(other.modified_keys, {})
+        self.assertListEqual(other.contract_modifications, [{}])
+        self.assertDictEqual(other.original_values, {})
+
+    def test_revert_leaves_empty_current_tx_and_forgets_keys(self):
+        self.c.set('stu', 'farm')
+
+        self.c.new_tx()
+
+        self.c.set('col', 'bro')
+        self.c.set('stu', 'tes')
+
+        self.c.new_tx()
+
+        self.c.set('col', 'orb')
+
+        self.c.revert(1)
+
+        self.assertEqual(len(self.c.contract_modifications), 2)
+        self.assertDictEqual(self.c.contract_modifications[-1], {})
+        self.assertDictEqual(self.c.modified_keys, dict_to_default_dict({'stu': [0]}))
+
+    def test_set_same_key_twice_in_tx_has_one_location(self):
+        self.c.set('stu', 'farm')
+        self.c.set('stu', 'tes')
+
+        self.assertDictEqual(self.c.modified_keys, dict_to_default_dict({'stu': [0]}))
+
+    def test_rollback_to_savepoint(self):
+        self.c.set('stu', 'farm')
+
+        self.c.new_tx()
+
+        self.c.set('col', 'bro')
+
+        sp = self.c.savepoint()
+
+        self.c.set('col', 'orb')
+        self.c.set('stu', 'tes')
+        self.c.set('new', '1')
+
+        self.c.rollback(sp)
+
+        self.assertEqual(self.c.get('col'), 'bro')
+        self.assertEqual(self.c.get('stu'), 'farm')
+        self.assertEqual(self.c.get('new'), None)
+        self.assertDictEqual(self.c.modified_keys, dict_to_default_dict({'stu': [0], 'col': [1]}))
+
+    def test_rollback_savepoint_from_other_tx_fails(self):
+        sp = self.c.savepoint()
+
+        self.c.new_tx()
+
+        with self.assertRaises(AssertionError):
+            self.c.rollback(sp)
+
+    def test_read_log_follows_transactions(self):
+        self.c.get('a')
+        self.c.set('b', '1')
+        self.c.get('b')
+        self.c.get('a')
+
+        self.c.new_tx()
+
+        self.c.get('b')
+        self.c.set('c', '1')
+        self.c.get('c')
+
+        self.assertEqual(self.c.read_log.reads(0), [('a', STORAGE)])
+        self.assertEqual(self.c.read_log.reads(1), [('b', 0)])
+        self.assertEqual(self.c.read_log.keys_read(1), {'b'})
+
+    def test_read_log_first_reader_and_readers(self):
+        self.c.get('a')
+        self.c.new_tx()
+        self.c.get('b')
+        self.c.new_tx()
+        self.c.get('a')
+
+        self.assertEqual(self.c.read_log.first_reader({'b', 'c'}), 1)
+        self.assertEqual(self.c.read_log.first_reader({'c'}), None)
+        self.assertEqual(self.c.read_log.readers('a'), [0, 2])
+
+    def test_revert_truncates_read_log(self):
+        self.c.get('a')
+        self.c.new_tx()
+        self.c.get('b')
+        self.c.new_tx()
+        self.c.get('c')
+
+        self.c.revert(1)
+
+        self.assertEqual(len(self.c.read_log), 2)
+        self.assertEqual(self.c.read_log.reads(0), [('a', STORAGE)])
+        self.assertEqual(self.c.read_log.reads(1), [])
+
+    def test_take_cache_moves_read_log(self):
+        other = CacheDriver()
+        other.get('a')
+        log = other.read_log
+
+        self.c.take_cache(other)
+
+        self.assertIs(self.c.read_log, log)
+        self.assertEqual(other.read_log.reads(0), [])
+
+    def test_peek_does_not_record_a_read(self):
+        self.c.peek('a')
+
+        self.assertEqual(self.c.read_log.reads(0), [])
+
+    def test_replay_records_writes_and_reads(self):
+        self.c.set('b', '2')
+        self.c.new_tx()
+
+        self.c.replay({'a': '1'}, reads={'b'})
+
+        self.assertEqual(self.c.get('a'), '1')
+        self.assertEqual(self.c.contract_modifications[1], {'a': '1'})
+        self.assertEqual(self.c.read_log.reads(1), [('b', 0)])
+        self.assertEqual(len(self.c.contract_modifications), 3)
@@ -0,0 +1,81 @@
+from unittest import TestCase
+from contracting.execution.metering import blocks
+from contracting import config
+import dis
+
+source = '''
+a = 1
+b = 2
+
+def f(x):
+    return x + a
+'''
+
+
+class TestLineCosts(TestCase):
+    def setUp(self):
+        self.code = compile(source, '', 'exec')
+
+    def test_one_entry_per_code_unit(self):
+        table = blocks.line_costs(self.code, {})
+        self.assertEqual(len(table), len(self.code.co_code) // blocks.CODE_UNIT)
+
+    def test_line_start_charges_every_instruction_of_the_line(self):
+        costs = {op: 1 for op in range(256)}
+        table = blocks.line_costs(self.code, costs)
+
+        starts = sorted(offset // blocks.CODE_UNIT for offset, _ in dis.findlinestarts(self.code))
+        ends = starts[1:] + [len(table)]
+
+        for start, end in zip(starts, ends):
+            self.assertEqual(table[start], end - start)
+
+    def test_whole_code_is_charged_once(self):
+        costs = {op: 1 for op in range(256)}
+        table = blocks.line_costs(self.code, costs)
+
+        starts = {offset // blocks.CODE_UNIT for offset, _ in dis.findlinestarts(self.code)}
+        self.assertEqual(sum(table[i] for i in starts), len(table))
+
+    def test_unknown_opcodes_are_free(self):
+        self.assertEqual(sum(blocks.line_costs(self.code, {})), 0)
+
+
+class TestRegister(TestCase):
+    def setUp(self):
+        self.code = compile(source, '', 'exec')
+
+    def tearDown(self):
+        blocks.unregister(self.code)
+
+    def test_register_adds_nested_code(self):
+        blocks.register(self.code)
+
+        for c in blocks.code_objects(self.code):
+            self.assertIn(id(c), blocks.TABLES)
+
+        self.assertEqual(len(list(blocks.code_objects(self.code))), 2)
+
+    def test_unregister_removes_tables(self):
+        blocks.register(self.code)
+        blocks.unregister(self.code)
+
+        for c in blocks.code_objects(self.code):
+            self.assertNotIn(id(c), blocks.TABLES)
+
+    def test_unregister_other_code_leaves_tables(self):
+        blocks.register(self.code)
+        blocks.unregister(compile(source, '', 'exec'))
+
+        self.assertIn(id(self.code), blocks.TABLES)
+
+    def test_tables_is_none_when_metering_lines(self):
+        metering = config.METERING
+        try:
+            config.METERING = 'lines'
+            self.assertIsNone(blocks.tables())
+
+            config.METERING = 'blocks'
+            self.assertIs(blocks.tables(), blocks.TABLES)
+        finally:
+            config.METERING = metering
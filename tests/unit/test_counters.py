@@ -0,0 +1,135 @@
+from unittest import TestCase
+import ast
+import sys
+from contracting import config
+from contracting.compilation import counters
+from contracting.compilation.compiler import ContractingCompiler
+from contracting.db.driver import ContractDriver
+from contracting.execution.executor import Executor
+from contracting.execution.module import DatabaseFinder
+from contracting.execution.runtime import rt
+
+
+class CountStub:
+    def __init__(self):
+        self.costs = []
+
+    def __call__(self, cost):
+        self.costs.append(cost)
+        return True
+
+
+def run(source):
+    meter = CountStub()
+    scope = {config.METER_FUNC_NAME: meter}
+    exec(counters.compile_source(source), scope)
+    return meter, scope
+
+
+class TestStampCounter(TestCase):
+    def test_module_body_is_charged_once(self):
+        meter, scope = run('a = 1\nb = a + 2\n')
+
+        self.assertEqual(len(meter.costs), 1)
+        self.assertEqual(scope['b'], 3)
+
+    def test_function_entry_is_charged_per_call(self):
+        meter, scope = run('def f(x):\n    return x + 1\n')
+        module_costs = len(meter.costs)
+
+        scope['f'](1)
+        scope['f'](2)
+
+        self.assertEqual(len(meter.costs), module_costs + 2)
+        self.assertEqual(meter.costs[-1], meter.costs[-2])
+
+    def test_loops_are_charged_per_iteration(self):
+        meter, scope = run('t = 0\nfor i in range(10):\n    t += i\n')
+        self.assertEqual(len(meter.costs), 1 + 10)
+        self.assertEqual(scope['t'], 45)
+
+        meter, scope = run('i = 0\nwhile i < 5:\n    i += 1\n')
+        self.assertEqual(len(meter.costs), 1 + 5)
+
+    def test_comprehensions_are_charged_per_iteration(self):
+        meter, scope = run('l = [x * y for x in range(3) for y in range(4) if y]\n')
+
+        self.assertEqual(len(meter.costs), 1 + 3 + 3 * 4)
+        self.assertEqual(scope['l'], [x * y for x in range(3) for y in range(4) if y])
+
+    def test_if_charges_most_expensive_branch(self):
+        cheap = counters.StampCounter(node_cost=1)
+        tree = ast.parse('if a:\n    b = 1\nelse:\n    b = c + d + e\n')
+
+        branch = cheap.block_cost(ast.parse('b = c + d + e').body)
+        self.assertEqual(cheap.block_cost(tree.body), 1 + cheap.expression_cost(tree.body[0].test) + branch)
+
+    def test_docstring_stays_first(self):
+        meter, scope = run('def f():\n    """doc"""\n    return 1\n')
+        self.assertEqual(scope['f'].__doc__, 'doc')
+
+    def test_compiler_instruments_transformed_tree(self):
+        compiler = ContractingCompiler(counters=True)
+        code = compiler.parse_to_code('@export\ndef f():\n    return 1\n', lint=False)
+
+        self.assertIn(config.METER_FUNC_NAME, code)
+        self.assertIn('def f', code)
+
+        self.assertNotIn(config.METER_FUNC_NAME, ContractingCompiler().parse_to_code('x = 1\n', lint=False))
+
+
+loop = '''
+v = Variable()
+
+@export
+def spin(n):
+    t = 0
+    for i in range(n):
+        t += i
+    v.set(t)
+    return t
+
+@export
+def forever():
+    while True:
+        pass
+'''
+
+driver = ContractDriver(db=0)
+
+
+class TestCountersExecution(TestCase):
+    def setUp(self):
+        sys.meta_path.append(DatabaseFinder)
+        driver.flush()
+
+        compiler = ContractingCompiler(module_name='loop')
+        driver.set_contract(name='loop', code=compiler.parse_to_code(loop, lint=False), author='unittest')
+        driver.set('currency.balances{}unittest'.format(config.DELIMITER), 1000)
+        driver.commit()
+
+        self.e = Executor(metering=True, metering_mode='counters', workers=0)
+
+    def tearDown(self):
+        sys.meta_path.remove(DatabaseFinder)
+        driver.flush()
+        rt.mode = config.METERING
+
+    def test_stamps_grow_with_iterations(self):
+        # Loads the contract, which costs stamps of its own
+        self.e.execute('unittest', 'loop', 'spin', {'n': 1}, stamps=100000)
+
+        status, result, few = self.e.execute('unittest', 'loop', 'spin', {'n': 1}, stamps=100000)
+        self.assertEqual((status, result), (0, 0))
+
+        status, result, many = self.e.execute('unittest', 'loop', 'spin', {'n': 100}, stamps=100000)
+        self.assertEqual((status, result), (0, 4950))
+
+        self.assertGreater(many, few)
+
+    def test_infinite_loop_runs_out_of_stamps(self):
+        status, result, used = self.e.execute('unittest', 'loop', 'forever', {}, stamps=10000)
+
+        self.assertEqual(status, 1)
+        self.assertIsInstance(result, AssertionError)
+        self.assertGreater(used, 10000)
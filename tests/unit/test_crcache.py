@@ -7,10 +7,13 @@ from contracting.db.cr.cache import CRCache, Macros
 from contracting.execution.executor import Executor
 from contracting.db.driver import ContractDriver
 from contracting.db.cr.transaction_bag import TransactionBag
+from contracting.compilation.compiler import ContractingCompiler
+from contracting import config
 
 class PayloadStub():
-    def __init__(self, sender):
+    def __init__(self, sender, stamps=1000000):
         self.sender = sender
+        self.stampsSupplied = stamps
 
 class TransactionStub():
     def __init__(self, sender, contract_name, func_name, kwargs):
@@ -154,3 +157,112 @@ class TestSingleCRCache(unittest.TestCase):
 
 # if __name__ == "__main__":
 #     unittest.main()
+
+
+bank = '''
+balances = Hash(default_value=0)
+
+@export
+def mint(to, amount):
+    balances[to] += amount
+    return balances[to]
+
+@export
+def transfer(sender, to, amount):
+    balances[sender] -= amount
+    balances[to] += amount
+    return balances[to]
+
+@export
+def pay_if_rich(sender, to, amount):
+    if balances[sender] >= 20:
+        balances[to] += amount
+
+@export
+def count():
+    return len(balances.all())
+'''
+
+
+class TestCRCacheReruns(unittest.TestCase):
+    def setUp(self):
+        self.master_db = ContractDriver(db=0)
+        self.master_db.flush()
+        sys.meta_path.append(DatabaseFinder)
+
+        self.master_db.set_contract(name='bank', code=ContractingCompiler().parse_to_code(bank, lint=False),
+                                    author='unittest')
+        self.master_db.commit()
+
+        self.scheduler = SchedulerStub()
+        self.cache = CRCache(idx=1, master_db=self.master_db, sbb_idx=0, num_sbb=1,
+                             executor=Executor(metering=False), scheduler=self.scheduler)
+
+    def tearDown(self):
+        self.cache.db.flush()
+        self.master_db.flush()
+        sys.meta_path.remove(DatabaseFinder)
+
+    def test_only_dependent_transactions_rerun(self):
+        txs = [TransactionStub('unittest', 'bank', 'mint', {'to': 'a', 'amount': 10}),
+               TransactionStub('unittest', 'bank', 'mint', {'to': 'b', 'amount': 10}),
+               TransactionStub('unittest', 'bank', 'mint', {'to': 'c', 'amount': 10}),
+               TransactionStub('unittest', 'bank', 'transfer', {'sender': 'b', 'to': 'd', 'amount': 1}),
+               TransactionStub('unittest', 'bank', 'mint', {'to': 'e', 'amount': 10})]
+
+        self.cache.set_bag(TransactionBag(txs, 'A'*64, lambda y: y))
+        self.cache.execute()
+
+        # Another sub-block changes the balance of b before CR
+        key_b = self.cache.db.read_log.reads(1)[0][0]
+        self.cache.db.set_direct(key_b, 5)
+
+        self.cache.prepare_reruns()
+        self.assertEqual(self.cache.rerun_idx, 1)
+
+        self.cache.rerun_transactions()
+
+        # Minting to b and the transfer from b are executed again, the others are replayed
+        self.assertEqual(self.cache.rerun_count, 2)
+        self.assertEqual(self.cache.rerun_ratio, 0.4)
+
+        self.assertEqual(self.cache.results[1][1], 15)
+        self.assertEqual(self.cache.results[3][1], 1)
+        self.assertEqual(self.cache.db.get(key_b), 14)
+        self.assertEqual(len(self.cache.db.contract_modifications), 6)
+
+    def test_scan_after_a_rerun_that_creates_a_key_runs_again(self):
+        txs = [TransactionStub('unittest', 'bank', 'mint', {'to': 'b', 'amount': 10}),
+               TransactionStub('unittest', 'bank', 'pay_if_rich', {'sender': 'b', 'to': 'z', 'amount': 1}),
+               TransactionStub('unittest', 'bank', 'count', {})]
+
+        self.cache.set_bag(TransactionBag(txs, 'A'*64, lambda y: y))
+        self.cache.execute()
+        self.assertEqual(self.cache.results[2][1], 1)
+
+        # Another sub-block makes b rich enough for the payment, which creates the balance of z
+        key_b = self.cache.db.read_log.reads(0)[0][0]
+        self.cache.db.set_direct(key_b, 15)
+
+        self.cache.prepare_reruns()
+        self.cache.rerun_transactions()
+
+        self.assertEqual(self.cache.rerun_count, 3)
+        self.assertEqual(self.cache.results[2][1], 2)
+
+    def test_merge_to_master_streams_raw_values(self):
+        self.cache.db.write_batch({'bank.balances:{}'.format(i): str(i) for i in range(25)})
+        self.cache.db.incrby(Macros.EXECUTION)
+
+        config.WRITE_BATCH_SIZE, batch_size = 10, config.WRITE_BATCH_SIZE
+        try:
+            self.cache.merge_to_master()
+        finally:
+            config.WRITE_BATCH_SIZE = batch_size
+
+        self.assertEqual(self.master_db.get_direct('bank.balances:7'), b'7')
+        self.assertEqual(self.master_db.get('bank.balances:24'), 24)
+        self.assertIsNone(self.master_db.get_direct(Macros.EXECUTION))
+
+        self.assertEqual(self.cache.merge_stats['keys'], 25)
+        self.assertGreaterEqual(self.cache.merge_stats['chunks'], 3)
@@ -1,7 +1,16 @@
-from unittest import TestCase
-from contracting.db.driver import RedisDriver, ContractDriver, DBMDriver
+from unittest import TestCase, skipIf
+import tempfile
+import os
+from contracting.db.driver import RedisDriver, ContractDriver, DBMDriver, LMDBDriver, lmdb, INDEXED_DBS
+from contracting.db.encoder import msgpack
+from contracting.compilation.compiler import ContractingCompiler
 from contracting import config
+from contracting.execution.runtime import rt
 import random
+import time
+import threading
+import marshal
+import sys
 
 class TestAbstractDatabaseDriver(TestCase):
     pass
@@ -271,6 +280,205 @@ class TestRedisDatabaseDriver(TestCase):
 
         self.assertListEqual(keys, ks)
 
+    def test_write_batch_sets_and_deletes(self):
+        self.d.set('gone', 'x')
+
+        sets = {'k{}'.format(i): 'v{}'.format(i) for i in range(10)}
+        self.d.write_batch(sets, deletes=['gone'], batch_size=3)
+
+        for k, v in sets.items():
+            self.assertEqual(self.d.get(k).decode(), v)
+
+        self.assertIsNone(self.d.get('gone'))
+
+    def test_iter_uses_index_and_forgets_deleted_keys(self):
+        for k in ['a', 'ab', 'abc', 'b']:
+            self.d.set(k, k)
+
+        self.d.delete('abc')
+
+        self.assertListEqual(self.d.iter(prefix='a'), [b'a', b'ab'])
+        self.assertListEqual(self.d.keys(), [b'a', b'ab', b'b'])
+
+    def test_rebuild_index_picks_up_unindexed_keys(self):
+        self.d.conn.set('raw', 'x')
+        self.assertListEqual(self.d.iter(prefix='raw'), [])
+
+        self.d.rebuild_index()
+
+        self.assertListEqual(self.d.iter(prefix='raw'), [b'raw'])
+
+    def test_state_from_before_the_index_is_indexed_on_first_connect(self):
+        self.d.conn.set('old.balances:stu', '1')
+        self.d.conn.set('old.owner', 'stu')
+        INDEXED_DBS.clear()
+
+        d = RedisDriver(db=1)
+
+        self.assertListEqual(d.keys(), [b'old.balances:stu', b'old.owner'])
+        self.assertListEqual(d.iter(prefix='old.balances'), [b'old.balances:stu'])
+
+    def test_existing_index_is_left_alone_on_first_connect(self):
+        self.d.set('indexed', 'x')
+        self.d.conn.set('raw', 'x')
+        INDEXED_DBS.clear()
+
+        d = RedisDriver(db=1)
+
+        self.assertListEqual(d.keys(), [b'indexed'])
+
+    def test_iter_chunks(self):
+        self.d.write_batch({'k{}'.format(i): i for i in range(7)})
+
+        chunks = list(self.d.iter_chunks(batch_size=3))
+
+        self.assertListEqual([len(c) for c in chunks], [3, 3, 1])
+        self.assertEqual(dict(kv for c in chunks for kv in c)[b'k4'], b'4')
+
+    def test_incrby_is_indexed(self):
+        self.assertEqual(self.d.incrby('inc'), 1)
+        self.assertEqual(self.d.incrby('inc', 5), 6)
+        self.assertEqual(self.d.get('inc'), b'6')
+        self.assertListEqual(self.d.iter(prefix='inc'), [b'inc'])
+
+    def test_concurrent_incrby_loses_no_updates(self):
+        def increment():
+            driver = RedisDriver(db=1)
+            for _ in range(50):
+                driver.incrby('inc')
+
+        threads = [threading.Thread(target=increment) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(int(self.d.get('inc')), 200)
+
+    def test_incrby_publishes_on_channel(self):
+        received = []
+        subscription = self.d.subscribe('channel', received.append)
+
+        for _ in range(50):
+            self.d.incrby('inc', channel='channel')
+            if received:
+                break
+            time.sleep(0.02)
+
+        subscription.stop()
+        self.assertEqual(received[0], b'inc')
+
+    def test_publish_reaches_subscribers(self):
+        received = []
+        subscription = self.d.subscribe('channel', received.append)
+
+        for _ in range(50):
+            self.d.publish('channel', 'hello')
+            if received:
+                break
+            time.sleep(0.02)
+
+        subscription.stop()
+        self.assertEqual(received[0], b'hello')
+
+
+# Opened at import so lmdb finishes its lazy imports before other tests swap out the import machinery
+lmdb_dir = tempfile.mkdtemp()
+lmdb_driver = LMDBDriver(dir=lmdb_dir, db=1) if lmdb is not None else None
+
+
+@skipIf(lmdb is None, 'lmdb is not installed')
+class TestLMDBDatabaseDriver(TestCase):
+    # Flush this sucker every test
+    def setUp(self):
+        self.d = lmdb_driver
+        self.d.flush()
+
+    def tearDown(self):
+        self.d.flush()
+
+    def test_get_set(self):
+        a = 'a'
+        self.d.set('b', a)
+
+        b = self.d.get('b')
+        b = b.decode()
+        self.assertEqual(a, b)
+
+    def test_delete(self):
+        self.d.set('b', 'a')
+        self.d.delete('b')
+
+        self.assertIsNone(self.d.get('b'))
+
+    def test_dbs_are_separate(self):
+        other = LMDBDriver(dir=lmdb_dir, db=2)
+        other.flush()
+
+        self.d.set('b', 'a')
+
+        self.assertIsNone(other.get('b'))
+
+    def test_iter_only_returns_prefix(self):
+        keys = ['a', 'ab', 'abc', 'abd', 'ac', 'b', 'ba']
+        for k in keys:
+            self.d.set(k, k)
+
+        self.assertListEqual(self.d.iter(prefix='ab'), [b'ab', b'abc', b'abd'])
+        self.assertListEqual(self.d.iter(prefix='x'), [])
+        self.assertListEqual(self.d.keys(), [k.encode() for k in keys])
+
+    def test_incrby(self):
+        self.assertEqual(self.d.incrby('inc'), 1)
+        self.assertEqual(self.d.incrby('inc', 5), 6)
+        self.assertEqual(int(self.d.get('inc')), 6)
+
+    def test_write_batch_and_get_many(self):
+        self.d.set('gone', 'x')
+
+        self.d.write_batch({'k1': 'v1', 'k2': 'v2'}, deletes=['gone'])
+
+        self.assertListEqual(self.d.get_many(['k1', 'k2', 'gone']), [b'v1', b'v2', None])
+
+    def test_snapshot_does_not_see_later_writes(self):
+        self.d.set('b', 'old')
+
+        with self.d.snapshot() as snap:
+            self.d.set('b', 'new')
+            self.d.set('bb', 'new')
+
+            self.assertEqual(snap.get('b'), b'old')
+            self.assertListEqual(snap.iter(prefix='b'), [b'b'])
+
+        self.assertEqual(self.d.get('b'), b'new')
+
+    def test_iter_chunks(self):
+        self.d.write_batch({'k{}'.format(i): i for i in range(7)})
+
+        chunks = list(self.d.iter_chunks(batch_size=3))
+
+        self.assertListEqual([len(c) for c in chunks], [3, 3, 1])
+        self.assertEqual(dict(kv for c in chunks for kv in c)[b'k4'], b'4')
+
+    @skipIf(not hasattr(os, 'register_at_fork'), 'needs os.register_at_fork')
+    def test_forked_process_opens_its_own_environment(self):
+        parent_env = self.d.env
+
+        pid = os.fork()
+        if pid == 0:
+            # The inherited driver must have reopened its environment and be able to write with it
+            try:
+                self.d.set('forked', 'yes')
+                os._exit(0 if self.d.env is not parent_env else 1)
+            except BaseException:
+                os._exit(2)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+
+        self.assertIs(self.d.env, parent_env)
+        self.assertEqual(self.d.get('forked'), b'yes')
+
 
 class TestDBMDatabaseDriver(TestCase):
     # Flush this sucker every test
@@ -458,7 +666,7 @@ def stu():
             '{}{}{}'.format(name, self.d.delimiter, config.CODE_KEY),
             '{}{}{}'.format(name, self.d.delimiter, config.AUTHOR_KEY),
             '{}{}{}'.format(name, self.d.delimiter, config.TYPE_KEY),
-            '{}{}{}'.format(name, self.d.delimiter, '__compiled__')
+            '{}{}{}'.format(name, self.d.delimiter, config.HASH_KEY)
         ]
 
         self.d.commit()
@@ -470,6 +678,72 @@ def stu():
 
         self.assertListEqual(keys, k)
 
+    def test_compiled_code_is_stored_raw(self):
+        self.d.set_contract('stustu', 'a = 1')
+        self.d.commit()
+
+        code_hash = self.d.get_contract_hash('stustu')
+        key = self.d.artifact_key(code_hash)
+
+        self.assertIn(sys.implementation.cache_tag, key)
+        self.assertEqual(marshal.loads(self.d.get_direct(key)).co_consts, compile('a = 1', '', 'exec').co_consts)
+
+        scope = {}
+        exec(self.d.get_compiled('stustu', code_hash), scope)
+        self.assertEqual(scope['a'], 1)
+
+    def test_contract_submitted_before_commit_is_loaded(self):
+        self.d.set_contract('stustu', 'a = 1')
+        self.d.commit()
+
+        # Submitted again in the same bag. The hash and the code come from the cache, not the committed contract
+        self.d.set_contract('stustu', 'a = 2')
+
+        scope = {}
+        exec(self.d.get_compiled('stustu', self.d.get_contract_hash('stustu')), scope)
+        self.assertEqual(scope['a'], 2)
+
+    def test_is_submitted_until_committed(self):
+        self.assertFalse(self.d.is_submitted('stustu'))
+
+        self.d.set_contract('stustu', 'a = 1')
+        self.assertTrue(self.d.is_submitted('stustu'))
+
+        self.d.commit()
+        self.assertFalse(self.d.is_submitted('stustu'))
+
+    def test_get_compiled_without_artifact_compiles_the_code(self):
+        self.d.set_contract('stustu', 'a = 1')
+        self.d.commit()
+        self.d.delete(self.d.artifact_key(self.d.get_contract_hash('stustu')))
+        self.d.commit()
+
+        scope = {}
+        exec(self.d.get_compiled('stustu', self.d.get_contract_hash('stustu')), scope)
+        self.assertEqual(scope['a'], 1)
+
+    def test_artifact_matches_the_code_compiled_from_source(self):
+        source = '''
+# A comment and blank lines the canonical source drops
+
+
+v = Variable()
+
+@export
+def f(a,
+      b):
+    return a + b
+'''
+        code, code_obj = ContractingCompiler(module_name='stustu').parse_to_artifacts(source, lint=False)
+        self.d.set_contract('stustu', code, code_obj=code_obj)
+        self.d.commit()
+        artifact = self.d.get_compiled('stustu', self.d.get_contract_hash('stustu'))
+
+        self.d.delete(self.d.artifact_key(self.d.get_contract_hash('stustu')))
+        self.d.commit()
+
+        self.assertEqual(artifact, self.d.get_compiled('stustu', self.d.get_contract_hash('stustu')))
+
     def test_delete_contract(self):
             contract = '''
 def stu():
@@ -504,4 +778,130 @@ def stu():
         _t = 'test'
 
         self.d.set_contract(name, contract, author=author, _type=_t)
-        self.assertTrue(self.d.is_contract('stustu'))
\ No newline at end of file
+        self.assertTrue(self.d.is_contract('stustu'))
+
+    def test_decoded_values_are_cached(self):
+        self.d.set('token.balances:stu', 100)
+
+        self.d.get('token.balances:stu')
+        self.d.get('token.balances:stu')
+
+        self.assertDictEqual(self.d.decoded_stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_decoded_cache_follows_sets_and_reverts(self):
+        self.d.set('token.balances:stu', 100)
+        self.assertEqual(self.d.get('token.balances:stu'), 100)
+
+        self.d.new_tx()
+        self.d.set('token.balances:stu', 50)
+        self.assertEqual(self.d.get('token.balances:stu'), 50)
+
+        self.d.revert(1)
+        self.assertEqual(self.d.get('token.balances:stu'), 100)
+
+        self.d.commit()
+        self.assertEqual(self.d.get('token.balances:stu'), 100)
+
+    def test_mutable_values_are_not_cached(self):
+        self.d.set('token.owners', {'stu': True})
+
+        owners = self.d.get('token.owners')
+        owners['colin'] = True
+
+        self.assertDictEqual(self.d.get('token.owners'), {'stu': True})
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack_commits_ints_past_64_bits(self):
+        m = ContractDriver(db=1, codec='msgpack')
+        m.set('token.supply', 2 ** 64)
+        m.commit()
+        m.clear_decoded()
+
+        self.assertEqual(m.get('token.supply'), 2 ** 64)
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    def test_migrate_codec_to_msgpack(self):
+        self.d.set('token.balances:stu', 1_000_000)
+        self.d.set('token.owner', 'stu')
+        self.d.delete('token.gone')
+        self.d.commit()
+
+        m = ContractDriver(db=1, codec='msgpack')
+
+        self.assertEqual(m.migrate_codec(), 2)
+        self.assertEqual(m.migrate_codec(), 0)
+
+        self.assertTrue(m.codec.is_encoded(m.get_direct('token.owner')))
+        self.assertEqual(m.get('token.balances:stu'), 1_000_000)
+
+        m.delete('token.owner')
+        m.commit()
+
+        self.assertIsNone(m.get_direct('token.owner'))
+
+
+class TestContractDriverMetering(TestCase):
+    # Block metering charges nothing for the lines of code that is not a contract, so only storage is charged here
+    def setUp(self):
+        self.d = ContractDriver(db=1)
+        self.d.flush()
+
+    def tearDown(self):
+        rt.tracer.stop()
+        rt.clean_up()
+        self.d.flush()
+
+    def charged(self, f):
+        rt.set_up(stmps=10_000_000, meter=True, mode='blocks')
+        f()
+        rt.tracer.stop()
+        used = rt.tracer.get_stamp_used()
+        rt.clean_up()
+        return used
+
+    def test_read_is_charged_per_key_and_byte(self):
+        self.d.set('token.balances:stu', 100)
+        self.d.commit()
+
+        raw = self.d.get_direct('token.balances:stu')
+        expected = config.READ_COST_PER_KEY + (len('token.balances:stu') + len(raw)) * config.READ_COST_PER_BYTE
+
+        self.assertEqual(self.charged(lambda: self.d.get('token.balances:stu')), expected)
+
+    def test_write_is_charged_per_key_and_byte(self):
+        raw = self.d.codec.encode(100)
+        expected = config.WRITE_COST_PER_KEY + (len('token.balances:stu') + len(raw)) * config.WRITE_COST_PER_BYTE
+
+        self.assertEqual(self.charged(lambda: self.d.set('token.balances:stu', 100)), expected)
+
+    def test_read_costs_the_same_from_cache_and_storage(self):
+        self.d.set('token.balances:stu', 100)
+        self.d.commit()
+
+        from_storage = self.charged(lambda: self.d.get('token.balances:stu'))
+        from_cache = self.charged(lambda: self.d.get('token.balances:stu'))
+
+        self.d.reset_cache()
+        self.d.prefetch(['token.balances:stu'])
+        prefetched = self.charged(lambda: self.d.get('token.balances:stu'))
+
+        self.assertEqual(from_storage, from_cache)
+        self.assertEqual(from_storage, prefetched)
+
+    def test_missing_key_is_charged_for_the_key(self):
+        expected = config.READ_COST_PER_KEY + len('token.owner') * config.READ_COST_PER_BYTE
+        self.assertEqual(self.charged(lambda: self.d.get('token.owner')), expected)
+
+    def test_commit_is_not_charged_again(self):
+        self.d.set('token.balances:stu', 100)
+        self.assertEqual(self.charged(self.d.commit), 0)
+
+    def test_contract_code_is_read_unmetered(self):
+        self.d.set_contract(name='token', code='a = 1')
+        self.assertEqual(self.charged(lambda: self.d.get_contract('token')), 0)
+
+    def test_nothing_is_charged_when_not_metering(self):
+        self.d.set('token.balances:stu', 100)
+        self.d.get('token.balances:stu')
+
+        self.assertEqual(rt.tracer.get_stamp_used(), 0)
@@ -1,5 +1,6 @@
-from unittest import TestCase
-from contracting.db.encoder import encode, decode
+from unittest import TestCase, skipIf
+from contracting.db.encoder import encode, decode, get_codec, JSONCodec, msgpack
+from contracting.exceptions import CodecNotFound
 from decimal import Decimal as dec
 from contracting.stdlib.bridge.time import Datetime, Timedelta
 from datetime import datetime
@@ -73,3 +74,64 @@ class TestEncode(TestCase):
         t = decode(_t)
 
         self.assertEqual(t, Timedelta(weeks=1, days=1))
+
+
+class TestGetCodec(TestCase):
+    def test_default_is_json(self):
+        self.assertIsInstance(get_codec(), JSONCodec)
+
+    def test_unknown_codec_raises(self):
+        with self.assertRaises(CodecNotFound):
+            get_codec('xml')
+
+
+@skipIf(msgpack is None, 'msgpack is not installed')
+class TestMsgpackCodec(TestCase):
+    def setUp(self):
+        self.c = get_codec('msgpack')
+
+    def test_roundtrip_primitives(self):
+        for v in [1000, -5, 'hello', True, None, [1, 'a'], {'a': {'b': [1, 2]}}]:
+            self.assertEqual(self.c.decode(self.c.encode(v)), v)
+
+    def test_decimals_go_through_float_like_json(self):
+        for d in [dec('99.7532'), dec(99.7532), dec('0.0044997618965276123456789'), dec('1E+300'), dec('Infinity')]:
+            self.assertEqual(self.c.decode(self.c.encode(d)), decode(encode(d)))
+
+        self.assertEqual(self.c.decode(self.c.encode(dec(99.7532))), dec('99.7532'))
+
+    def test_bytes_come_back_as_hex_like_json(self):
+        self.assertEqual(self.c.decode(self.c.encode(b'ab')), '6162')
+        self.assertEqual(self.c.decode(self.c.encode({'x': [b'\x00\x01']})), decode(encode({'x': [b'\x00\x01']})))
+
+    def test_floats_come_back_as_decimals_like_json(self):
+        self.assertEqual(self.c.decode(self.c.encode(1.098409840984)), dec('1.098409840984'))
+        self.assertEqual(self.c.decode(self.c.encode({'x': [0.5]})), {'x': [dec('0.5')]})
+
+    def test_non_string_keys_become_strings_like_json(self):
+        self.assertEqual(self.c.decode(self.c.encode({1: 'a'})), decode(encode({1: 'a'})))
+
+    def test_ints_past_64_bits(self):
+        for v in [2 ** 64, 2 ** 64 - 1, -2 ** 63 - 1, -2 ** 63, 10 ** 100, [2 ** 70, {'a': -10 ** 30}]]:
+            self.assertEqual(self.c.decode(self.c.encode(v)), v)
+
+    def test_datetime_and_timedelta(self):
+        d = Datetime(2019, 1, 1, 12, 30, 15, 100)
+        t = Timedelta(weeks=1, days=1)
+
+        self.assertEqual(self.c.decode(self.c.encode(d)), d)
+        self.assertEqual(self.c.decode(self.c.encode(t)), t)
+
+    def test_smaller_than_json(self):
+        v = {'owner': 'stu', 'amount': 1000000, 'history': [1, 2, 3, 4]}
+
+        self.assertLess(len(self.c.encode(v)), len(encode(v)))
+
+    def test_reads_legacy_json(self):
+        self.assertEqual(self.c.decode(b'{"__time__": [2019, 1, 1, 0, 0, 0, 0]}'), Datetime(2019, 1, 1))
+        self.assertEqual(self.c.decode('1234'), 1234)
+
+    def test_is_encoded(self):
+        self.assertTrue(self.c.is_encoded(self.c.encode(1)))
+        self.assertFalse(self.c.is_encoded(b'1'))
+        self.assertFalse(JSONCodec().is_encoded(self.c.encode(1)))
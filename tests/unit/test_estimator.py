@@ -0,0 +1,104 @@
+from unittest import TestCase
+from collections import Counter
+import dis
+import os
+import tempfile
+from contracting.exceptions import CostTableNotFound, CostTableMismatch
+from contracting.execution.metering import costs
+from contracting.execution.metering.estimator import OperationsEstimator, quantize
+
+
+class TestOperationsEstimator(TestCase):
+    def setUp(self):
+        self.e = OperationsEstimator(reference=('LOAD_CONST',), reference_cost=2, ridge=0)
+
+    def test_count_opcodes_counts_every_iteration(self):
+        once = self.e.count_opcodes(self.e.compile('for a in range(1): pass'))
+        many = self.e.count_opcodes(self.e.compile('for a in range(10): pass'))
+
+        self.assertEqual(many[dis.opmap['FOR_ITER']] - once[dis.opmap['FOR_ITER']], 9)
+
+    def test_count_opcodes_includes_called_functions(self):
+        counts = self.e.count_opcodes(self.e.compile('def f():\n    return 1\nf()\nf()'))
+        self.assertEqual(counts[dis.opmap['RETURN_VALUE']], 3)
+
+    def test_compile_skips_invalid_syntax(self):
+        self.assertIsNone(self.e.compile('def'))
+
+    def test_solve_recovers_costs(self):
+        a, b, c = 1, 2, 3
+        truth = {a: 2.0, b: 5.0, c: 11.0}
+        overhead = 7.0
+
+        rows = []
+        for counts in [{a: 1}, {a: 3, b: 1}, {b: 2, c: 1}, {a: 1, c: 4}, {a: 2, b: 2, c: 2}, {c: 1}]:
+            rows.append((Counter(counts), overhead + sum(truth[op] * n for op, n in counts.items())))
+
+        seconds = self.e.solve(rows)
+
+        self.assertAlmostEqual(seconds[None], overhead, places=3)
+        for op, cost in truth.items():
+            self.assertAlmostEqual(seconds[op], cost, places=3)
+
+    def test_solve_downweights_outliers(self):
+        a, b = 1, 2
+        rows = [(Counter({a: n, b: m}), 1.0 * n + 3.0 * m) for n in range(1, 5) for m in range(1, 5)]
+        rows.append((Counter({a: 1, b: 1}), 1000.0))
+
+        seconds = self.e.solve(rows)
+
+        self.assertAlmostEqual(seconds[a], 1.0, delta=0.1)
+        self.assertAlmostEqual(seconds[b], 3.0, delta=0.1)
+
+    def test_cu_costs_covers_every_opcode(self):
+        reference = dis.opmap['LOAD_CONST']
+        table = self.e.cu_costs({None: 100.0, reference: 1.0, 1: 4.0, 2: 0.0})
+
+        self.assertEqual(sorted(table), list(range(costs.TABLE_SIZE)))
+        self.assertEqual(table[reference], 2)
+        self.assertEqual(table[1], 8)
+        self.assertEqual(table[2], 1)
+
+        # Opcodes no snippet ran are charged like the expensive measured ones
+        self.assertEqual(table[255], 8)
+
+    def test_quantize(self):
+        self.assertEqual([quantize(c) for c in [0, 1, 1.9, 2.9, 5.5, 7, 11, 100]], [1, 1, 2, 3, 6, 8, 12, 96])
+
+
+class TestCostTables(TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'cu_costs.test.const')
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_write_and_load(self):
+        table = {op: op % 7 + 1 for op in range(costs.TABLE_SIZE)}
+        costs.write_costs(table, self.path, comments=['a comment'])
+
+        with open(self.path) as f:
+            self.assertEqual(f.readline(), '# a comment\n')
+
+        self.assertEqual(costs.load_costs(self.path), table)
+
+    def test_missing_table_fails(self):
+        with self.assertRaises(CostTableNotFound):
+            costs.load_costs(self.path)
+
+    def test_table_of_wrong_size_fails(self):
+        with open(self.path, 'w') as f:
+            for op in range(144):
+                f.write('{},1\n'.format(op))
+
+        with self.assertRaises(CostTableMismatch):
+            costs.load_costs(self.path)
+
+    def test_write_incomplete_table_fails(self):
+        with self.assertRaises(CostTableMismatch):
+            costs.write_costs({0: 1}, self.path)
+
+    def test_versioned_path(self):
+        self.assertTrue(costs.costs_path('cpython-36').endswith('cu_costs.cpython-36.const'))
+        self.assertEqual(costs.load_costs(costs.costs_path('cpython-36'))[100], 2)
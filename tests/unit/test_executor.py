@@ -191,12 +191,103 @@ class DBTests(unittest.TestCase):
         self.assertEqual(results[0][1], 'Working')
 
 
+class TestTransactionPool(unittest.TestCase):
+    def setUp(self):
+        sys.meta_path.append(DatabaseFinder)
+        driver.flush()
+        self.author = 'unittest'
+
+        compiler = ContractingCompiler()
+        with open('./test_sys_contracts/module_func.py') as f:
+            code = f.read()
+
+        driver.set_contract(name='module_func', code=compiler.parse_to_code(code, lint=False), author=self.author)
+        driver.commit()
+
+        self.e = Executor(metering=False)
+        self.e_pool = Executor(metering=False, workers=2)
+
+    def tearDown(self):
+        self.e_pool.pool.terminate()
+        sys.meta_path.remove(DatabaseFinder)
+        driver.flush()
+
+    def bag(self):
+        txs = []
+        for i in range(8):
+            txs.append(ContractTxStub(self.author, 'module_func', 'test_func', {'status': str(i)}))
+            txs.append(ContractTxStub(self.author, 'module_func', 'test_keymod', {'deduct': i}))
+        txs.append(ContractTxStub(self.author, 'badmodule', 'test_func', {'status': 'Working'}))
+
+        return TransactionBag(txs, 'A'*64, completion_handler_stub)
+
+    def test_pool_execute_bag_matches_serial(self):
+        serial_driver = ContractDriver(db=0)
+        serial = self.e.execute_bag(self.bag(), driver=serial_driver)
+
+        pool_driver = ContractDriver(db=0)
+        parallel = self.e_pool.execute_bag(self.bag(), driver=pool_driver)
+
+        self.assertEqual(sorted(serial.keys()), sorted(parallel.keys()))
+        for idx in serial:
+            self.assertEqual(serial[idx][0], parallel[idx][0])
+            if serial[idx][0] == 0:
+                self.assertEqual(serial[idx][1], parallel[idx][1])
+            else:
+                self.assertEqual(type(serial[idx][1]), type(parallel[idx][1]))
+
+        self.assertEqual(serial_driver.contract_modifications, pool_driver.contract_modifications)
+        self.assertEqual(pool_driver.get('__main__.balances:test'), -28)
+
+    def test_pool_loads_contract_submitted_earlier_in_the_bag(self):
+        with open('../../contracting/contracts/submission.s.py') as f:
+            driver.set_contract(name='submission', code=f.read(), author='sys')
+        driver.commit()
+
+        code = "@export\ndef hello():\n    return 'hi'\n"
+        txs = [ContractTxStub(self.author, 'submission', 'submit_contract', {'name': 'newc', 'code': code}),
+               ContractTxStub(self.author, 'newc', 'hello', {})]
+        results = self.e_pool.execute_bag(TransactionBag(txs, 'A'*64, completion_handler_stub),
+                                          driver=ContractDriver(db=0))
+
+        self.assertEqual(results[1][:2], (0, 'hi'))
+        self.assertEqual(self.e_pool.pool.stats()['reexecuted'], 1)
+
+    def test_pool_reexecutes_conflicting_txs(self):
+        self.e_pool.execute_bag(self.bag(), driver=ContractDriver(db=0))
+
+        stats = self.e_pool.pool.stats()
+        self.assertEqual(stats['applied'] + stats['reexecuted'], 17)
+
+        # Every test_keymod after the first one read a balance an earlier tx of the bag wrote
+        self.assertGreaterEqual(stats['reexecuted'], 7)
+
+    def test_pool_is_valid(self):
+        pool_driver = ContractDriver(db=0)
+        pool_driver.set('module_func.balances:test', 5)
+
+        self.assertTrue(self.e_pool.pool.is_valid(pool_driver, {'module_func.balances:test': b'5'}))
+        self.assertFalse(self.e_pool.pool.is_valid(pool_driver, {'module_func.balances:test': None}))
+        self.assertTrue(self.e_pool.pool.is_valid(pool_driver, {'module_func.balances:stu': None}))
+
+    def test_pool_is_valid_scans(self):
+        pool_driver = ContractDriver(db=0)
+        self.assertTrue(self.e_pool.pool.is_valid(pool_driver, {}, {'module_func.balances:': frozenset()}))
+
+        # A key created earlier in the bag is seen by a serial scan but not by the worker's
+        pool_driver.set('module_func.balances:stu', 5)
+        self.assertFalse(self.e_pool.pool.is_valid(pool_driver, {}, {'module_func.balances:': frozenset()}))
+        self.assertTrue(self.e_pool.pool.is_valid(pool_driver, {},
+                                                  {'module_func.balances:': frozenset([b'module_func.balances:stu'])}))
+
+
 # Stub out the Contract Transaction object for use in the unit test
 # We will need to write an integration test that passes real contract
 # objects, but here is not the place
 class PayloadStub(object):
-    def __init__(self, sender):
+    def __init__(self, sender, stamps=1000000):
         self.sender = sender
+        self.stampsSupplied = stamps
 
 
 class ContractTxStub(object):
@@ -8,13 +8,15 @@ from contracting.db.cr.cache import CRCache, Macros
 from contracting.execution.executor import Executor
 from contracting.db.driver import ContractDriver
 from contracting.db.cr.transaction_bag import TransactionBag
-from contracting.db.cr.client import FSMScheduler
+from contracting.db.cr.client import FSMScheduler, notify_all
+from contracting import config
 
 driver = ContractDriver(db=0)
 
 class PayloadStub():
-    def __init__(self, sender):
+    def __init__(self, sender, stamps=1000000):
         self.sender = sender
+        self.stampsSupplied = stamps
 
 class TransactionStub():
     def __init__(self, sender, contract_name, func_name, kwargs):
@@ -112,3 +114,249 @@ class TestMultiCRCache(unittest.TestCase):
             self.assertTrue(self.caches[i] not in self.scheduler.pending_caches)
             if i < self.num_caches-1:
                 self.assertEqual(self.caches[i+1].state, 'READY_TO_MERGE')
+
+
+class CacheStub():
+    def __init__(self):
+        self.state = 'WAITING'
+
+
+class TestSchedulerWakeup(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.scheduler = FSMScheduler(self.loop, sbb_idx=0, num_sbb=1)
+
+        self.cache = CacheStub()
+        self.ready = False
+        self.calls = 0
+
+    def tearDown(self):
+        self.scheduler.fut.cancel()
+        self.loop.run_until_complete(asyncio.gather(self.scheduler.fut, return_exceptions=True))
+        self.loop.close()
+
+    def transition(self):
+        self.calls += 1
+        if self.ready:
+            self.cache.state = 'DONE'
+
+    def run_loop(self, period):
+        self.loop.run_until_complete(asyncio.sleep(period))
+
+    def test_new_poll_runs_without_waiting_for_the_interval(self):
+        self.ready = True
+        self.scheduler.add_poll(self.cache, self.transition, 'DONE')
+        self.run_loop(config.POLL_INTERVAL / 10)
+
+        self.assertEqual(self.cache.state, 'DONE')
+        self.assertEqual(self.calls, 1)
+
+    def test_notification_retries_polls(self):
+        self.scheduler.add_poll(self.cache, self.transition, 'DONE')
+        self.run_loop(config.POLL_INTERVAL / 10)
+        self.assertEqual(self.cache.state, 'WAITING')
+
+        self.ready = True
+        notify_all()
+        self.run_loop(config.POLL_INTERVAL / 10)
+
+        self.assertEqual(self.cache.state, 'DONE')
+        self.assertEqual(self.calls, 2)
+
+    def test_polls_are_retried_often_without_a_subscription(self):
+        self.assertEqual(self.scheduler.poll_interval, config.POLL_INTERVAL)
+
+        self.scheduler.add_poll(self.cache, self.transition, 'DONE')
+        self.run_loop(config.POLL_INTERVAL / 10)
+        self.ready = True
+        self.run_loop(config.POLL_INTERVAL * 2)
+
+        self.assertEqual(self.cache.state, 'DONE')
+
+
+class PoolCacheStub():
+    def __init__(self, idx, scheduler):
+        self.idx = idx
+        self.state = 'CLEAN'
+        self.bag = None
+        scheduler.mark_clean(self)
+
+    def set_bag(self, bag):
+        self.bag = bag
+        self.state = 'BAG_SET'
+
+    def execute(self):
+        self.state = 'EXECUTED'
+
+    def merge(self):
+        self.state = 'RESET'
+
+
+class TestCachePool(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.schedulers = []
+
+    def tearDown(self):
+        for scheduler in self.schedulers:
+            scheduler.stop()
+            scheduler.fut.cancel()
+        self.loop.run_until_complete(asyncio.gather(*[s.fut for s in self.schedulers], return_exceptions=True))
+        self.loop.close()
+        driver.flush()
+
+    def scheduler(self, sbb_idx=0, driver=None, resizable=True):
+        scheduler = FSMScheduler(self.loop, sbb_idx=sbb_idx, num_sbb=2, driver=driver)
+        if resizable:
+            scheduler.cache_factory = lambda idx: PoolCacheStub(idx, scheduler)
+        self.schedulers.append(scheduler)
+        return scheduler
+
+    def bag(self, input_hash):
+        return TransactionBag([], input_hash, completion_handler_stub)
+
+    def clean(self, scheduler, cache):
+        cache.state = 'CLEAN'
+        scheduler.mark_clean(cache)
+
+    def run_loop(self, period=0.1):
+        self.loop.run_until_complete(asyncio.sleep(period))
+
+    def test_bags_queue_until_a_cache_is_clean(self):
+        scheduler = self.scheduler(resizable=False)
+        cache = PoolCacheStub(1, scheduler)
+
+        self.assertTrue(scheduler.execute_bag(self.bag('A'*64)))
+        self.assertTrue(scheduler.execute_bag(self.bag('B'*64)))
+        self.assertEqual(cache.bag.input_hash, 'A'*64)
+        self.assertEqual(scheduler.stats()['queued'], 1)
+
+        self.clean(scheduler, cache)
+        self.run_loop()
+
+        self.assertEqual(cache.bag.input_hash, 'B'*64)
+        self.assertEqual(scheduler.stats()['queued'], 0)
+        self.assertEqual(list(scheduler.pending_caches), [cache])
+
+    def test_bags_beyond_the_queue_size_are_rejected(self):
+        scheduler = self.scheduler(resizable=False)
+
+        for i in range(config.MAX_SB_QUEUE_SIZE):
+            self.assertTrue(scheduler.execute_bag(self.bag(str(i))))
+        self.assertFalse(scheduler.execute_bag(self.bag('X'*64)))
+
+        self.assertEqual(scheduler.stats()['queued'], config.MAX_SB_QUEUE_SIZE)
+        self.assertEqual(scheduler.stats()['rejected'], 1)
+
+    def test_merge_of_queued_bag_is_scheduled_once_it_runs(self):
+        scheduler = self.scheduler(resizable=False)
+        cache = PoolCacheStub(1, scheduler)
+
+        scheduler.execute_bag(self.bag('A'*64))
+        scheduler.execute_bag(self.bag('B'*64))
+        scheduler.update_master_db()
+        scheduler.update_master_db()
+        self.assertEqual(scheduler.merges_requested, 1)
+
+        self.run_loop()
+        self.assertEqual(cache.state, 'RESET')
+
+        self.clean(scheduler, cache)
+        self.run_loop()
+
+        self.assertEqual(cache.bag.input_hash, 'B'*64)
+        self.assertEqual(scheduler.merges_requested, 0)
+        self.assertEqual(cache.state, 'RESET')
+
+    def test_pool_grows_under_backlog(self):
+        scheduler = self.scheduler()
+        scheduler._resize_pool()
+        self.assertEqual(len(scheduler.caches), config.MIN_NUM_CACHES)
+
+        for i in range(config.MIN_NUM_CACHES + 2):
+            self.assertTrue(scheduler.execute_bag(self.bag(str(i))))
+
+        self.assertEqual(scheduler.stats()['queued'], 0)
+        self.assertEqual(len(scheduler.caches), config.MIN_NUM_CACHES + 2)
+        self.assertEqual([c.idx for c in scheduler.caches],
+                         [config.DB_OFFSET + i for i in range(config.MIN_NUM_CACHES + 2)])
+
+    def test_pool_never_grows_beyond_max(self):
+        scheduler = self.scheduler()
+
+        for i in range(config.MAX_NUM_CACHES + 2):
+            self.assertTrue(scheduler.execute_bag(self.bag(str(i))))
+
+        self.assertEqual(len(scheduler.caches), config.MAX_NUM_CACHES)
+        self.assertEqual(scheduler.stats()['queued'], 2)
+
+    def test_pool_shrinks_back_when_idle(self):
+        scheduler = self.scheduler()
+        for i in range(config.MIN_NUM_CACHES + 2):
+            scheduler.execute_bag(self.bag(str(i)))
+
+        for cache in list(scheduler.pending_caches):
+            self.clean(scheduler, cache)
+        scheduler.arrivals.clear()
+
+        for _ in range(3):
+            scheduler.notify()
+            self.run_loop()
+
+        self.assertEqual(len(scheduler.caches), config.MIN_NUM_CACHES)
+        self.assertEqual(len(scheduler.available_caches), config.MIN_NUM_CACHES)
+        self.assertGreater(scheduler.stats()['latency'], 0)
+
+    def test_other_sub_block_builders_follow_the_first(self):
+        leader = self.scheduler(sbb_idx=0, driver=driver)
+        follower = self.scheduler(sbb_idx=1, driver=driver)
+
+        for i in range(config.MIN_NUM_CACHES + 1):
+            leader.execute_bag(self.bag(str(i)))
+
+        # The new size reaches the follower by pub/sub
+        deadline = time.time() + 3
+        while follower.pool_size != len(leader.caches) and time.time() < deadline:
+            self.run_loop()
+        follower._resize_pool()
+
+        self.assertGreater(len(leader.caches), config.MIN_NUM_CACHES)
+        self.assertEqual(len(follower.caches), len(leader.caches))
+
+    def test_followers_are_told_of_a_new_pool_size(self):
+        leader = self.scheduler(sbb_idx=0, driver=driver)
+        follower = self.scheduler(sbb_idx=1, driver=driver)
+        leader._resize_pool()
+        follower._resize_pool()
+        self.assertEqual(follower.pool_size, config.MIN_NUM_CACHES)
+
+        # Not read back from the DB on wakeups, the size comes with the message of the leader
+        follower._check_pool_key = lambda: self.fail('The pool size was read back from the DB')
+
+        for i in range(config.MIN_NUM_CACHES + 1):
+            leader.execute_bag(self.bag(str(i)))
+        # The follower grows its pool on the wakeup after the message, not when it arrives
+        deadline = time.time() + 3
+        while len(follower.caches) != len(leader.caches) and time.time() < deadline:
+            self.run_loop()
+
+        self.assertEqual(follower.pool_size, len(leader.caches))
+        self.assertEqual(len(follower.caches), len(leader.caches))
+
+    def test_polls_wait_longer_while_subscribed(self):
+        scheduler = self.scheduler(driver=driver)
+        self.assertEqual(scheduler.poll_interval, config.NOTIFIED_POLL_INTERVAL)
+
+        scheduler.stop()
+        self.assertEqual(scheduler.poll_interval, config.POLL_INTERVAL)
+
+    def test_pool_size_is_kept_out_of_the_state(self):
+        leader = self.scheduler(sbb_idx=0, driver=driver)
+        leader._resize_pool()
+
+        self.assertEqual(int(driver.get_meta(config.CACHE_POOL_KEY)), config.MIN_NUM_CACHES)
+        self.assertIsNone(driver.get_direct(config.CACHE_POOL_KEY))
+        self.assertNotIn(config.CACHE_POOL_KEY, driver.keys())
+        self.assertEqual(driver.iter(prefix=config.CACHE_POOL_KEY), [])
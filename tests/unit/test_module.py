@@ -1,7 +1,11 @@
 from unittest import TestCase
 from contracting.execution.module import *
+from contracting.execution.metering import blocks
 import types
 import glob
+import gc
+import weakref
+from contracting import config
 
 
 class TestDatabase(TestCase):
@@ -148,3 +152,211 @@ print("now i can run my functions!")
         print('ok do it again')
 
         exec(code, vars(ctx))
+
+    def test_loader_driver_keeps_nothing_of_a_load(self):
+        d = loader_driver()
+        for name in ['module1', 'module2']:
+            # Without an artifact for this interpreter the code is read and compiled from source
+            driver.delete(driver.artifact_key(driver.get_contract_hash(name)))
+            driver.commit()
+
+            sys.modules.pop(name, None)
+            MODULE_CACHE.pop(name)
+            importlib.import_module(name)
+
+            self.assertEqual(d.original_values, {})
+            self.assertEqual(len(d.read_log), 1)
+            self.assertEqual(d.read_log.reads(0), [])
+
+
+callee = '''
+calls = Variable()
+
+@export
+def who():
+    return ctx.caller
+'''
+
+caller = '''
+import callee
+
+@export
+def who():
+    return callee.who()
+'''
+
+leaky = '''
+h = Hash()
+
+@export
+def set_leak(v):
+    h.leak = v
+
+@export
+def get_leak():
+    return h.leak
+'''
+
+
+class TestWarmModules(TestCase):
+    def setUp(self):
+        from contracting.execution.executor import Executor
+        from contracting.compilation.compiler import ContractingCompiler
+
+        sys.meta_path.append(DatabaseFinder)
+        driver.flush()
+
+        self.compiler = ContractingCompiler()
+        self.submit('callee', callee)
+        self.submit('caller', caller)
+
+        self.e = Executor(metering=False)
+
+    def tearDown(self):
+        sys.meta_path.remove(DatabaseFinder)
+        driver.flush()
+
+    def submit(self, name, code):
+        driver.set_contract(name=name, code=self.compiler.parse_to_code(code, lint=False), author='unittest')
+        driver.commit()
+
+    def test_reusable_body(self):
+        self.assertTrue(reusable_body(compile("a = 1\nb = Hash()\nimport c\ndef f():\n    return a", '', 'exec')))
+        self.assertFalse(reusable_body(compile("b = Hash()\nb['x'] = 1", '', 'exec')))
+        self.assertFalse(reusable_body(compile("a = len('x')", '', 'exec')))
+        self.assertFalse(reusable_body(compile("a = [i for i in (1, 2)]", '', 'exec')))
+        self.assertFalse(reusable_body(compile("b = Hash()\ndef f():\n    b.x = 1", '', 'exec')))
+
+    def test_reusable_body_does_not_keep_evicted_code(self):
+        # Equal code objects share a cache entry, so none of the others may compile from the same source
+        code = compile("a = 'evicted'", '', 'exec')
+        ref = weakref.ref(code)
+        reusable_body(code)
+
+        for i in range(config.MODULE_CACHE_SIZE):
+            reusable_body(compile("a = {}".format(i), '', 'exec'))
+
+        del code
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_body_is_executed_once(self):
+        self.e.execute('stu', 'callee', 'who', {})
+        instance = MODULE_INSTANCES['callee']
+        function = instance.body['who']
+
+        self.e.execute('stu', 'callee', 'who', {})
+
+        self.assertIs(MODULE_INSTANCES['callee'], instance)
+        self.assertIs(instance.scope['who'], function)
+
+    def test_context_is_bound_again(self):
+        self.assertEqual(self.e.execute('stu', 'caller', 'who', {})[1], 'caller')
+        self.assertEqual(self.e.execute('stu', 'callee', 'who', {})[1], 'stu')
+        self.assertEqual(self.e.execute('stu', 'caller', 'who', {})[1], 'caller')
+        self.assertEqual(self.e.execute('colin', 'callee', 'who', {})[1], 'colin')
+
+    def test_orm_objects_use_the_current_driver(self):
+        other = ContractDriver(db=0)
+
+        self.e.execute('stu', 'callee', 'who', {})
+        self.e.execute('stu', 'callee', 'who', {}, driver=other)
+
+        self.assertIs(MODULE_INSTANCES['callee'].body['__calls']._driver, other)
+
+    def test_resubmission_invalidates(self):
+        self.e.execute('stu', 'callee', 'who', {})
+
+        self.submit('callee', callee.replace('return ctx.caller', 'return 42'))
+        self.assertNotIn('callee', MODULE_INSTANCES)
+
+        self.assertEqual(self.e.execute('stu', 'callee', 'who', {})[1], 42)
+
+    def test_attributes_set_by_a_transaction_are_not_seen_by_the_next(self):
+        self.submit('leaky', leaky)
+
+        self.assertEqual(self.e.execute('stu', 'leaky', 'set_leak', {'v': 42})[0], 0)
+
+        status, result, _ = self.e.execute('stu', 'leaky', 'get_leak', {})
+        self.assertEqual(status, 1)
+        self.assertIsInstance(result, AttributeError)
+
+    def test_mutable_body_is_not_kept(self):
+        self.submit('callee', callee + '\nseen = []\n')
+        self.e.execute('stu', 'callee', 'who', {})
+
+        self.assertIsNone(MODULE_INSTANCES['callee'])
+
+
+class TestModuleCache(TestCase):
+    def setUp(self):
+        self.cache = ModuleCache(size=2)
+
+        self.code = compile('a = 1', '', 'exec')
+        self.code_a = compile('a = 1', '', 'exec')
+        self.code_b = compile('b = 1', '', 'exec')
+        self.code_c = compile('c = 1', '', 'exec')
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def test_hit_requires_same_version(self):
+        self.cache.set('a', 'v1', self.code)
+
+        self.assertEqual(self.cache.get('a', 'v1'), self.code)
+        self.assertIsNone(self.cache.get('a', 'v2'))
+        self.assertIsNone(self.cache.get('b', 'v1'))
+
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 2, 'evictions': 0, 'size': 1})
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set('a', 'v', self.code_a)
+        self.cache.set('b', 'v', self.code_b)
+        self.cache.get('a', 'v')
+        self.cache.set('c', 'v', self.code_c)
+
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache)
+        self.assertIn('c', self.cache)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_eviction_drops_warm_instance(self):
+        MODULE_INSTANCES['evicted_contract'] = object()
+
+        self.cache.set('evicted_contract', 'v', self.code)
+        self.cache.set('b', 'v', self.code_b)
+        self.cache.set('c', 'v', self.code_c)
+
+        self.assertNotIn('evicted_contract', MODULE_INSTANCES)
+
+    def test_cached_code_is_metered_by_block(self):
+        self.cache.set('a', 'v', self.code_a)
+        self.cache.set('b', 'v', self.code_b)
+        self.assertIn(id(self.code_a), blocks.TABLES)
+
+        self.cache.set('c', 'v', self.code_c)
+        self.assertNotIn(id(self.code_a), blocks.TABLES)
+
+        self.cache.pop('b')
+        self.assertNotIn(id(self.code_b), blocks.TABLES)
+        self.assertIn(id(self.code_c), blocks.TABLES)
+
+    def test_loaders_share_a_driver(self):
+        self.assertIs(DatabaseLoader().d, DatabaseLoader().d)
+
+    def test_stale_version_is_loaded_again(self):
+        sys.meta_path.append(DatabaseFinder)
+        try:
+            driver.set_contract(name='versioned', code='a = 1', author='unittest')
+            driver.commit()
+
+            # As if another process had loaded an older version of the contract
+            MODULE_CACHE.set('versioned', 'an older hash', compile('a = 0', '', 'exec'))
+
+            import versioned
+            self.assertEqual(versioned.a, 1)
+            self.assertEqual(MODULE_CACHE.get('versioned', driver.get_contract_hash('versioned')).co_consts[0], 1)
+        finally:
+            sys.meta_path.remove(DatabaseFinder)
+            sys.modules.pop('versioned', None)
+            driver.flush()
@@ -0,0 +1,200 @@
+from unittest import TestCase
+import sys
+from contracting.db.driver import ContractDriver
+from contracting.db.cr.transaction_bag import TransactionBag
+from contracting.execution.executor import Executor
+from contracting.execution.module import DatabaseFinder
+from contracting.execution.optimistic import MultiVersionMemory, STORAGE
+from contracting.compilation.compiler import ContractingCompiler
+
+code = '''
+balances = Hash(default_value=0)
+
+@export
+def transfer(sender, to, amount):
+    balances[sender] -= amount
+    balances[to] += amount
+    return balances[to]
+
+@export
+def mint(to, amount):
+    balances[to] += amount
+    return balances[to]
+
+@export
+def total():
+    return len(balances.all())
+'''
+
+
+class PayloadStub():
+    def __init__(self, sender, stamps=1000000):
+        self.sender = sender
+        self.stampsSupplied = stamps
+
+
+class TransactionStub():
+    def __init__(self, sender, contract_name, func_name, kwargs):
+        self.payload = PayloadStub(sender)
+        self.contract_name = contract_name
+        self.func_name = func_name
+        self.kwargs = kwargs
+
+
+def completion_handler_stub():
+    pass
+
+
+class TestMultiVersionMemory(TestCase):
+    def setUp(self):
+        self.m = MultiVersionMemory()
+
+    def test_read_without_writers_is_storage(self):
+        self.assertEqual(self.m.read('a', 3), (STORAGE, None))
+
+    def test_read_returns_highest_writer_below(self):
+        self.m.record(1, 0, {'a': '1'})
+        self.m.record(4, 0, {'a': '4'})
+
+        self.assertEqual(self.m.read('a', 0), (STORAGE, None))
+        self.assertEqual(self.m.read('a', 1), (STORAGE, None))
+        self.assertEqual(self.m.read('a', 2), ((1, 0), '1'))
+        self.assertEqual(self.m.read('a', 9), ((4, 0), '4'))
+
+    def test_record_drops_keys_no_longer_written(self):
+        self.m.record(1, 0, {'a': '1', 'b': '1'})
+        self.m.record(1, 1, {'b': '2'})
+
+        self.assertEqual(self.m.read('a', 2), (STORAGE, None))
+        self.assertEqual(self.m.read('b', 2), ((1, 1), '2'))
+
+    def test_record_same_value_keeps_version(self):
+        self.m.record(1, 0, {'a': '1'})
+        self.m.record(1, 1, {'a': '1'})
+
+        self.assertEqual(self.m.read('a', 2), ((1, 0), '1'))
+
+    def test_keys_below_idx(self):
+        self.m.record(1, 0, {'x.a': '1'})
+        self.m.record(3, 0, {'x.b': '1', 'y.c': '1'})
+
+        self.assertEqual(self.m.keys('x.', 1), frozenset())
+        self.assertEqual(self.m.keys('x.', 2), frozenset(['x.a']))
+        self.assertEqual(self.m.keys('x.', 4), frozenset(['x.a', 'x.b']))
+
+
+driver = ContractDriver(db=0)
+
+
+class TestOptimisticExecutor(TestCase):
+    def setUp(self):
+        sys.meta_path.append(DatabaseFinder)
+        driver.flush()
+
+        compiler = ContractingCompiler()
+        driver.set_contract(name='bank', code=compiler.parse_to_code(code, lint=False), author='unittest')
+        driver.commit()
+
+        self.e = Executor(metering=False)
+        self.e_opt = Executor(metering=False, optimistic=True)
+
+    def tearDown(self):
+        self.e_opt.pool.terminate()
+        sys.meta_path.remove(DatabaseFinder)
+        driver.flush()
+
+    def bag(self):
+        txs = []
+        for i in range(10):
+            txs.append(TransactionStub('unittest', 'bank', 'mint', {'to': 'user{}'.format(i), 'amount': 10}))
+        for i in range(10):
+            txs.append(TransactionStub('unittest', 'bank', 'transfer',
+                                       {'sender': 'user{}'.format(i), 'to': 'user{}'.format((i + 1) % 10),
+                                        'amount': i}))
+        txs.append(TransactionStub('unittest', 'bank', 'total', {}))
+        txs.append(TransactionStub('unittest', 'nope', 'total', {}))
+
+        return TransactionBag(txs, 'A'*64, completion_handler_stub)
+
+    def assert_same_as_serial(self):
+        serial_driver = ContractDriver(db=0)
+        serial = self.e.execute_bag(self.bag(), driver=serial_driver)
+
+        optimistic_driver = ContractDriver(db=0)
+        optimistic = self.e_opt.execute_bag(self.bag(), driver=optimistic_driver)
+
+        self.assertEqual(sorted(serial.keys()), sorted(optimistic.keys()))
+        for idx in serial:
+            self.assertEqual(serial[idx][0], optimistic[idx][0])
+            if serial[idx][0] == 0:
+                self.assertEqual(serial[idx][1], optimistic[idx][1])
+
+        self.assertEqual(serial_driver.contract_modifications, optimistic_driver.contract_modifications)
+
+    def test_same_as_serial(self):
+        self.assert_same_as_serial()
+
+    def test_same_as_serial_without_concurrency(self):
+        self.e_opt.optimistic.concurrency = 1
+        self.assert_same_as_serial()
+
+        # Every transaction sees the writes of the ones before it, so nothing is executed twice
+        stats = self.e_opt.optimistic.stats()
+        self.assertEqual(stats['executions'], stats['transactions'])
+
+    def test_same_as_serial_fully_concurrent(self):
+        self.e_opt.optimistic.concurrency = 100
+        self.assert_same_as_serial()
+
+        stats = self.e_opt.optimistic.stats()
+        self.assertGreater(stats['executions'], stats['transactions'])
+        self.assertGreater(stats['rounds'], 1)
+
+    def test_independent_transactions_execute_once(self):
+        self.e_opt.optimistic.concurrency = 100
+
+        txs = [TransactionStub('unittest', 'bank', 'mint', {'to': 'user{}'.format(i), 'amount': 10})
+               for i in range(10)]
+        results = self.e_opt.execute_bag(TransactionBag(txs, 'A'*64, completion_handler_stub),
+                                         driver=ContractDriver(db=0))
+
+        self.assertEqual([results[i][1] for i in range(10)], [10] * 10)
+        self.assertEqual(self.e_opt.optimistic.stats()['executions'], 10)
+        self.assertEqual(self.e_opt.optimistic.stats()['rounds'], 1)
+
+    def test_waves_execute_on_workers(self):
+        self.e_opt.optimistic.concurrency = 100
+        self.assert_same_as_serial()
+
+        self.assertEqual(self.e_opt.optimistic.stats()['fallbacks'], 0)
+
+    def test_memory_is_shipped_once_per_chunk(self):
+        self.e_opt.optimistic.concurrency = 100
+
+        tasks = []
+        pool_map = self.e_opt.pool.map
+
+        def recording_map(func, wave):
+            tasks.extend(wave)
+            return pool_map(func, wave)
+
+        self.e_opt.pool.map = recording_map
+        self.assert_same_as_serial()
+
+        rounds = self.e_opt.optimistic.stats()['rounds']
+        self.assertLessEqual(len(tasks), rounds * self.e_opt.pool.workers)
+        for _, _, memory, txs in tasks:
+            self.assertIsInstance(memory, bytes)
+            self.assertLessEqual(len(txs), -(-len(self.bag().transactions) // self.e_opt.pool.workers))
+
+    def test_reads_of_state_the_workers_do_not_see_run_on_the_parent(self):
+        # Written to the parent's driver but not committed, so the workers read the stored balance instead. The contract
+        # is compiled without a name, so its ORM keys are under __main__
+        pending = ContractDriver(db=0)
+        pending.set('__main__.balances:user0', 100)
+
+        txs = [TransactionStub('unittest', 'bank', 'mint', {'to': 'user0', 'amount': 10})]
+        results = self.e_opt.execute_bag(TransactionBag(txs, 'A'*64, completion_handler_stub), driver=pending)
+
+        self.assertEqual(results[0][1], 110)
+        self.assertEqual(self.e_opt.optimistic.stats()['fallbacks'], 1)
@@ -0,0 +1,68 @@
+from unittest import TestCase
+from contracting.execution.prefetch import Prefetcher, OBSERVATIONS_PER_FUNCTION
+
+
+class PayloadStub():
+    def __init__(self, sender):
+        self.sender = sender
+
+
+class TransactionStub():
+    def __init__(self, sender, contract_name, func_name, kwargs):
+        self.payload = PayloadStub(sender)
+        self.contract_name = contract_name
+        self.func_name = func_name
+        self.kwargs = kwargs
+
+
+class TestPrefetcher(TestCase):
+    def setUp(self):
+        self.p = Prefetcher()
+
+    def test_balance_key_predicted_when_metering(self):
+        keys = self.p.keys_for_tx('stu', 'erc20', 'transfer', {}, metering=True)
+        self.assertSetEqual(keys, {'currency.balances:stu'})
+
+    def test_no_keys_predicted_without_metering_or_history(self):
+        keys = self.p.keys_for_tx('stu', 'erc20', 'transfer', {}, metering=False)
+        self.assertSetEqual(keys, set())
+
+    def test_observed_patterns_are_reused_for_new_senders_and_kwargs(self):
+        self.p.observe('stu', 'erc20', 'transfer', {'amount': 1, 'to': 'colin'},
+                       {'erc20.balances:stu', 'erc20.balances:colin', 'erc20.supply'})
+
+        keys = self.p.keys_for_tx('raghu', 'erc20', 'transfer', {'amount': 5, 'to': 'davis'}, metering=False)
+
+        self.assertSetEqual(keys, {'erc20.balances:raghu', 'erc20.balances:davis', 'erc20.supply'})
+
+    def test_multi_dimension_keys(self):
+        self.p.observe('stu', 'erc20', 'approve', {'amount': 1, 'to': 'colin'}, {'erc20.balances:stu:colin'})
+
+        keys = self.p.keys_for_tx('raghu', 'erc20', 'approve', {'amount': 5, 'to': 'davis'}, metering=False)
+
+        self.assertSetEqual(keys, {'erc20.balances:raghu:davis'})
+
+    def test_pattern_skipped_if_kwarg_missing(self):
+        self.p.observe('stu', 'erc20', 'transfer', {'to': 'colin'}, {'erc20.balances:colin'})
+
+        keys = self.p.keys_for_tx('raghu', 'erc20', 'transfer', {}, metering=False)
+
+        self.assertSetEqual(keys, set())
+
+    def test_keys_for_bag(self):
+        self.p.observe('stu', 'erc20', 'transfer', {'to': 'colin'}, {'erc20.balances:colin'})
+
+        bag = [(0, TransactionStub('stu', 'erc20', 'transfer', {'to': 'a'})),
+               (1, TransactionStub('colin', 'erc20', 'transfer', {'to': 'b'}))]
+
+        keys = self.p.keys_for_bag(bag)
+
+        self.assertSetEqual(keys, {'currency.balances:stu', 'currency.balances:colin',
+                                   'erc20.balances:a', 'erc20.balances:b'})
+
+    def test_stops_learning_after_enough_observations(self):
+        for _ in range(OBSERVATIONS_PER_FUNCTION):
+            self.assertTrue(self.p.wants('erc20', 'transfer'))
+            self.p.observe('stu', 'erc20', 'transfer', {}, set())
+
+        self.assertFalse(self.p.wants('erc20', 'transfer'))
@@ -1,5 +1,7 @@
 from unittest import TestCase
 from contracting.execution import runtime
+from contracting.execution.metering import blocks
+from contracting import config
 
 
 class TestRuntime(TestCase):
@@ -7,9 +9,11 @@ class TestRuntime(TestCase):
         runtime.rt.tracer.stop()
         runtime.rt.clean_up()
 
+    # Block metering, the default, charges nothing for the lines of code that is not a contract. These tests meter the
+    # lines of the test itself
     def test_tracer_works_roughly(self):
         stamps = 1000
-        runtime.rt.set_up(stmps=stamps, meter=True)
+        runtime.rt.set_up(stmps=stamps, meter=True, mode='lines')
         a = 5
         runtime.rt.tracer.stop()
         used = runtime.rt.tracer.get_stamp_used()
@@ -41,7 +45,7 @@ class TestRuntime(TestCase):
 
     def test_starting_and_stopping_tracer_works_roughly(self):
         stamps = 1000
-        runtime.rt.set_up(stmps=stamps, meter=True)
+        runtime.rt.set_up(stmps=stamps, meter=True, mode='lines')
         a = 5
         b = 5
         c = 5
@@ -52,7 +56,7 @@ class TestRuntime(TestCase):
         runtime.rt.clean_up()
 
         stamps = 1000
-        runtime.rt.set_up(stmps=stamps, meter=True)
+        runtime.rt.set_up(stmps=stamps, meter=True, mode='lines')
         a = 5
         b = 5
         runtime.rt.tracer.stop()
@@ -103,4 +107,82 @@ class TestRuntime(TestCase):
         used_1 = runtime.rt.tracer.get_stamp_used()
 
         runtime.rt.clean_up()
-        print(used_1)
\ No newline at end of file
+        print(used_1)
+
+class TestMemoryMetering(TestCase):
+    def setUp(self):
+        self.limit = config.MEMORY_LIMIT
+        self.bytes_per_stamp = config.MEMORY_BYTES_PER_STAMP
+
+    def tearDown(self):
+        config.MEMORY_LIMIT = self.limit
+        config.MEMORY_BYTES_PER_STAMP = self.bytes_per_stamp
+
+        runtime.rt.tracer.stop()
+        runtime.rt.clean_up()
+
+    def used(self, size, contract=True):
+        # Only code registered as a contract has its allocations metered
+        code = compile('a = bytearray(size)', '', 'exec')
+        if contract:
+            blocks.register(code)
+
+        try:
+            runtime.rt.set_up(stmps=1000000, meter=True)
+            exec(code, {'size': size})
+            runtime.rt.tracer.stop()
+        finally:
+            blocks.unregister(code)
+
+        return runtime.rt.tracer.get_memory_used(), runtime.rt.tracer.get_stamp_used()
+
+    def test_allocations_are_counted(self):
+        memory, _ = self.used(100000)
+        self.assertGreaterEqual(memory, 100000)
+
+    def test_allocations_are_rounded_up_to_a_size_class(self):
+        memory, _ = self.used(1000)
+        self.assertEqual(memory, 1024)
+
+    def test_allocations_are_counted_the_same_every_time(self):
+        first, _ = self.used(100000)
+        runtime.rt.clean_up()
+        second, _ = self.used(100000)
+
+        self.assertEqual(first, second)
+
+    def test_small_allocations_are_not_counted(self):
+        memory, _ = self.used(100)
+        self.assertEqual(memory, 0)
+
+    def test_allocations_outside_contracts_are_not_counted(self):
+        memory, _ = self.used(100000, contract=False)
+        self.assertEqual(memory, 0)
+
+    def test_allocations_are_charged(self):
+        _, small = self.used(1000)
+        runtime.rt.clean_up()
+        _, large = self.used(1000000)
+
+        self.assertGreaterEqual(large - small, 999000 // config.MEMORY_BYTES_PER_STAMP)
+
+    def test_allocations_are_free_without_bytes_per_stamp(self):
+        config.MEMORY_BYTES_PER_STAMP = 0
+
+        _, small = self.used(1000)
+        runtime.rt.clean_up()
+        _, large = self.used(1000000)
+
+        self.assertEqual(small, large)
+
+    def test_allocation_past_limit_fails(self):
+        config.MEMORY_LIMIT = 100000
+
+        with self.assertRaises(MemoryError):
+            self.used(1000000)
+
+    def test_reset_clears_memory_used(self):
+        self.used(100000)
+        runtime.rt.clean_up()
+
+        self.assertEqual(runtime.rt.tracer.get_memory_used(), 0)
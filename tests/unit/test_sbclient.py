@@ -2,6 +2,7 @@ from unittest import TestCase
 from contracting.execution.executor import Executor
 from contracting.db.cr.client import SubBlockClient
 from contracting.db.driver import ContractDriver
+from contracting import config
 from contracting.logger import get_logger
 import asyncio, glob
 from typing import List
@@ -70,6 +71,8 @@ class TestSBClient(TestCase):
         driver.flush()
         for client in self.clients:
             client.flush_all()
+            client.stop()
+        self.loop.run_until_complete(asyncio.gather(*[c.scheduler.fut for c in self.clients]))
 
     def run_loop(self, period=1):
         async def run():
@@ -77,6 +80,20 @@ class TestSBClient(TestCase):
 
         self.loop.run_until_complete(run())
 
+    def test_stop_ends_the_scheduler(self):
+        client = self.clients[1]
+        subscriptions = [client.scheduler.subscription, client.scheduler.pool_subscription]
+
+        client.stop()
+        self.loop.run_until_complete(client.scheduler.fut)
+
+        self.assertTrue(client.scheduler.fut.done())
+        self.assertIsNone(client.scheduler.subscription)
+        self.assertIsNone(client.scheduler.pool_subscription)
+        for subscription in subscriptions:
+            subscription.join(timeout=config.NOTIFIED_POLL_INTERVAL * 2)
+            self.assertFalse(subscription.is_alive())
+
     def test_some_conflicts(self):
         def _assert_handler1(outputs: List[tuple]):
             contract1, status1, result1, state1 = outputs[0]